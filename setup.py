@@ -10,8 +10,13 @@ setup(
     entry_points = {
         'console_scripts': [
           'tbx2depfile=tbx2cmake.read_scons:main',
-          'tbx2cmake=tbx2cmake.write_cmake:main'
+          'tbx2cmake=tbx2cmake.write_cmake:main',
+          'tbx2compdb=tbx2cmake.write_compdb:main',
+          'tbx2ninja=tbx2cmake.write_ninja:main',
+          'tbx2impact=tbx2cmake.impact:main',
+          'tbx2query=tbx2cmake.query:main'
         ],
     },
-    install_requires=["enum34", "docopt", "networkx<2", "pyyaml", "mock"],
+    install_requires=["enum34; python_version < '3.4'", "docopt", "networkx", "pyyaml",
+                      "mock; python_version < '3.3'", "fissix; python_version >= '3.13'"],
 )
@@ -0,0 +1,390 @@
+# coding: utf-8
+
+"""
+Estimates the build cost of a TBX distribution without building it.
+
+Every target is given a relative cost from the number and size of its
+sources and the heavy headers that they include. Combined with the link
+graph between targets, this gives the critical path through the build, how
+much parallelism is available and which targets hold everything else up.
+"""
+
+import os
+import re
+import collections
+import subprocess
+
+import networkx as nx
+
+from .utils import topological_order
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Headers that dominate compile time when included, with a relative weight.
+# Matched as prefixes against the #include name.
+HEAVY_HEADERS = {
+  "boost/python": 4.0,
+  "scitbx/array_family/boost_python/flex_wrapper": 6.0,
+  "scitbx/array_family/versa_matrix": 2.0,
+  "cctbx/sgtbx/space_group": 2.0,
+  "boost/spirit": 3.0,
+  "boost/fusion": 2.0,
+  "boost/math": 1.5,
+  "boost/random": 1.0,
+  "boost/thread": 1.0,
+  "Eigen": 3.0,
+}
+
+# Relative cost of compiling one source, per KiB of source text, and per
+# generated source (which doesn't exist until refresh has been run)
+COST_PER_SOURCE = 1.0
+COST_PER_KIB = 0.05
+COST_PER_GENERATED = 2.0
+# Number of buckets to sample the parallelism profile into
+PROFILE_BUCKETS = 20
+
+_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.M)
+
+class TargetCost(object):
+  """The estimated build cost of a single target"""
+  def __init__(self, target):
+    self.target = target
+    self.sources = 0
+    self.source_bytes = 0
+    self.generated = 0
+    self.heavy_includes = collections.Counter()
+
+  @property
+  def cost(self):
+    cost = COST_PER_SOURCE * self.sources
+    cost += COST_PER_KIB * self.source_bytes / 1024.0
+    cost += COST_PER_GENERATED * self.generated
+    cost += sum(HEAVY_HEADERS[x] * n for x, n in self.heavy_includes.items())
+    return cost
+
+  def __repr__(self):
+    return "<TargetCost {} {:.1f}>".format(self.target.name, self.cost)
+
+def _heavy_header(include):
+  "Returns the HEAVY_HEADERS key matching an include, or None"
+  for header in HEAVY_HEADERS:
+    if include.startswith(header):
+      return header
+  return None
+
+def estimate_target_cost(tbx, target):
+  """Estimate the cost of building a target from it's sources.
+
+  :param tbx:    The TBXDistribution the target belongs to
+  :param target: The target to estimate
+  :returns: A TargetCost object
+  """
+  estimate = TargetCost(target)
+  for source in target.sources:
+    path = os.path.join(tbx.module_path, target.origin_path, source)
+    estimate.sources += 1
+    if not os.path.isfile(path):
+      logger.debug("Cannot read source {} for {}".format(path, target.name))
+      continue
+    estimate.source_bytes += os.path.getsize(path)
+    # Sources aren't always valid UTF-8, and only the directives matter
+    with open(path, "rb") as f:
+      for include in _INCLUDE_RE.findall(f.read().decode("latin-1")):
+        header = _heavy_header(include)
+        if header:
+          estimate.heavy_includes[header] += 1
+  estimate.generated = len(target.generated_sources)
+  return estimate
+
+def build_link_graph(tbx):
+  """Builds a networkX graph of link dependencies between targets.
+
+  Edges point from a target to the internal library that it links against.
+  """
+  G = nx.DiGraph()
+  names = {x.name for x in tbx.targets}
+  G.add_nodes_from(names)
+  for target in tbx.targets:
+    for lib in target.extra_libs:
+      if lib in names and lib != target.name:
+        G.add_edge(target.name, lib)
+  assert nx.is_directed_acyclic_graph(G), "Cycles found in target link graph"
+  return G
+
+class BuildAnalysis(object):
+  """Results of scheduling the estimated target costs over the link graph"""
+  def __init__(self, costs, graph):
+    self.costs = costs
+    self.graph = graph
+    self.start = {}
+    self.finish = {}
+    self.slack = {}
+    self.critical_path = []
+    self.profile = []
+
+  @property
+  def total_cost(self):
+    return sum(x.cost for x in self.costs.values())
+
+  @property
+  def makespan(self):
+    return max(self.finish.values()) if self.finish else 0.0
+
+  @property
+  def parallelism(self):
+    "The average parallelism available with unlimited workers"
+    if not self.makespan:
+      return 0.0
+    return self.total_cost / self.makespan
+
+  def bottlenecks(self, count=10):
+    """Targets on the critical path, most expensive first.
+
+    Returns a list of (name, cost, number of targets waiting on it)
+    """
+    entries = []
+    for name in self.critical_path:
+      dependents = len(nx.ancestors(self.graph, name))
+      entries.append((name, self.costs[name].cost, dependents))
+    return sorted(entries, key=lambda x: (-x[1], x[0]))[:count]
+
+def analyze_build(tbx):
+  """Estimate costs for every target and schedule them with unlimited workers.
+
+  :param tbx: The TBXDistribution to analyse, with autogen information applied
+  :returns: A BuildAnalysis object
+  """
+  costs = {x.name: estimate_target_cost(tbx, x) for x in tbx.targets}
+  G = build_link_graph(tbx)
+  analysis = BuildAnalysis(costs, G)
+
+  # Dependencies before dependents; sort names first for a stable order
+  order = topological_order(G, reverse=True)
+  for name in order:
+    start = max([analysis.finish[x] for x in G.successors(name)] or [0.0])
+    analysis.start[name] = start
+    analysis.finish[name] = start + costs[name].cost
+
+  # Work backwards to find how late each target could start without delay
+  makespan = analysis.makespan
+  latest_start = {}
+  for name in reversed(order):
+    latest_finish = min([latest_start[x] for x in G.predecessors(name)] or [makespan])
+    latest_start[name] = latest_finish - costs[name].cost
+    analysis.slack[name] = max(0.0, latest_start[name] - analysis.start[name])
+
+  # Walk back from the last target to finish through it's latest dependency
+  if order:
+    name = max(order, key=lambda x: (analysis.finish[x], x))
+    path = [name]
+    while list(G.successors(name)):
+      name = max(list(G.successors(name)), key=lambda x: (analysis.finish[x], x))
+      path.append(name)
+    analysis.critical_path = list(reversed(path))
+
+  # Sample how many targets are building at each point in time
+  if makespan:
+    width = makespan / PROFILE_BUCKETS
+    for bucket in range(PROFILE_BUCKETS):
+      middle = (bucket + 0.5) * width
+      running = sum(1 for x in order if analysis.start[x] <= middle < analysis.finish[x])
+      analysis.profile.append(running)
+
+  return analysis
+
+def import_libraries(tbx, static_libraries=False):
+  """Works out the internal libraries the dynamic loader has to open for each
+  python extension module, when it is imported.
+
+  :param tbx:              The TBXDistribution to examine
+  :param static_libraries: Whether internal shared libraries are being built
+                           as static libraries, and linked into the modules
+  :returns: A dictionary of module target name to a set of library names,
+            including the module itself
+  """
+  G = build_link_graph(tbx)
+  shared = {x.name for x in tbx.targets if x.type == x.Type.SHARED}
+  if static_libraries:
+    shared = set()
+  loaded = {}
+  for target in tbx.targets:
+    if target.type == target.Type.MODULE:
+      loaded[target.name] = {target.name} | (nx.descendants(G, target.name) & shared)
+  return loaded
+
+def format_import_report(tbx, static_libraries=False, baseline=None):
+  """Formats a summary of the internal libraries loaded when importing modules
+
+  :param baseline: The distribution as emulated without static libraries, to
+                   compare against. The SConscripts choose the library types,
+                   so a distribution emulated with static_libraries can't be
+                   used for the shared figure. By default, tbx itself
+  """
+  loaded = import_libraries(tbx, static_libraries)
+  shared_loaded = import_libraries(baseline or tbx)
+  if not loaded:
+    return "No python extension modules found"
+  total = len(set.union(*loaded.values()))
+  shared_total = len(set.union(*shared_loaded.values())) if shared_loaded else 0
+  worst = max(loaded, key=lambda x: (len(loaded[x]), x))
+  lines = [
+    "Importing all {} extension modules loads {} internal libraries ({} as shared libraries)".format(
+      len(loaded), total, shared_total),
+    "Most libraries loaded by one module: {} ({})".format(len(loaded[worst]), worst),
+  ]
+  return "\n".join(lines)
+
+# Extensions of the binaries compared in a size report
+BINARY_EXTENSIONS = (".so", ".dylib", ".a")
+
+def _find_binaries(build_dir, extensions=BINARY_EXTENSIONS):
+  "Finds the library files under a build directory, skipping symlinks"
+  for dirpath, dirnames, filenames in os.walk(build_dir):
+    dirnames[:] = sorted(x for x in dirnames if x != "CMakeFiles")
+    for filename in sorted(filenames):
+      path = os.path.join(dirpath, filename)
+      if filename.endswith(extensions) and not os.path.islink(path):
+        yield path
+
+def binary_sizes(build_dir):
+  """Finds the size of every library under a build directory.
+
+  :returns: A dictionary of path relative to the build directory, to size
+  """
+  return {os.path.relpath(x, build_dir): os.path.getsize(x) for x in _find_binaries(build_dir)}
+
+def unused_dependencies(path):
+  """Asks the dynamic loader which direct dependencies of a library are unused.
+
+  :returns: A list of library paths, or None if they couldn't be checked
+  """
+  try:
+    process = subprocess.Popen(["ldd", "-u", "-r", path],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  except OSError:
+    return None
+  output, _ = process.communicate()
+  lines = output.splitlines()
+  if not any(x.startswith("Unused direct dependencies") for x in lines):
+    return []
+  start = [i for i, x in enumerate(lines) if x.startswith("Unused direct dependencies")][0]
+  return [x.strip() for x in lines[start+1:] if x.strip()]
+
+def format_unused_report(build_dir):
+  "Formats the unused direct dependencies of every shared library in a build"
+  lines = []
+  checked = 0
+  for path in _find_binaries(build_dir, extensions=(".so",)):
+    unused = unused_dependencies(path)
+    if unused is None:
+      return "Cannot check dependencies; ldd was not found"
+    checked += 1
+    if unused:
+      lines.append("  {}".format(os.path.relpath(path, build_dir)))
+      lines.extend("    " + x for x in unused)
+  lines.insert(0, "{} of {} libraries have unused direct dependencies".format(
+    len([x for x in lines if not x.startswith("    ")]), checked))
+  return "\n".join(lines)
+
+def format_size_report(sizes, baseline):
+  "Formats the change in library sizes between two builds"
+  lines = ["Library size changes (KiB):"]
+  for name in sorted(set(sizes) | set(baseline)):
+    if not name in sizes:
+      lines.append("  {:50} {:>10}".format(name, "removed"))
+    elif not name in baseline:
+      lines.append("  {:50} {:>10}".format(name, "added"))
+    else:
+      change = sizes[name] - baseline[name]
+      lines.append("  {:50} {:10.1f} -> {:10.1f} {:+7.1%}".format(
+        name, baseline[name] / 1024.0, sizes[name] / 1024.0,
+        float(change) / baseline[name] if baseline[name] else 0.0))
+  total, base_total = sum(sizes.values()), sum(baseline.values())
+  lines.append("Total: {:.1f} KiB -> {:.1f} KiB ({:+.1%})".format(
+    base_total / 1024.0, total / 1024.0,
+    float(total - base_total) / base_total if base_total else 0.0))
+  return "\n".join(lines)
+
+# Placeholders the emulated libtbx environment uses for build-specific paths
+BUILD_PATH_PLACEHOLDERS = ("UNDERBUILD", "BASEDIR", "DISTPATH", "REPOSITORIES")
+
+_ABSOLUTE_PATH_RE = re.compile(r"(^|[=:,])/")
+
+def cache_hazards(target):
+  """Finds anything in a target's compile commands that would be different
+  for every build or checkout, and so stop a compiler cache from hitting.
+
+  :returns: A list of human-readable reasons
+  """
+  hazards = []
+  flags = list(target.flags.compile_options) + list(target.flags.compile_definitions)
+  for profile_flags in target.flags.profiles.values():
+    flags += list(profile_flags.compile_options) + list(profile_flags.compile_definitions)
+  for flag in flags:
+    if _ABSOLUTE_PATH_RE.search(flag):
+      hazards.append("absolute path in flag {}".format(flag))
+    elif any(x in flag for x in BUILD_PATH_PLACEHOLDERS):
+      hazards.append("build path in flag {}".format(flag))
+  for path in sorted(target.include_paths):
+    path = path.lstrip("!")
+    if path.startswith("/"):
+      hazards.append("absolute include path {}".format(path))
+    elif path.startswith("#build"):
+      hazards.append("include path in the build directory {}".format(path))
+  if target.generated_sources:
+    hazards.append("{} generated sources compiled from the build directory".format(
+      len(target.generated_sources)))
+  return hazards
+
+def format_cache_report(tbx):
+  "Formats a list of targets with compile commands that can't be cached"
+  targets = sorted(tbx.targets, key=lambda x: x.name)
+  hazards = [(x, cache_hazards(x)) for x in targets]
+  hazards = [(x, reasons) for x, reasons in hazards if reasons]
+  lines = ["{} of {} targets have build-specific compile commands".format(
+    len(hazards), len(targets))]
+  for target, reasons in hazards:
+    lines.append("  {} ({})".format(target.name, target.origin_path))
+    lines.extend("    " + x for x in reasons)
+  return "\n".join(lines)
+
+def format_report(analysis, count=10):
+  "Formats a BuildAnalysis as a human-readable report"
+  lines = []
+  lines.append("Estimated build cost: {:.1f} units over {} targets".format(
+    analysis.total_cost, len(analysis.costs)))
+  lines.append("Critical path length: {:.1f} units ({} targets)".format(
+    analysis.makespan, len(analysis.critical_path)))
+  lines.append("Average parallelism:  {:.2f}".format(analysis.parallelism))
+  lines.append("")
+
+  lines.append("Critical path:")
+  for name in analysis.critical_path:
+    lines.append("  {:40} {:8.1f} -> {:8.1f}".format(
+      name, analysis.start[name], analysis.finish[name]))
+  lines.append("")
+
+  lines.append("Parallelism profile (targets building over time):")
+  peak = max(analysis.profile or [0])
+  for bucket, running in enumerate(analysis.profile):
+    lines.append("  {:5.0%} {:3d} {}".format(
+      float(bucket) / len(analysis.profile), running, "#" * running))
+  lines.append("  Peak: {}".format(peak))
+  lines.append("")
+
+  lines.append("Likely bottlenecks (cost, targets waiting):")
+  for name, cost, dependents in analysis.bottlenecks(count):
+    heavy = analysis.costs[name].heavy_includes
+    detail = ", ".join("{}x{}".format(n, x) for x, n in sorted(heavy.items()))
+    lines.append("  {:40} {:8.1f} {:4d}  {}".format(name, cost, dependents, detail))
+  lines.append("")
+
+  lines.append("Most expensive targets:")
+  expensive = sorted(analysis.costs.values(), key=lambda x: (-x.cost, x.target.name))
+  for estimate in expensive[:count]:
+    lines.append("  {:40} {:8.1f}  {} sources, {:.0f} KiB, slack {:.1f}".format(
+      estimate.target.name, estimate.cost, estimate.sources + estimate.generated,
+      estimate.source_bytes / 1024.0, analysis.slack[estimate.target.name]))
+
+  return "\n".join(lines)
@@ -0,0 +1,239 @@
+# coding: utf-8
+
+"""
+Configures the tree and flat CMake outputs side by side, to compare them.
+
+Both outputs are written over a mirror of the distribution sources, with a
+driver CMakeLists.txt that stands in for the functions and packages the
+including project normally provides. After configuring, the properties of
+every target are dumped and compared, and the time taken by CMake to
+re-configure each layout is reported.
+"""
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+import subprocess
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Target properties that are compared between the two layouts
+COMPARED_PROPERTIES = ["SOURCES", "COMPILE_OPTIONS", "COMPILE_DEFINITIONS",
+  "INCLUDE_DIRECTORIES", "LINK_LIBRARIES", "LINK_OPTIONS"]
+INTERFACE_PROPERTIES = ["INTERFACE_INCLUDE_DIRECTORIES", "INTERFACE_LINK_LIBRARIES"]
+# Target properties that also take the values set on the target's directories
+DIRECTORY_PROPERTIES = ["COMPILE_OPTIONS", "COMPILE_DEFINITIONS"]
+
+_DRIVER = """\
+cmake_minimum_required(VERSION 3.14)
+project(tbx2cmake_compare C CXX)
+
+# Stand-ins for the functions and packages the including project provides
+function(add_python_library name)
+  add_library(${{name}} MODULE ${{ARGN}})
+endfunction()
+function(add_generated_sources name)
+  foreach(_source ${{ARGN}})
+    set_source_files_properties(${{CMAKE_BINARY_DIR}}/${{_source}} PROPERTIES GENERATED TRUE)
+    target_sources(${{name}} PRIVATE ${{CMAKE_BINARY_DIR}}/${{_source}})
+  endforeach()
+endfunction()
+function(add_libtbx_refresh_command script)
+  cmake_parse_arguments(_refresh "" "" "OUTPUT;DEPENDS" ${{ARGN}})
+  add_custom_command(OUTPUT ${{_refresh_OUTPUT}} COMMAND ${{CMAKE_COMMAND}} -E echo ${{script}}
+                     DEPENDS ${{script}} ${{_refresh_DEPENDS}})
+endfunction()
+foreach(_target {imported})
+  if(NOT TARGET ${{_target}})
+    add_library(${{_target}} INTERFACE IMPORTED)
+  endif()
+endforeach()
+
+include(autogen_CMakeLists.txt)
+
+# Write out the properties of every target, for comparison
+file(WRITE "${{TBX_DUMP}}" "")
+set(_tbx_directory_properties {directory_properties})
+# The values of a directory property set in a directory and its parents,
+# outermost first. Compile definitions set on the directory apply to the
+# targets in it without being copied onto them.
+function(_tbx_directory_values out directory property)
+  set(_values)
+  while(directory)
+    get_directory_property(_directory_values DIRECTORY "${{directory}}" ${{property}})
+    set(_values ${{_directory_values}} ${{_values}})
+    get_directory_property(directory DIRECTORY "${{directory}}" PARENT_DIRECTORY)
+  endwhile()
+  set(${{out}} "${{_values}}" PARENT_SCOPE)
+endfunction()
+function(_tbx_dump directory)
+  get_property(_targets DIRECTORY "${{directory}}" PROPERTY BUILDSYSTEM_TARGETS)
+  foreach(_target IN LISTS _targets)
+    get_target_property(_type ${{_target}} TYPE)
+    if(_type STREQUAL "INTERFACE_LIBRARY")
+      set(_properties {interface_properties})
+    else()
+      set(_properties {properties})
+    endif()
+    file(APPEND "${{TBX_DUMP}}" "${{_target}} TYPE ${{_type}}\\n")
+    get_target_property(_source_dir ${{_target}} SOURCE_DIR)
+    foreach(_property IN LISTS _properties)
+      get_target_property(_value ${{_target}} ${{_property}})
+      if(_property STREQUAL "SOURCES")
+        set(_absolute)
+        foreach(_source IN LISTS _value)
+          get_filename_component(_source "${{_source}}" ABSOLUTE BASE_DIR "${{_source_dir}}")
+          list(APPEND _absolute "${{_source}}")
+        endforeach()
+        set(_value "${{_absolute}}")
+      elseif(_property IN_LIST _tbx_directory_properties)
+        # Merge in the values set on the directories the target is in
+        _tbx_directory_values(_inherited "${{_source_dir}}" ${{_property}})
+        if(NOT _value)
+          set(_value)
+        endif()
+        set(_value ${{_inherited}} ${{_value}})
+        if(_value)
+          list(REMOVE_DUPLICATES _value)
+        endif()
+      endif()
+      file(APPEND "${{TBX_DUMP}}" "${{_target}} ${{_property}} ${{_value}}\\n")
+    endforeach()
+  endforeach()
+  get_property(_subdirectories DIRECTORY "${{directory}}" PROPERTY SUBDIRECTORIES)
+  foreach(_subdirectory IN LISTS _subdirectories)
+    _tbx_dump("${{_subdirectory}}")
+  endforeach()
+endfunction()
+_tbx_dump("${{CMAKE_SOURCE_DIR}}")
+"""
+
+class LayoutResult(object):
+  "The outcome of configuring one output layout"
+  def __init__(self, name):
+    self.name = name
+    self.files = 0
+    self.times = []
+    self.properties = {}
+
+  @property
+  def best_time(self):
+    return min(self.times) if self.times else None
+
+class Comparison(object):
+  "The results of configuring both layouts"
+  def __init__(self, tree, flat):
+    self.tree = tree
+    self.flat = flat
+
+  @property
+  def differences(self):
+    "A sorted list of (target, property, tree value, flat value)"
+    keys = set(self.tree.properties) | set(self.flat.properties)
+    return sorted(key + (self.tree.properties.get(key), self.flat.properties.get(key))
+      for key in keys if self.tree.properties.get(key) != self.flat.properties.get(key))
+
+def _mirror_sources(tbx, dest):
+  "Symlinks the files the CMake output refers to into a new source tree"
+  paths = set()
+  for target in tbx.targets:
+    paths |= {os.path.normpath(os.path.join(target.origin_path, x)) for x in target.sources}
+  for module in tbx.modules.values():
+    if module.generated_sources:
+      paths.add(os.path.join(module.path, "libtbx_refresh.py"))
+      paths |= set(module.refresh_inputs)
+  for path in sorted(paths):
+    source = os.path.abspath(os.path.join(tbx.module_path, path))
+    if not os.path.isfile(source):
+      continue
+    link = os.path.join(dest, path)
+    if not os.path.isdir(os.path.dirname(link)):
+      os.makedirs(os.path.dirname(link))
+    os.symlink(source, link)
+
+def _read_dump(filename, source_dir, build_dir):
+  "Reads a property dump, making paths independent of the directories used"
+  properties = {}
+  with open(filename) as f:
+    for line in f:
+      line = line.rstrip("\n").replace(build_dir, "<BUILD>").replace(source_dir, "<SOURCE>")
+      target, name, value = (line.split(" ", 2) + [""])[:3]
+      properties[(target, name)] = value
+  return properties
+
+def _configure_layout(root, tbx, workdir, flat, imported, cmake, repeat):
+  "Writes, configures and times one layout"
+  result = LayoutResult("flat" if flat else "tree")
+  source_dir = os.path.join(workdir, result.name, "source")
+  build_dir = os.path.join(workdir, result.name, "build")
+  os.makedirs(build_dir)
+  _mirror_sources(tbx, source_dir)
+
+  original = root._options
+  root._options = copy.copy(original)
+  root._options.flat = flat
+  try:
+    result.files = root.write(source_dir)
+  finally:
+    root._options = original
+  with open(os.path.join(source_dir, "CMakeLists.txt"), "w") as f:
+    f.write(_DRIVER.format(imported=" ".join(imported),
+      properties=" ".join(COMPARED_PROPERTIES),
+      directory_properties=" ".join(DIRECTORY_PROPERTIES),
+      interface_properties=" ".join(INTERFACE_PROPERTIES)))
+
+  # The first configure detects the toolchain, so only time the re-runs
+  dump = os.path.join(build_dir, "tbx_properties.txt")
+  command = [cmake, "-S", source_dir, "-B", build_dir, "-DTBX_DUMP=" + dump]
+  for run in range(repeat + 1):
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+      universal_newlines=True)
+    output, _ = process.communicate()
+    if process.returncode:
+      raise RuntimeError("Configuring the {} layout failed:\n{}".format(result.name, output))
+    if run:
+      result.times.append(time.time() - start)
+  result.properties = _read_dump(dump, os.path.realpath(source_dir), os.path.realpath(build_dir))
+  return result
+
+def compare_layouts(root, tbx, imported, cmake="cmake", repeat=3):
+  """Configures the tree and flat layouts of a CMakeLists tree.
+
+  :param root:     The root CMakeLists to write
+  :param tbx:      The TBXDistribution the tree was built from
+  :param imported: Names of external targets to stand in for
+  :param cmake:    The cmake executable to run
+  :param repeat:   How many times to time the re-configure of each layout
+  :returns: A Comparison object
+  """
+  workdir = tempfile.mkdtemp(prefix="tbx2cmake_compare_")
+  try:
+    tree = _configure_layout(root, tbx, workdir, False, imported, cmake, repeat)
+    flat = _configure_layout(root, tbx, workdir, True, imported, cmake, repeat)
+  finally:
+    shutil.rmtree(workdir)
+  return Comparison(tree, flat)
+
+def format_comparison(comparison):
+  "Formats a Comparison as a human-readable report"
+  lines = []
+  for result in (comparison.tree, comparison.flat):
+    lines.append("{:5} layout: {:4d} files, configure {:.3f}s (best of {})".format(
+      result.name, result.files, result.best_time, len(result.times)))
+  if comparison.tree.best_time and comparison.flat.best_time:
+    lines.append("Flat configure takes {:.0%} of the tree time".format(
+      comparison.flat.best_time / comparison.tree.best_time))
+  differences = comparison.differences
+  if not differences:
+    lines.append("Target properties are identical in both layouts")
+  else:
+    lines.append("{} target properties differ:".format(len(differences)))
+    for target, name, tree_value, flat_value in differences:
+      lines.append("  {} {}".format(target, name))
+      lines.append("    tree: {}".format(tree_value))
+      lines.append("    flat: {}".format(flat_value))
+  return "\n".join(lines)
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+"""
+Compatibility between python 2 and 3, both for the converter itself and for
+the python 2 SConscripts that it runs.
+"""
+
+import io
+import sys
+import re
+import tokenize
+import warnings
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+  basestring = basestring
+except NameError:
+  basestring = str
+
+try:
+  import __builtin__ as builtins
+except ImportError:
+  import builtins
+
+try:
+  from collections.abc import Set
+except ImportError:
+  from collections import Set
+
+try:
+  from unittest.mock import Mock
+except ImportError:
+  from mock import Mock
+
+PY2 = sys.version_info[0] == 2
+
+# Python 2 builtins used by SConscripts, provided when running under python 3
+PYTHON2_BUILTINS = {
+  "basestring": str,
+  "unicode": str,
+  "long": int,
+  "xrange": range,
+}
+
+# The 2to3 fixers for the python 2 constructs that SConscripts use
+PYTHON2_FIXERS = ["apply", "dict", "except", "exec", "filter", "has_key", "map",
+  "ne", "numliterals", "print", "raise", "repr", "tuple_params", "zip"]
+
+# Python 2 dictionary methods, which compile but fail when run on python 3
+_DICT_METHODS_RE = re.compile(r"\.(iteritems|iterkeys|itervalues|has_key)\s*\(")
+# Calls that compile on python 3 but return views or iterators instead of
+# lists, which the fixers wrap in list()
+_PYTHON2_SEMANTICS_RE = re.compile(r"\.(keys|values|items|iteritems|iterkeys|itervalues|has_key)\s*\("
+                                   r"|\b(map|filter|zip)\s*\(")
+
+def _refactoring_tool():
+  "A 2to3 RefactoringTool with the PYTHON2_FIXERS, or None if unavailable"
+  # lib2to3 is deprecated, and was removed in python 3.13; fissix is the
+  # maintained fork of it
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    try:
+      from lib2to3.refactor import RefactoringTool
+      fixers = "lib2to3.fixes.fix_"
+    except ImportError:
+      try:
+        from fissix.refactor import RefactoringTool
+        fixers = "fissix.fixes.fix_"
+      except ImportError:
+        return None
+  return RefactoringTool([fixers + x for x in PYTHON2_FIXERS])
+
+def _warn_division(source, filename):
+  "Warns about uses of /, which is true division on python 3"
+  try:
+    tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+  except (tokenize.TokenError, SyntaxError):
+    return
+  lines = sorted(set(x[2][0] for x in tokens if x[0] == tokenize.OP and x[1] in ("/", "/=")))
+  if lines:
+    logger.warning("{} divides with / on lines {}, which is true division on python 3".format(
+      filename, ", ".join(str(x) for x in lines)))
+
+def python3_source(text, filename):
+  """Converts python 2 source to run on the current interpreter.
+
+  Source that compiles, and has no calls that behave differently on python
+  3, is returned unchanged, as is everything when running on python 2.
+  Division is left as it is, with a warning.
+  """
+  if PY2:
+    return text
+  try:
+    compile(text, filename, "exec")
+  except SyntaxError as e:
+    error = e
+  else:
+    error = None
+  if not error and not _PYTHON2_SEMANTICS_RE.search(text):
+    _warn_division(text, filename)
+    return text
+
+  tool = _refactoring_tool()
+  if tool is None:
+    if not error and not _DICT_METHODS_RE.search(text):
+      logger.warning("Running {} unconverted, without lib2to3 or fissix; map, filter, zip and "
+                     "dictionary views keep their python 3 behaviour".format(filename))
+      _warn_division(text, filename)
+      return text
+    raise ImportError("{} needs converting from python 2, which needs lib2to3 or fissix ({})".format(
+      filename, error or "python 2 dictionary methods"))
+  if not text.endswith("\n"):
+    text += "\n"
+  source = str(tool.refactor_string(text, filename))
+  _warn_division(source, filename)
+  return source
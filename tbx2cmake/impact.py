@@ -0,0 +1,253 @@
+# coding: utf-8
+
+"""
+Works out which targets and modules a set of changed files can affect, so
+that only those need to be rebuilt and tested.
+
+Changed paths can be given as arguments, or one per line on stdin, e.g.
+  git diff --name-only HEAD~ | tbx2impact <module_dir> <autogen.yaml>
+
+Usage: tbx2impact [options] <module_dir> <autogen.yaml> [<path>...]
+
+Options:
+  --base=<dir>        The directory the changed paths are relative to. By
+                      default, the module directory
+  --only=<modules>    Only read a comma-separated list of modules, and the
+                      modules that they require
+  --targets           Only list the affected targets
+  --modules           Only list the affected modules
+  --json              Write the affected targets, with the reason for each,
+                      and modules as JSON
+  --scan-includes     Scan the #include directives of target sources, so
+                      that a changed header only affects the targets that
+                      include it, instead of every target in its module and
+                      the modules that depend on it
+  --include-cache=<file>
+                      Keep the scanned #include directives in a file, to
+                      only rescan changed files on the next run
+  --output=<file>     Write to a file instead of stdout
+"""
+
+import sys
+import os
+import json
+import logging
+
+import networkx as nx
+from docopt import docopt
+
+from .read_scons import read_distribution, unknown_modules, find_libtbx_modules
+from .read_scons import _build_dependency_graph
+from .pipeline import Pipeline
+from .analyze import build_link_graph
+from .write_cmake import read_autogen_information
+from .include_scan import IncludeCache, scan_includes, header_dependents
+from .utils import stdout_to_stderr
+
+logger = logging.getLogger(__name__)
+
+# Files that may be included by compiled sources, so affect a whole module
+# and everything that depends on it if they aren't known target sources
+INCLUDED_EXTENSIONS = {".h", ".hh", ".hpp", ".hxx", ".ipp", ".inl", ".tcc",
+  ".c", ".cc", ".cpp", ".cxx"}
+
+class ChangeImpact(object):
+  "The targets and modules that a set of changed files can affect"
+  def __init__(self):
+    # Affected target names, with the reason each is affected
+    self.targets = {}
+    # Affected module names
+    self.modules = set()
+    # Changed paths that aren't part of any module
+    self.unmatched = []
+
+  def add_target(self, name, reason):
+    if not name in self.targets:
+      self.targets[name] = reason
+
+class ImpactIndex(object):
+  """Reverse index from the files in a distribution to the targets and
+  modules built from them.
+
+  :param tbx:      The TBXDistribution, with autogen information applied
+  :param includes: The scanned includes of every target, from scan_includes,
+                   if headers should be matched to the targets including them
+  """
+  def __init__(self, tbx, includes=None):
+    self.tbx = tbx
+    # Header path to the names of the targets including it, if scanned
+    self.headers = None
+    # Source path, relative to the module root, to target names
+    self.sources = {}
+    # Generated source path, relative to the build, to target names
+    self.generated = {}
+    # Refresh script or input path to the names of the modules refreshed
+    self.refresh_inputs = {}
+    # Target names by the directory of the SConscript they were made in
+    self.origins = {}
+    for target in tbx.targets:
+      for source in target.sources:
+        path = os.path.normpath(os.path.join(target.origin_path, source))
+        self.sources.setdefault(path, set()).add(target.name)
+      for source in target.generated_sources:
+        self.generated.setdefault(source, set()).add(target.name)
+      self.origins.setdefault(target.origin_path, set()).add(target.name)
+    if includes is not None:
+      self.headers = {}
+      for header, names in header_dependents(includes).items():
+        if header.startswith("#build/"):
+          # Generated headers change when their module is refreshed
+          for name in names:
+            self.generated.setdefault(header[len("#build/"):], set()).add(name)
+        else:
+          self.headers[header] = names
+    for module in tbx.modules.values():
+      if module.has_refresh:
+        inputs = [os.path.join(module.path, "libtbx_refresh.py")] + list(module.refresh_inputs)
+        for path in inputs:
+          self.refresh_inputs.setdefault(os.path.normpath(path), set()).add(module.name)
+
+    # Every module, including those without targets, for the dependency graph
+    modules = find_libtbx_modules(tbx.module_path)
+    if tbx.selected_modules is not None:
+      modules = [x for x in modules if x.name in tbx.selected_modules]
+    self.module_paths = {x.name: x.path for x in modules}
+    self.module_graph = _build_dependency_graph(modules)
+    self.link_graph = build_link_graph(tbx)
+
+  def module_for(self, path):
+    "Finds the name of the module a path is in, or None"
+    found = None
+    for name, module_path in self.module_paths.items():
+      if path == module_path or path.startswith(module_path + os.sep):
+        if found is None or len(module_path) > len(self.module_paths[found]):
+          found = name
+    return found
+
+  def _module_targets(self, name):
+    if not name in self.tbx.modules:
+      return []
+    return sorted(x.name for x in self.tbx.modules[name].targets)
+
+  def affected(self, paths):
+    """Works out what a set of changed files can affect.
+
+    :param paths: Changed paths, relative to the module root
+    :returns: A ChangeImpact
+    """
+    impact = ChangeImpact()
+    included_modules = set()
+    for path in sorted(set(os.path.normpath(x) for x in paths)):
+      module = self.module_for(path)
+      known = path in self.sources or path in self.refresh_inputs or path in (self.headers or {})
+      if module is None and not known:
+        impact.unmatched.append(path)
+        continue
+      if module:
+        impact.modules.add(module)
+
+      for name in sorted(self.sources.get(path, [])):
+        impact.add_target(name, "source {} changed".format(path))
+      for name in sorted((self.headers or {}).get(path, [])):
+        impact.add_target(name, "includes {}".format(path))
+      for refreshed in sorted(self.refresh_inputs.get(path, [])):
+        for source in sorted(self.tbx.modules[refreshed].generated_sources):
+          for name in sorted(self.generated.get(source, [])):
+            impact.add_target(name, "generated source {} depends on {}".format(source, path))
+
+      filename = os.path.basename(path)
+      if filename == "SConscript":
+        directory = os.path.dirname(path)
+        for origin in sorted(self.origins):
+          if origin == directory or origin.startswith(directory + os.sep):
+            for name in sorted(self.origins[origin]):
+              impact.add_target(name, "SConscript {} changed".format(path))
+      elif filename == "libtbx_config" and module:
+        included_modules.add(module)
+      elif os.path.splitext(path)[1] in INCLUDED_EXTENSIONS and not path in self.sources and module:
+        # Scanned headers that nothing includes can't affect any target
+        if self.headers is None:
+          included_modules.add(module)
+
+    # Modules can include the headers of, and import, the modules they require
+    for module in sorted(impact.modules):
+      impact.modules |= nx.ancestors(self.module_graph, module)
+    for module in sorted(included_modules):
+      for dependent in sorted({module} | nx.ancestors(self.module_graph, module)):
+        for name in self._module_targets(dependent):
+          impact.add_target(name, "may include a changed file in {}".format(module))
+
+    # Targets have to be relinked if anything they link against changes
+    for name in sorted(impact.targets):
+      for dependent in sorted(nx.ancestors(self.link_graph, name)):
+        impact.add_target(dependent, "links against {}".format(name))
+
+    targets = {x.name: x for x in self.tbx.targets}
+    impact.modules |= {targets[x].module.name for x in impact.targets}
+    return impact
+
+def format_impact(impact, targets=True, modules=True):
+  "Formats a ChangeImpact as a human-readable report"
+  lines = []
+  if targets:
+    lines.append("{} affected targets:".format(len(impact.targets)))
+    for name in sorted(impact.targets):
+      lines.append("  {}: {}".format(name, impact.targets[name]))
+  if modules:
+    lines.append("{} affected modules:".format(len(impact.modules)))
+    lines.extend("  " + x for x in sorted(impact.modules))
+  if impact.unmatched:
+    lines.append("{} changed paths outside any module:".format(len(impact.unmatched)))
+    lines.extend("  " + x for x in impact.unmatched)
+  return "\n".join(lines)
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  options = docopt(__doc__)
+  module_dir = options["<module_dir>"]
+  base = options["--base"] or module_dir
+
+  if not os.path.isdir(module_dir):
+    print("Error: Module path {} must be a directory".format(module_dir))
+    sys.exit(1)
+  only = [x for x in (options["--only"] or "").split(",") if x]
+  if unknown_modules(module_dir, only):
+    print("Error: Unknown modules {}".format(", ".join(unknown_modules(module_dir, only))))
+    sys.exit(1)
+
+  paths = options["<path>"] or [x.strip() for x in sys.stdin if x.strip()]
+  paths = [os.path.relpath(os.path.join(os.path.abspath(base), x), os.path.abspath(module_dir))
+           for x in paths]
+
+  logger.info("Reading TBX distribution")
+  # The emulator prints as it goes; keep stdout for the result
+  with stdout_to_stderr():
+    tbx = read_distribution(module_dir, only=only, pipeline=Pipeline.from_autogen(options["<autogen.yaml>"]))
+  read_autogen_information(options["<autogen.yaml>"], tbx)
+  includes = None
+  if options["--scan-includes"]:
+    includes = scan_includes(tbx, IncludeCache(options["--include-cache"]))
+  impact = ImpactIndex(tbx, includes).affected(paths)
+
+  if options["--json"]:
+    output = json.dumps({
+      "targets": impact.targets,
+      "modules": sorted(impact.modules),
+      "unmatched": impact.unmatched,
+    }, indent=2, sort_keys=True)
+  elif options["--targets"]:
+    output = "\n".join(sorted(impact.targets))
+  elif options["--modules"]:
+    output = "\n".join(sorted(impact.modules))
+  else:
+    output = format_impact(impact)
+
+  if options["--output"]:
+    with open(options["--output"], "w") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -8,7 +8,7 @@ import os
 import sys
 import re
 from types import ModuleType
-from mock import Mock
+from .compat import Mock
 import contextlib
 
 from .utils import AttrDict
@@ -58,12 +58,36 @@ class libtbxBuildOptions(object):
   mode = "invalid" # AFAICT this is only tested as mode == "profile" (linux only)
   static_libraries = False
 
+# Build option overrides for each of the build profiles that can be emulated.
+# Debug builds turn on the extra warnings, as libtbx --warning_level=1 does
+BUILD_PROFILES = {
+  "release": {
+    "optimization": True,
+    "debug_symbols": False,
+    "boost_python_no_py_signatures": True,
+    "warning_level": 0,
+  },
+  "debug": {
+    "optimization": False,
+    "debug_symbols": True,
+    "warning_level": 1,
+  },
+  "profile": {
+    "optimization": True,
+    "debug_symbols": True,
+    "mode": "profile",
+    "warning_level": 0,
+  },
+}
+
 class libtbxEnv(object):
   boost_version = 106500
 
-  def __init__(self, dist_path):
+  def __init__(self, dist_path, isdir=None):
     self.build_options = libtbxBuildOptions()
     self._dist_path = dist_path
+    # The directory check the SConscripts see
+    self._isdir = isdir or os.path.isdir
 
   def under_build(self, path):
     return os.path.join("UNDERBUILD", path)#UnderBuild(path)
@@ -76,7 +100,7 @@ class libtbxEnv(object):
 
     for repo in [".", "cctbx_project"]:
       path = os.path.normpath(os.path.join(self._dist_path, repo, module))
-      if os.path.isdir(path):
+      if self._isdir(path):
         print("  found exact {}".format(path))
         return path
     assert False
@@ -122,15 +146,16 @@ class libtbxIncludeRegistry(list):
       env.Prepend(CPPPATH=[path])
 
 
-def new_module(name, doc=None):
-  """Create a new module and inject it into sys.modules.
+def new_module(name, modules, doc=None):
+  """Create a new module and add it to a dictionary of modules.
 
-  :param name: Fully qualified name (including parent .)
-  :returns:  A module, injected into sys.modules
+  :param name:    Fully qualified name (including parent .)
+  :param modules: The dictionary of module name to module to add it to
+  :returns:  A module, also in the modules dictionary
   """
   m = ModuleType(name, doc)
   m.__file__ = name + '.py'
-  sys.modules[name] = m
+  modules[name] = m
   return m
 
 # Common functions
@@ -179,9 +204,6 @@ def _tbx_easyrun_fully_buffered(command, **kwargs):
     return EasyRunResult(["Cuda compilation tools, release 8.0, V8.0.61"])
   assert False, "No command known; {}".format(command)
 
-# Only allow this to be done once, until we may add e.g. context-patching
-_patching_done = False
-
 def _get_gcc_version_50400(*args, **kwargs):
   return 50400
 
@@ -193,19 +215,39 @@ def _getenv_bool(variable_name, default=False):
   assert variable_name in results, "Unknown getenv_bool {}".format(variable_name)
   return results[variable_name]
 
-def do_import_patching(dist_path):
-  # Only do this once
-  global _patching_done
-  if _patching_done:
-    return
+def make_build_options(overrides=None):
+  """Makes the build options seen by the SConscripts.
+
+  :param overrides: A dictionary of libtbxBuildOptions values to change from
+                    the defaults, or None to use the defaults.
+  """
+  options = libtbxBuildOptions()
+  for name, value in (overrides or {}).items():
+    assert hasattr(options, name), "Unknown build option {}".format(name)
+    setattr(options, name, value)
+  return options
+
+def make_stub_modules(dist_path, build_options=None, isdir=None):
+  """Creates the libtbx and SCons modules imported by the SConscripts.
+
+  Every emulator has its own set, so that separate distributions can be
+  read in the same process; they are never put into sys.modules.
+
+  :param dist_path:     The root of the distribution being read
+  :param build_options: A dictionary of libtbxBuildOptions to override
+  :param isdir:         The directory check used by the SConscripts, if
+                        not os.path.isdir
+  :returns: A dictionary of fully-qualified module name to module
+  """
+  modules = {}
 
   # Create the libtbx environment
-  libtbx = new_module("libtbx")
-  libtbx.load_env = new_module("libtbx.load_env")
-  libtbx.env_config = new_module("libtbx.env_config")
-  libtbx.utils = new_module("libtbx.utils")
-  libtbx.str_utils = new_module("libtbx.str_utils")
-  libtbx.path = new_module("libtbx.path")
+  libtbx = new_module("libtbx", modules)
+  libtbx.load_env = new_module("libtbx.load_env", modules)
+  libtbx.env_config = new_module("libtbx.env_config", modules)
+  libtbx.utils = new_module("libtbx.utils", modules)
+  libtbx.str_utils = new_module("libtbx.str_utils", modules)
+  libtbx.path = new_module("libtbx.path", modules)
 
   libtbx.manual_date_stamp = 20090819 # I don't even
   libtbx.utils.getenv_bool = _getenv_bool
@@ -226,23 +268,26 @@ def do_import_patching(dist_path):
   libtbx.utils.warn_if_unexpected_md5_hexdigest = Mock()
   libtbx.utils.write_this_is_auto_generated =  Mock()
 
-  libtbx.env = libtbxEnv(dist_path)
-  libtbx.easy_run = new_module("libtbx.easy_run")
+  libtbx.env = libtbxEnv(dist_path, isdir=isdir)
+  libtbx.env.build_options = make_build_options(build_options)
+  libtbx.easy_run = new_module("libtbx.easy_run", modules)
   libtbx.easy_run.fully_buffered = _tbx_easyrun_fully_buffered
 
   # data module used during it's sconscript
-  fftw3tbx = new_module("fftw3tbx")
+  fftw3tbx = new_module("fftw3tbx", modules)
   fftw3tbx.fftw3_h = "fftw3.h"
 
   # Occasionally we access some SCons API to do... something
-  SCons = new_module("SCons")
-  SCons.Action = new_module("SCons.Action")
-  SCons.Scanner = new_module("SCons.Scanner")
-  SCons.Scanner.C = new_module("SCons.Scanner.C")
+  SCons = new_module("SCons", modules)
+  SCons.Action = new_module("SCons.Action", modules)
+  SCons.Scanner = new_module("SCons.Scanner", modules)
+  SCons.Scanner.C = new_module("SCons.Scanner.C", modules)
 
   SCons.Action.FunctionAction = Mock()
   SCons.Scanner.C.CScanner = Mock()
 
+  return modules
+
 # def monkeypatched(object, name, patch):
 #   """ Temporarily monkeypatches an object. """
 #   pre_patched_value = getattr(object, name)
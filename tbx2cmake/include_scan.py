@@ -0,0 +1,417 @@
+# coding: utf-8
+
+"""
+Scans the #include directives of the sources of every target, to find the
+headers that each target depends on and the include directories it needs.
+
+Files are scanned in parallel processes. The directives found in each file
+can be kept in a cache file between runs, reused while the modification
+time and size of the file are unchanged, or its content hash is the same.
+
+Paths are relative to the module root. Headers generated into the build
+directory are written as "#build/<path>", as in target include paths.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import multiprocessing
+from collections import Counter
+
+from .analyze import _heavy_header
+
+logger = logging.getLogger(__name__)
+
+_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.M)
+
+# Extensions of the files that are indexed to find unresolved includes
+HEADER_EXTENSIONS = {".h", ".hh", ".hpp", ".hxx", ".ipp", ".inl", ".tcc"}
+
+# The repository directories searched for modules, as libtbxEnv.dist_path
+REPOSITORY_DIRS = [".", "cctbx_project"]
+
+# Below this many files to scan, it isn't worth starting worker processes
+PARALLEL_THRESHOLD = 32
+
+# Expensive headers are precompiled for a target when at least this many,
+# and this fraction of, its sources include them directly
+PCH_MIN_SOURCES = 2
+PCH_MIN_FRACTION = 0.5
+
+class IncludeCache(object):
+  """The #include directives of previously scanned files, by absolute path.
+
+  :param filename: A file to load the cache from and save it to, if any
+  """
+  VERSION = 1
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.entries = {}
+    self.changed = False
+    if filename and os.path.isfile(filename):
+      try:
+        with open(filename) as f:
+          data = json.load(f)
+      except ValueError:
+        logger.warning("Ignoring unreadable include cache {}".format(filename))
+      else:
+        if data.get("version") == self.VERSION:
+          self.entries = data["files"]
+
+  def update(self, path, mtime, size, digest, includes):
+    self.entries[path] = {"mtime": mtime, "size": size, "hash": digest, "includes": includes}
+    self.changed = True
+
+  def save(self):
+    "Writes the cache back to its file, if anything has changed"
+    if not self.filename or not self.changed:
+      return
+    with open(self.filename, "w") as f:
+      json.dump({"version": self.VERSION, "files": self.entries}, f, sort_keys=True)
+    self.changed = False
+
+def _scan_file(job):
+  """Reads the #include directives of one file. Run in the worker processes.
+
+  :param job: The path, and the hash and includes of the file when it was
+              last scanned, if it was
+  :returns: The path, the hash of the contents, and a list of [kind, name]
+            for each directive, where kind is '"' or '<'
+  """
+  path, known_hash, known_includes = job
+  with open(path, "rb") as f:
+    data = f.read()
+  digest = hashlib.sha1(data).hexdigest()
+  if digest == known_hash:
+    return path, digest, known_includes
+  text = data.decode("latin-1")
+  return path, digest, [[x.group(1), x.group(2).strip()] for x in _INCLUDE_RE.finditer(text)]
+
+class IncludeScanner(object):
+  """Reads the #include directives of files, in parallel and through a cache.
+
+  :param cache: An IncludeCache to use, if any
+  :param jobs:  The number of processes to scan with. By default, one per CPU
+  """
+  def __init__(self, cache=None, jobs=None):
+    self.cache = cache or IncludeCache()
+    self.jobs = jobs
+    # How many files were read, and how many were reused from the cache
+    self.scanned = 0
+    self.cached = 0
+    self._includes = {}
+
+  def includes(self, paths):
+    """Finds the #include directives of a set of files.
+
+    :param paths: Absolute paths of the files
+    :returns: A dictionary of path to a list of [kind, name] directives.
+              Files that can't be read have no directives
+    """
+    pending = []
+    for path in sorted(set(paths) - set(self._includes)):
+      try:
+        stat = os.stat(path)
+      except OSError:
+        self._includes[path] = []
+        continue
+      entry = self.cache.entries.get(path)
+      if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        self._includes[path] = entry["includes"]
+        self.cached += 1
+        continue
+      pending.append((path, stat))
+
+    jobs = []
+    for path, _ in pending:
+      entry = self.cache.entries.get(path) or {}
+      jobs.append((path, entry.get("hash"), entry.get("includes")))
+    if len(jobs) < PARALLEL_THRESHOLD or self.jobs == 1:
+      results = [_scan_file(x) for x in jobs]
+    else:
+      pool = multiprocessing.Pool(self.jobs)
+      try:
+        results = pool.map(_scan_file, jobs, chunksize=16)
+      finally:
+        pool.close()
+        pool.join()
+    for (path, stat), (_, digest, found) in zip(pending, results):
+      self.cache.update(path, stat.st_mtime, stat.st_size, digest, found)
+      self._includes[path] = found
+    self.scanned += len(pending)
+    return {x: self._includes[x] for x in paths}
+
+def resolve_search_path(tbx, target, path):
+  """Resolves a CPPPATH entry of a target to a directory.
+
+  :returns: The directory relative to the module root, a "#build" path, an
+            absolute path outside the distribution, or None for entries that
+            can't be resolved (e.g. the python and base directories)
+  """
+  root = os.path.abspath(tbx.module_path)
+  if path.startswith("UNDERBUILD"):
+    return os.path.normpath("#build" + path[len("UNDERBUILD"):])
+  if path.startswith("#"):
+    return os.path.normpath(os.path.join("#build", path[1:].lstrip("/")))
+  match = re.match(r"DISTPATH\[(\w+)\](.*)$", path)
+  if match:
+    if not match.group(1) in tbx.modules:
+      return None
+    return os.path.normpath(tbx.modules[match.group(1)].path + match.group(2))
+  if path == "DISTPATH" or path.startswith("DISTPATH/"):
+    return os.path.normpath(path[len("DISTPATH"):].lstrip("/") or ".")
+  if path.startswith("REPOSITORIES/"):
+    for repository in REPOSITORY_DIRS:
+      found = os.path.normpath(os.path.join(repository, path[len("REPOSITORIES/"):]))
+      if os.path.isdir(os.path.join(root, found)):
+        return found
+    return None
+  if path.split("/")[0] in {"BASEDIR", "REPOSITORIES"} or path.startswith("PYTHON"):
+    return None
+  if os.path.isabs(path):
+    path = os.path.normpath(path)
+    if path == root or path.startswith(root + os.sep):
+      return os.path.relpath(path, root)
+    return path if os.path.isdir(path) else None
+  return os.path.normpath(os.path.join(target.origin_path, path))
+
+def _include_path_directory(target, path):
+  "Resolves a target include path, as in the autogen information, to a directory"
+  path = path.lstrip("!")
+  if path.startswith("#base"):
+    return os.path.normpath(path[len("#base"):].lstrip("/") or ".")
+  if path.startswith("#build"):
+    return os.path.normpath(path)
+  return os.path.normpath(os.path.join(target.origin_path, path))
+
+def _include_path(directory):
+  """The target include path for a directory found by the scanner. These are
+  private, as the scanner only knows what the target's own sources need"""
+  if directory.startswith("#build"):
+    return "!" + directory
+  return "!#base/" + directory
+
+class TargetIncludes(object):
+  "The headers that the sources of a target include"
+  def __init__(self, target):
+    self.target = target
+    # Headers found in the distribution, and generated into the build
+    self.headers = set()
+    # The directories that headers were found through
+    self.include_dirs = set()
+    # Of those, the directories the target needs added to its include paths
+    self.missing_dirs = set()
+    # Included names that aren't in the distribution, e.g. system headers
+    self.external = set()
+    # The [kind, name] directives of each source
+    self.direct = {}
+
+class _Resolver(object):
+  """Finds included headers in the distribution, for every target"""
+  def __init__(self, tbx):
+    self.tbx = tbx
+    self.root = os.path.abspath(tbx.module_path)
+    self.generated = {os.path.normpath(os.path.join("#build", x)) for x in tbx.all_generated}
+    # The directories containing every module, as libtbx adds
+    self.module_parents = sorted({os.path.dirname(x.path) or "." for x in tbx.modules.values()})
+    self._exists = {}
+    self._index = None
+
+  def exists(self, path):
+    "Whether a resolved header exists, or will be generated"
+    if path.startswith("#build"):
+      return path in self.generated
+    if not path in self._exists:
+      self._exists[path] = os.path.isfile(path if os.path.isabs(path) else os.path.join(self.root, path))
+    return self._exists[path]
+
+  def explicit_dirs(self, target):
+    "The directories already in the include paths of a target, or its module"
+    paths = sorted(target.include_paths)
+    if target.module:
+      paths += sorted(target.module.include_paths)
+    return [_include_path_directory(target, x) for x in paths]
+
+  def search_dirs(self, target):
+    "The directories searched for the headers of a target, in order"
+    dirs = self.explicit_dirs(target)
+    dirs += [resolve_search_path(self.tbx, target, x) for x in target.search_paths]
+    dirs += self.module_parents + ["#build", os.path.join("#build", "include")]
+    unique = []
+    for path in dirs:
+      if path is not None and not path in unique:
+        unique.append(path)
+    return unique
+
+  def required_modules(self, target):
+    "The names of the module of a target, and every module it requires"
+    names = set()
+    pending = [target.module.name] if target.module else []
+    while pending:
+      name = pending.pop()
+      if name in names or not name in self.tbx.modules:
+        continue
+      names.add(name)
+      pending.extend(self.tbx.modules[name].required)
+    return names
+
+  def _indexed(self, name, modules):
+    """Finds the directories in the given modules that an include name is
+    under, from an index of every header in the modules"""
+    if self._index is None:
+      self._index = {}
+      for module in self.tbx.modules.values():
+        index = self._index[module.name] = {}
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, module.path)):
+          dirnames[:] = sorted(x for x in dirnames if not x.startswith("."))
+          for filename in filenames:
+            if os.path.splitext(filename)[1] in HEADER_EXTENSIONS:
+              path = os.path.relpath(os.path.join(dirpath, filename), self.root)
+              index.setdefault(filename, set()).add(path)
+    name = os.path.normpath(name)
+    found = set()
+    for module in modules:
+      found |= {x[:-len(name)].rstrip("/") or "." for x in self._index.get(module, {}).get(os.path.basename(name), [])
+                if x == name or x.endswith("/" + name)}
+    return sorted(found)
+
+  def resolve(self, name, kind, including_dir, dirs, modules=()):
+    """Finds an included header.
+
+    :param modules: The names of the modules to look for headers missing
+                    from the search path in
+    :returns: The header path and the search directory it was found
+              through, which is None for quoted includes found next to the
+              including file. Both are None if the header isn't found
+    """
+    if kind == '"' and including_dir is not None:
+      path = os.path.normpath(os.path.join(including_dir, name))
+      if self.exists(path):
+        return path, None
+    for directory in dirs:
+      path = os.path.normpath(os.path.join(directory, name))
+      if self.exists(path):
+        return path, directory
+    # Not in the search path; the directory may be missing from CPPPATH.
+    # Only guess for names that are unlikely to be system headers
+    if kind != '"' and not "/" in name:
+      return None, None
+    found = self._indexed(name, modules)
+    if len(found) == 1:
+      return os.path.normpath(os.path.join(found[0], name)), found[0]
+    if len(found) > 1:
+      logger.debug("Ambiguous include {}: could be under {}".format(name, ", ".join(found)))
+    return None, None
+
+  def absolute(self, path):
+    return path if os.path.isabs(path) else os.path.join(self.root, path)
+
+def scan_includes(tbx, cache=None, jobs=None):
+  """Finds the headers that the sources of every target include.
+
+  Included headers in the distribution are followed, and the directories
+  that they were found through recorded for each target.
+
+  :param tbx:   The TBXDistribution, with autogen information applied
+  :param cache: An IncludeCache of previously scanned files, if any
+  :param jobs:  The number of processes to scan with
+  :returns: A dictionary of target name to TargetIncludes
+  """
+  resolver = _Resolver(tbx)
+  scanner = IncludeScanner(cache, jobs)
+  results = {}
+  search_dirs = {}
+  known_dirs = {}
+  required = {}
+  # Files left to follow for each target, scanned together so that every
+  # round of reading can go to the worker processes at once
+  frontier = {}
+  for target in tbx.targets:
+    results[target.name] = TargetIncludes(target)
+    search_dirs[target.name] = resolver.search_dirs(target)
+    known_dirs[target.name] = set(resolver.module_parents) | set(resolver.explicit_dirs(target))
+    required[target.name] = resolver.required_modules(target)
+    frontier[target.name] = [os.path.normpath(os.path.join(target.origin_path, x)) for x in target.sources]
+
+  first = True
+  while any(frontier.values()):
+    paths = set(resolver.absolute(x) for x in sum(frontier.values(), []) if not x.startswith("#build"))
+    found = scanner.includes(paths)
+    following = {}
+    for name in sorted(frontier):
+      result = results[name]
+      dirs = search_dirs[name]
+      following[name] = []
+      for path in frontier[name]:
+        if path.startswith("#build"):
+          continue
+        directives = found[resolver.absolute(path)]
+        if first:
+          result.direct[path] = directives
+        for kind, include in directives:
+          header, directory = resolver.resolve(include, kind, os.path.dirname(path), dirs, required[name])
+          if header is None:
+            result.external.add(include)
+            continue
+          if directory is not None:
+            result.include_dirs.add(directory)
+            if not directory in known_dirs[name] and not os.path.isabs(directory):
+              result.missing_dirs.add(directory)
+          if not header in result.headers:
+            result.headers.add(header)
+            following[name].append(header)
+    frontier = following
+    first = False
+
+  logger.info("Scanned includes of {} files ({} unchanged since the last scan)".format(
+    scanner.scanned + scanner.cached, scanner.cached))
+  scanner.cache.save()
+  return results
+
+def add_include_paths(includes):
+  """Adds the include directories that each target was found to need, but
+  that aren't in its include paths, to the target.
+
+  :param includes: A dictionary of target name to TargetIncludes
+  :returns: The number of include paths added
+  """
+  added = 0
+  for name in sorted(includes):
+    result = includes[name]
+    for directory in sorted(result.missing_dirs):
+      logger.debug("Adding include path {} to {}".format(_include_path(directory), name))
+      result.target.include_paths.add(_include_path(directory))
+      added += 1
+  return added
+
+def select_precompiled_headers(result):
+  """Picks the headers to precompile for a target: the expensive external
+  headers that most of its sources include directly.
+
+  :param result: The TargetIncludes of the target
+  :returns: A sorted list of header names
+  """
+  if len(result.direct) < PCH_MIN_SOURCES:
+    return []
+  counts = Counter()
+  for directives in result.direct.values():
+    counts.update({name for kind, name in directives
+      if kind == "<" and name in result.external and _heavy_header(name)})
+  needed = max(PCH_MIN_SOURCES, PCH_MIN_FRACTION * len(result.direct))
+  return sorted(name for name, count in counts.items() if count >= needed)
+
+def header_dependents(includes):
+  """Reverses the scanned includes.
+
+  :param includes: A dictionary of target name to TargetIncludes
+  :returns: A dictionary of header path to the names of the targets whose
+            sources include it, directly or through other headers
+  """
+  dependents = {}
+  for name, result in includes.items():
+    for header in result.headers:
+      dependents.setdefault(header, set()).add(name)
+  return dependents
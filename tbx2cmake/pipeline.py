@@ -0,0 +1,370 @@
+# coding: utf-8
+
+"""
+The rules that filter, classify and check the targets of a distribution
+after its SConscripts have been read, applied in order to every target.
+
+Every rule is registered in RULES. The settings of each can be changed, and
+rules turned off, in a "pipeline" section of the autogen.yaml, e.g.:
+
+  pipeline:
+    remove_modules: [clipper, clipper_adaptbx, fftw3tbx, cudatbx]
+    external_libraries: [tiff, boost_python, GL, GLU, hdf5, fftw3]
+    disable: [library_prefixes]
+
+Settings that aren't given keep the defaults in each rule.
+"""
+
+import collections
+import threading
+import timeit
+
+import yaml
+
+from .compat import basestring
+from .sconsemu import Target
+
+import logging
+logger = logging.getLogger(__name__)
+
+class RuleError(AssertionError):
+  "Raised when a validator finds a target that breaks its assumptions"
+
+class Rule(object):
+  """A step of the pipeline. Subclasses implement any of the hooks:
+
+    start(tbx)          Once, before the rule is applied to the targets
+    apply(tbx, target)  For each target; filters return True to remove the
+                        target, other rules return True if they changed or
+                        matched the target
+    finish(tbx)         Once, after every rule has been applied to the
+                        targets; returns how many things it
+                        changed or matched
+
+  :param setting: The setting from the autogen.yaml, or the default
+  """
+  # The key of the rule in RULES and in the autogen.yaml
+  name = None
+  # One of "filter", "classifier" or "validator"
+  kind = None
+  default = None
+
+  def __init__(self, setting=None):
+    self.setting = self.default if setting is None else setting
+    # How many targets (or modules) the rule matched, and the time it took
+    self.hits = 0
+    self.seconds = 0.0
+
+  def start(self, tbx):
+    return 0
+
+  def apply(self, tbx, target):
+    return False
+
+  def finish(self, tbx):
+    return 0
+
+class RemoveModules(Rule):
+  """Removes modules that can't be converted
+  - clipper has some script referencing we don't understand completely
+  - fftw3tbx uses an external library that dials doesn't use"""
+  name = "remove_modules"
+  kind = "filter"
+  default = ["clipper", "clipper_adaptbx", "fftw3tbx"]
+
+  def start(self, tbx):
+    removed = 0
+    for module in sorted(set(self.setting)):
+      if module in tbx.modules:
+        logger.info("Removing module {} ({} targets)".format(module, len(tbx.modules[module].targets)))
+        del tbx.modules[module]
+        removed += 1
+    return removed
+
+class RemoveTargets(Rule):
+  "Removes targets built outside of the distribution, e.g. boost"
+  name = "remove_targets"
+  kind = "filter"
+  default = ["boost_thread", "boost_system", "boost_python", "boost_chrono"]
+
+  def apply(self, tbx, target):
+    if target.name in self.setting:
+      logger.info("Removing target {} (in {})".format(target.name, target.module.name))
+      return True
+    return False
+
+class RemoveLibraries(Rule):
+  """Removes targets linking any of the libraries, e.g. the CUDA libraries,
+  and CUDA targets, for now"""
+  name = "remove_libraries"
+  kind = "filter"
+  default = ["cufft"]
+
+  def apply(self, tbx, target):
+    if target.type == Target.Type.CUDALIB:
+      logger.info("Removing target {} (a CUDA library)".format(target.name))
+      return True
+    libraries = sorted(x for x in self.setting if x in target.extra_libs)
+    if libraries:
+      logger.info("Removing target {} (links {})".format(target.name, ", ".join(libraries)))
+      return True
+    return False
+
+class PythonModules(Rule):
+  "Classifies python-module-type targets as modules"
+  name = "python_modules"
+  kind = "classifier"
+  default = "boost_python"
+
+  def apply(self, tbx, target):
+    if self.setting in target.extra_libs and not target.prefix:
+      target.type = Target.Type.MODULE
+      return True
+    return False
+
+class SharedSources(Rule):
+  """Collapses shared source objects that are known to be safe to compile
+  into each target down to unshared sources"""
+  name = "ignorable_shared_sources"
+  kind = "classifier"
+  default = [
+    ['numpy_bridge.cpp'],
+    ['lbfgs_fem.cpp'],
+    ['boost_python/outlier_helpers.cc'],
+    ['nanoBragg_ext.cpp', 'nanoBragg.cpp']
+  ]
+
+  def apply(self, tbx, target):
+    if not target.shared_sources:
+      return False
+    src = target.shared_sources[0].path
+    if isinstance(src, basestring):
+      src = [src]
+    if list(src) in [list(x) for x in self.setting]:
+      target.sources.extend(src)
+      target.shared_sources = []
+      return True
+    return False
+
+class RemoveEmptyModules(Rule):
+  "Removes any modules without targets (these might not even be real modules)"
+  name = "remove_empty_modules"
+  kind = "filter"
+
+  def finish(self, tbx):
+    empty = [x.name for x in tbx.modules.values() if not x.targets]
+    for module in empty:
+      del tbx.modules[module]
+    return len(empty)
+
+class DeduplicateNames(Rule):
+  "Fixes duplicated target names, by adding the module name"
+  name = "deduplicate_names"
+  kind = "classifier"
+
+  def start(self, tbx):
+    self._names = collections.defaultdict(list)
+    return 0
+
+  def apply(self, tbx, target):
+    self._names[target.name].append(target)
+    return False
+
+  def finish(self, tbx):
+    renamed = 0
+    for duplicate in sorted(x for x, found in self._names.items() if len(found) > 1):
+      duped = self._names[duplicate]
+      modules = set(x.module for x in duped)
+      if len(modules) != len(duped):
+        raise RuleError("Module name not enough to disambiguate duplicate targets named {} (in {})".format(
+          duplicate, ", ".join(sorted(x.name for x in modules))))
+      for target in duped:
+        oldname = target.name
+        target.name = "{}_{}".format(target.name, target.module.name)
+        logger.info("Renaming target {} to {}".format(oldname, target.name))
+        renamed += 1
+    names = collections.Counter(x.name for x in tbx.targets)
+    if not all(x == 1 for x in names.values()):
+      raise RuleError("Deduplication failed")
+    return renamed
+
+class BelongsToModule(Rule):
+  "Checks that every target belongs to a module"
+  name = "belongs_to_module"
+  kind = "validator"
+
+  def apply(self, tbx, target):
+    if not target.module:
+      raise RuleError("Not all targets belong to a module")
+    return False
+
+class LibraryPrefixes(Rule):
+  "Checks that libraries have a lib prefix, and python modules none"
+  name = "library_prefixes"
+  kind = "validator"
+  default = {"Shared": "lib", "Static": "lib", "Module": ""}
+
+  def apply(self, tbx, target):
+    expected = self.setting.get(target.type.value)
+    if expected is not None and target.prefix != expected:
+      raise RuleError("{} target {} has prefix {!r}, not {!r}".format(
+        target.type.value, target.name, target.prefix, expected))
+    return False
+
+class NoSharedSources(Rule):
+  "Checks that every shared source object has been collapsed"
+  name = "no_shared_sources"
+  kind = "validator"
+
+  def apply(self, tbx, target):
+    if target.shared_sources:
+      raise RuleError("Shared sources exists - all should be filtered ({})".format(target.name))
+    return False
+
+class ModuleRootTargets(Rule):
+  "Checks that targets named directly after a module are in the module root"
+  name = "module_root_targets"
+  kind = "validator"
+
+  def start(self, tbx):
+    self._named = []
+    return 0
+
+  def apply(self, tbx, target):
+    if target.name in tbx.modules:
+      self._named.append(target)
+      return True
+    return False
+
+  def finish(self, tbx):
+    # Checked after deduplication, which can rename them
+    for target in self._named:
+      if target.name in tbx.modules and target.origin_path != tbx.modules[target.name].path:
+        raise RuleError("Target {} is not in the root of module {}".format(target.name, target.name))
+    return 0
+
+class ExternalLibraries(Rule):
+  """Checks that we know and expect all the external libraries. A partial
+  conversion might not need all of them."""
+  name = "external_libraries"
+  kind = "validator"
+  default = ["tiff", "boost_python", "GL", "GLU", "hdf5"]
+
+  def start(self, tbx):
+    self._libs = set()
+    return 0
+
+  def apply(self, tbx, target):
+    self._libs |= target.extra_libs
+    return False
+
+  def finish(self, tbx):
+    external_libs = self._libs - {x.name for x in tbx.targets}
+    logger.info("All linked libraries: {}".format(", ".join(self._libs)))
+    logger.info("All external (w/o universal): {}".format(", ".join(external_libs)))
+    logger.info("{} Targets remaining".format(len(tbx.targets)))
+    expected_libs = set(self.setting)
+    if tbx.selected_modules is None and external_libs != expected_libs:
+      raise RuleError("Unexpected extra external libs in: {}".format(", ".join(sorted(external_libs))))
+    if not external_libs <= expected_libs:
+      raise RuleError("Unexpected extra external libs in: {}".format(
+        ", ".join(sorted(external_libs - expected_libs))))
+    return len(external_libs)
+
+# Every rule, in the order they are applied
+RULES = collections.OrderedDict((x.name, x) for x in [
+  RemoveModules, RemoveTargets, RemoveLibraries, RemoveEmptyModules,
+  DeduplicateNames, PythonModules, SharedSources, BelongsToModule,
+  LibraryPrefixes, NoSharedSources, ModuleRootTargets, ExternalLibraries,
+])
+
+class Pipeline(object):
+  """The rules to prepare a distribution with, and how each performed over
+  every distribution prepared. Each run makes its own rule objects, so one
+  pipeline can prepare several distributions at once.
+
+  :param settings: The "pipeline" section of the autogen.yaml, if any
+  """
+  def __init__(self, settings=None):
+    settings = dict(settings or {})
+    disabled = set(settings.pop("disable", []))
+    unknown = (set(settings) | disabled) - set(RULES)
+    if unknown:
+      raise KeyError("Unknown pipeline rules: {}".format(", ".join(sorted(unknown))))
+    self._rules = [(rule, settings.get(name)) for name, rule in RULES.items() if not name in disabled]
+    # The totals of every run
+    self.rules = self._new_rules()
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # A copy sent to another process only counts its own runs, for add
+    state = dict(self.__dict__)
+    state["rules"] = self._new_rules()
+    del state["_lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def _new_rules(self):
+    return [rule(setting) for rule, setting in self._rules]
+
+  def add(self, rules):
+    "Adds how the rules of one run, or another pipeline's totals, performed"
+    with self._lock:
+      for total, rule in zip(self.rules, rules):
+        total.hits += rule.hits
+        total.seconds += rule.seconds
+
+  @classmethod
+  def from_autogen(cls, filename):
+    "Makes the pipeline configured in an autogen.yaml"
+    with open(filename) as f:
+      data = yaml.safe_load(f) or {}
+    return cls(data.get("pipeline"))
+
+  def _timed(self, rule, function, *args):
+    start = timeit.default_timer()
+    result = function(*args)
+    rule.seconds += timeit.default_timer() - start
+    return result
+
+  def _apply(self, rule, tbx, targets):
+    "Applies a rule to every target, returning the targets it matched"
+    return [x for x in targets if rule.apply(tbx, x)]
+
+  def run(self, tbx):
+    """Applies every rule to a distribution. Each rule is applied to every
+    target that the filters before it kept, and timed once over them all.
+
+    :returns: The rules used, with how each performed in this run
+    """
+    rules = self._new_rules()
+    for rule in rules:
+      rule.hits += self._timed(rule, rule.start, tbx)
+
+    targets = list(tbx.targets)
+    for rule in rules:
+      matched = self._timed(rule, self._apply, rule, tbx, targets)
+      rule.hits += len(matched)
+      if rule.kind == "filter" and matched:
+        tbx.targets.remove_all(matched)
+        targets = [x for x in targets if not x in matched]
+
+    for rule in rules:
+      rule.hits += self._timed(rule, rule.finish, tbx)
+    self.add(rules)
+    for line in _format_rules(rules).splitlines():
+      logger.debug(line)
+    return rules
+
+def _format_rules(rules):
+  lines = ["{:<26} {:<11} {:>6} {:>10}".format("Rule", "Kind", "Hits", "Time (ms)")]
+  for rule in rules:
+    lines.append("{:<26} {:<11} {:>6} {:>10.2f}".format(rule.name, rule.kind, rule.hits, rule.seconds * 1000))
+  return "\n".join(lines)
+
+def format_pipeline_report(pipeline):
+  "Formats how many things each rule matched, and how long it took, in total"
+  return _format_rules(pipeline.rules)
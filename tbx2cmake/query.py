@@ -0,0 +1,369 @@
+# coding: utf-8
+
+"""
+Answers questions about the targets and modules of a TBX distribution from a
+saved snapshot, instead of emulating the SConscripts every time.
+
+Save a snapshot first, then query it:
+  tbx2query --save <module_dir> <autogen.yaml> dist.json
+  tbx2query dist.json linked-by scitbx_boost_python
+
+Usage: tbx2query --save [options] <module_dir> <autogen.yaml> <snapshot>
+       tbx2query [options] <snapshot> links <target>
+       tbx2query [options] <snapshot> linked-by <target>
+       tbx2query [options] <snapshot> requires <module>
+       tbx2query [options] <snapshot> required-by <module>
+       tbx2query [options] <snapshot> owner <path>...
+       tbx2query [options] <snapshot> path <from> <to>
+       tbx2query [options] <snapshot> show <name>
+
+Commands:
+  links         The libraries a target links against
+  linked-by     The targets that link against a target
+  requires      The modules a module requires
+  required-by   The modules that require a module
+  owner         The targets that compile a source, or include a header
+  path          A shortest chain of links, or module requirements, from one
+                target or module to another
+  show          Everything known about a target and/or module
+
+Options:
+  --save              Read a distribution and save a snapshot of it to query
+  --only=<modules>    Only save a comma-separated list of modules, and the
+                      modules that they require
+  --scan-includes     Scan the #include directives of target sources when
+                      saving, so that owner queries find headers too
+  --include-cache=<file>
+                      Keep the scanned #include directives in a file, to
+                      only rescan changed files on the next save
+  --direct            Only list direct links or requirements, instead of
+                      everything pulled in through them
+  --json              Write the answer as JSON
+"""
+
+import sys
+import os
+import json
+import logging
+from collections import deque
+
+from docopt import docopt
+
+logger = logging.getLogger(__name__)
+
+class Snapshot(object):
+  """The targets and modules of a distribution, with the indexes needed to
+  answer queries, as saved to and loaded from a JSON file.
+
+  :param data: The dictionary written by snapshot_distribution
+  """
+  VERSION = 1
+
+  def __init__(self, data):
+    self.data = data
+    self.module_path = data["module_path"]
+    self.targets = data["targets"]
+    self.modules = data["modules"]
+    # Path to the target names built from, or including, it
+    self.sources = data["indexes"]["sources"]
+    self.generated = data["indexes"]["generated"]
+    self.headers = data["indexes"]["headers"]
+    # Reverse edges of the link and module requirement graphs
+    self.linked_by = data["indexes"]["linked_by"]
+    self.required_by = data["indexes"]["required_by"]
+
+  @classmethod
+  def load(cls, filename):
+    with open(filename) as f:
+      data = json.load(f)
+    if data.get("version") != cls.VERSION:
+      raise ValueError("Snapshot {} is from a different version; save it again".format(filename))
+    return cls(data)
+
+  def save(self, filename):
+    with open(filename, "w") as f:
+      json.dump(self.data, f, indent=1, sort_keys=True)
+
+  def links(self, name, direct=False):
+    "The libraries a target links against; internal ones first, then external"
+    internal = self._reachable(name, lambda x: self.targets[x]["internal_libs"], direct)
+    external = set(self.targets[name]["external_libs"])
+    if not direct:
+      for lib in internal:
+        external |= set(self.targets[lib]["external_libs"])
+    return sorted(internal) + sorted(external)
+
+  def linked_by_targets(self, name, direct=False):
+    "The targets that link against a target"
+    return sorted(self._reachable(name, lambda x: self.linked_by.get(x, []), direct))
+
+  def requires(self, name, direct=False):
+    "The modules a module requires"
+    return sorted(self._reachable(name, lambda x: self.modules[x]["requires"], direct))
+
+  def required_by_modules(self, name, direct=False):
+    "The modules that require a module"
+    return sorted(self._reachable(name, lambda x: self.required_by.get(x, []), direct))
+
+  def owners(self, path):
+    """Finds the targets built from a path.
+
+    :param path: A path relative to the module root, or generated into the build
+    :returns: A dictionary of target name to how it uses the path
+    """
+    owners = {}
+    for name in self.sources.get(path, []):
+      owners[name] = "compiles"
+    for name in self.generated.get(path, []):
+      owners.setdefault(name, "compiles generated")
+    for name in self.headers.get(path, []):
+      owners.setdefault(name, "includes")
+    return owners
+
+  def path(self, start, end):
+    """Finds a shortest chain of links between two targets, or of
+    requirements between two modules.
+
+    :returns: The list of names from start to end, or None if there isn't one
+    """
+    if start in self.targets and end in self.targets:
+      edges = lambda x: self.targets[x]["internal_libs"]
+    elif start in self.modules and end in self.modules:
+      edges = lambda x: self.modules[x]["requires"]
+    else:
+      raise KeyError("{} and {} must both be targets, or both modules".format(start, end))
+    previous = {start: None}
+    queue = deque([start])
+    while queue:
+      node = queue.popleft()
+      if node == end:
+        chain = []
+        while node is not None:
+          chain.append(node)
+          node = previous[node]
+        return chain[::-1]
+      for following in sorted(edges(node)):
+        if not following in previous:
+          previous[following] = node
+          queue.append(following)
+    return None
+
+  def _reachable(self, name, edges, direct):
+    "The names reachable from a name, through a function giving the edges of each"
+    if direct:
+      return set(edges(name))
+    found = set()
+    stack = list(edges(name))
+    while stack:
+      node = stack.pop()
+      if not node in found:
+        found.add(node)
+        stack.extend(edges(node))
+    return found
+
+def snapshot_distribution(tbx, includes=None):
+  """Makes a snapshot of a distribution.
+
+  :param tbx:      The TBXDistribution, with autogen information applied
+  :param includes: The scanned includes of every target, from scan_includes,
+                   if headers should be indexed
+  :returns: A Snapshot
+  """
+  # Only needed to save; loading a snapshot doesn't need the emulator
+  from .read_scons import find_libtbx_modules, _build_dependency_graph
+  from .include_scan import header_dependents
+
+  names = {x.name for x in tbx.targets}
+  targets = {}
+  sources = {}
+  generated = {}
+  linked_by = {}
+  for target in tbx.targets:
+    paths = [os.path.normpath(os.path.join(target.origin_path, x)) for x in target.sources]
+    internal = sorted(x for x in target.extra_libs if x in names and x != target.name)
+    targets[target.name] = {
+      "module": target.module.name,
+      "type": target.type.value,
+      "origin": target.origin_path,
+      "output": os.path.join(target.output_path, target.output_filename),
+      "sources": paths,
+      "generated_sources": sorted(target.generated_sources),
+      "internal_libs": internal,
+      "external_libs": sorted(x for x in target.extra_libs if not x in names),
+      "include_paths": sorted(target.include_paths),
+    }
+    for path in paths:
+      sources.setdefault(path, []).append(target.name)
+    for path in target.generated_sources:
+      generated.setdefault(path, []).append(target.name)
+    for lib in internal:
+      linked_by.setdefault(lib, []).append(target.name)
+
+  # Every module, including those without targets, as for the build order
+  all_modules = find_libtbx_modules(tbx.module_path)
+  if tbx.selected_modules is not None:
+    all_modules = [x for x in all_modules if x.name in tbx.selected_modules]
+  known = {x.name for x in all_modules}
+  graph = _build_dependency_graph(all_modules)
+  modules = {}
+  required_by = {}
+  for module in all_modules:
+    requires = sorted(x for x in graph.successors(module.name) if x in known)
+    owned = tbx.modules[module.name].targets if module.name in tbx.modules else []
+    modules[module.name] = {
+      "path": module.path,
+      "requires": requires,
+      "targets": sorted(x.name for x in owned),
+    }
+    for required in requires:
+      required_by.setdefault(required, []).append(module.name)
+
+  headers = {}
+  if includes is not None:
+    for header, owners in header_dependents(includes).items():
+      if header.startswith("#build/"):
+        generated.setdefault(header[len("#build/"):], []).extend(sorted(owners))
+      else:
+        headers[header] = sorted(owners)
+
+  indexes = {"sources": sources, "generated": generated, "headers": headers,
+             "linked_by": linked_by, "required_by": required_by}
+  for index in indexes.values():
+    for key in index:
+      index[key] = sorted(set(index[key]))
+  return Snapshot({
+    "version": Snapshot.VERSION,
+    "module_path": os.path.abspath(tbx.module_path),
+    "targets": targets,
+    "modules": modules,
+    "indexes": indexes,
+  })
+
+def _relative_path(snapshot, path):
+  "Makes a path given on the command line relative to the module root"
+  if os.path.exists(path) or os.path.isabs(path):
+    absolute = os.path.abspath(path)
+    if absolute.startswith(snapshot.module_path + os.sep):
+      return os.path.relpath(absolute, snapshot.module_path)
+  return os.path.normpath(path)
+
+def _format_show(snapshot, name):
+  "Formats everything known about a target and/or module"
+  lines = []
+  if name in snapshot.targets:
+    target = snapshot.targets[name]
+    lines.append("{} target {} in module {}".format(target["type"], name, target["module"]))
+    lines.append("  Output:  {}".format(target["output"]))
+    lines.append("  Origin:  {}".format(target["origin"]))
+    lines.append("  Sources: {}".format(", ".join(target["sources"] + target["generated_sources"])))
+    if target["internal_libs"] or target["external_libs"]:
+      lines.append("  Libs:    {}".format(", ".join(target["internal_libs"] + target["external_libs"])))
+    if target["include_paths"]:
+      lines.append("  Include paths: {}".format(", ".join(target["include_paths"])))
+  if name in snapshot.modules:
+    module = snapshot.modules[name]
+    lines.append("Module {} at {}".format(name, module["path"]))
+    lines.append("  Requires: {}".format(", ".join(module["requires"]) or "nothing"))
+    lines.append("  Targets:  {}".format(", ".join(module["targets"]) or "none"))
+  return "\n".join(lines)
+
+def _save(options):
+  "Reads a distribution and saves a snapshot of it"
+  from .read_scons import read_distribution, unknown_modules
+  from .write_cmake import read_autogen_information
+  from .pipeline import Pipeline
+  from .include_scan import IncludeCache, scan_includes
+  from .utils import stdout_to_stderr
+
+  module_dir = options["<module_dir>"]
+  if not os.path.isdir(module_dir):
+    print("Error: Module path {} must be a directory".format(module_dir))
+    sys.exit(1)
+  only = [x for x in (options["--only"] or "").split(",") if x]
+  if unknown_modules(module_dir, only):
+    print("Error: Unknown modules {}".format(", ".join(unknown_modules(module_dir, only))))
+    sys.exit(1)
+
+  logger.info("Reading TBX distribution")
+  # The emulator prints as it goes; keep stdout free of it, as tbx2impact does
+  with stdout_to_stderr():
+    tbx = read_distribution(module_dir, only=only, pipeline=Pipeline.from_autogen(options["<autogen.yaml>"]))
+  read_autogen_information(options["<autogen.yaml>"], tbx)
+  includes = None
+  if options["--scan-includes"]:
+    includes = scan_includes(tbx, IncludeCache(options["--include-cache"]))
+  snapshot_distribution(tbx, includes).save(options["<snapshot>"])
+  logger.info("Saved {} targets in {} modules to {}".format(
+    len(tbx.targets), len(tbx.modules), options["<snapshot>"]))
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  options = docopt(__doc__)
+  if options["--save"]:
+    return _save(options)
+
+  try:
+    snapshot = Snapshot.load(options["<snapshot>"])
+  except (IOError, ValueError) as e:
+    print("Error: Could not load snapshot: {}".format(e))
+    sys.exit(1)
+
+  direct = options["--direct"]
+  if options["links"] or options["linked-by"]:
+    name = options["<target>"]
+    if not name in snapshot.targets:
+      print("Error: No target named {}".format(name))
+      sys.exit(1)
+    if options["links"]:
+      result = snapshot.links(name, direct)
+    else:
+      result = snapshot.linked_by_targets(name, direct)
+  elif options["requires"] or options["required-by"]:
+    name = options["<module>"]
+    if not name in snapshot.modules:
+      print("Error: No module named {}".format(name))
+      sys.exit(1)
+    if options["requires"]:
+      result = snapshot.requires(name, direct)
+    else:
+      result = snapshot.required_by_modules(name, direct)
+  elif options["owner"]:
+    result = {}
+    for path in options["<path>"]:
+      result[path] = snapshot.owners(_relative_path(snapshot, path))
+  elif options["path"]:
+    try:
+      result = snapshot.path(options["<from>"], options["<to>"])
+    except KeyError as e:
+      print("Error: {}".format(e.args[0]))
+      sys.exit(1)
+  else:
+    name = options["<name>"]
+    if not name in snapshot.targets and not name in snapshot.modules:
+      print("Error: No target or module named {}".format(name))
+      sys.exit(1)
+    result = {"target": snapshot.targets.get(name), "module": snapshot.modules.get(name)}
+
+  if options["--json"]:
+    print(json.dumps(result, indent=2, sort_keys=True))
+  elif options["owner"]:
+    for path in options["<path>"]:
+      owners = result[path]
+      if not owners:
+        print("{}: not built by any target".format(path))
+      for name in sorted(owners):
+        print("{}: {} {}".format(path, name, owners[name]))
+  elif options["path"]:
+    if result is None:
+      print("No path from {} to {}".format(options["<from>"], options["<to>"]))
+    else:
+      print(" -> ".join(result))
+  elif options["show"]:
+    print(_format_show(snapshot, options["<name>"]))
+  else:
+    for name in result:
+      print(name)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -9,9 +9,15 @@ import sys
 import networkx as nx
 import collections
 import itertools
+import multiprocessing
 
-from .utils import return_as_list
-from .sconsemu import SconsEmulator, Target
+from .utils import return_as_list, topological_order, convert_scripts
+from .compat import PY2, basestring, Set
+from .sconsemu import SconsEmulator, Target, BuildFlags
+from .import_env import BUILD_PROFILES
+from .refresh import python_packages, find_refresh_inputs
+from .static_scons import plan_sconscript, compare_targets
+from .pipeline import Pipeline
 
 import logging
 logger = logging.getLogger(__name__)
@@ -26,8 +32,12 @@ class LibTBXModule(object):
     self.targets = []
     # The sources generated by the refresh step
     self.generated_sources = []
+    # Files in the distribution that the refresh step reads
+    self.refresh_inputs = []
     # Extra include paths to use this module
     self.include_paths = set()
+    # Compile flags shared by all targets in the module
+    self.flags = BuildFlags()
 
     # self.required_by = set()
 
@@ -77,7 +87,7 @@ def find_libtbx_modules(modulepath, repositories={"cctbx_project"}):
     yield LibTBXModule(name=name, path=path, module_root=modulepath)
 
 
-class TargetCollection(collections.Set):
+class TargetCollection(Set):
   """Collection wrapper to make operations on target sets easier"""
   def __init__(self, distribution):
     self.distribution = distribution
@@ -95,7 +105,9 @@ class TargetCollection(collections.Set):
     return True
 
   def __iter__(self):
-    return itertools.chain(*(x.targets for x in self.distribution._modules.values()))
+    # Always in the same order, regardless of hashing
+    modules = sorted(self.distribution._modules.items())
+    return itertools.chain(*(x.targets for _, x in modules))
   
   def __len__(self):
     return sum(len(x.targets) for x in self.distribution._modules.values())
@@ -129,6 +141,11 @@ class TBXDistribution(object):
     self._targetcollection = TargetCollection(self)
     # Files generated by unusual means during build
     self.other_generated = []
+    # The names of the modules converted, if not the whole distribution
+    self.selected_modules = None
+    # How many SConscripts were read without executing, and how many executed
+    self.planned_sconscripts = 0
+    self.executed_sconscripts = 0
 
   @property
   def targets(self):
@@ -171,29 +188,40 @@ def _build_dependency_graph(modules):
   G.add_edge("scitbx", "omptbx")
 
   # Validate we don't have any cycles
-  assert nx.is_directed_acyclic_graph(G), "Cycles found in dependency graph: {}".format(nx.cycles.find_cycle(G))
+  assert nx.is_directed_acyclic_graph(G), "Cycles found in dependency graph: {}".format(nx.find_cycle(G))
 
   return G
 
+def module_closure(G, names):
+  """Finds the modules needed to build a set of modules.
+
+  :param G:     The module dependency graph, from _build_dependency_graph
+  :param names: The names of the requested modules
+  :returns: A set of the requested module names and everything they require
+  """
+  closure = set()
+  for name in names:
+    if not name in G:
+      raise KeyError("No module named {}".format(name))
+    closure.add(name)
+    closure |= nx.descendants(G, name)
+  return closure
+
+def unknown_modules(module_path, names):
+  "Returns the names, in order, that are not modules in a module root"
+  known = {x.name for x in find_libtbx_modules(module_path)}
+  return [x for x in names if not x in known]
+
 ##############################################################################
 # __main__ handling and setup functionality
 
-def _deduplicate_target_names(targets):
-  "Takes a list of targets and fixes names to avoid duplicates"
-  namecount = collections.Counter([x.name for x in targets])
-  for duplicate in [x for x in namecount.keys() if namecount[x] > 1]:
-    duped = [x for x in targets if x.name == duplicate]
-    modules = set(x.module for x in duped)
-    assert len(modules) == len(duped), "Module name not enough to disambiguate duplicate targets named {} (in {})".format(duplicate, modules)
-    for target in duped:
-      oldname = target.name
-      target.name = "{}_{}".format(target.name, target.module.name)
-      logger.info("Renaming target {} to {}".format(oldname, target.name))
-  assert all([x == 1 for _, x in collections.Counter([x.name for x in targets]).items()]), "Deduplication failed"
-
-def read_module_path_sconscripts(module_path):
+def read_module_path_sconscripts(module_path, build_options=None, only=None, fast_path=True):
   """Parse all modules/SConscripts in a tbx module root.
 
+  :param build_options: A dictionary of libtbxBuildOptions to override
+  :param only: Names of modules to convert, along with everything they
+               require. By default, every module is converted.
+  :param fast_path: Read simple SConscripts without executing them
   Returns a TBXDistribution object.
   """
 
@@ -203,11 +231,19 @@ def read_module_path_sconscripts(module_path):
 
   # Find an order of processing that satisfies dependencies
   G = _build_dependency_graph(modules.values())
-  node_order = nx.topological_sort(G, reverse=True, nbunch=sorted(G.nodes()))
+  selected = None
+  if only:
+    selected = module_closure(G, only)
+    logger.info("Converting {} of {} modules: {}".format(
+      len(selected & set(modules)), len(modules), ", ".join(sorted(selected & set(modules)))))
+    modules = {name: x for name, x in modules.items() if name in selected}
+    G = G.subgraph(selected)
+  node_order = topological_order(G, reverse=True)
   logger.debug("Dependency processing order: {}".format(node_order))
 
   # Prepare the SCons emulator
-  scons = SconsEmulator(dist=module_path)#, modules=modules)
+  scons = SconsEmulator(dist=module_path, build_options=build_options,
+                        planner=plan_sconscript if fast_path else None)#, modules=modules)
 
   # Process all modules in the determined dependency order
   scons_modules = [modules[x] for x in node_order if x in modules and modules[x].has_sconscript]
@@ -223,111 +259,168 @@ def read_module_path_sconscripts(module_path):
 
 
   logger.info("Processing of SConscripts done.")
+  logger.info("{} of {} SConscripts read without executing".format(
+    scons.planned_count, scons.planned_count + scons.executed_count))
   logger.info("{} Targets recognised".format(len(scons.targets)))
 
   tbx = TBXDistribution()
   tbx.module_path = module_path
   tbx._modules = modules
+  tbx.selected_modules = selected
+  tbx.planned_sconscripts = scons.planned_count
+  tbx.executed_sconscripts = scons.executed_count
 
   return tbx
 
-def _is_cuda_target(target):
-  if target.type == Target.Type.CUDALIB:
-    return True
-  if "cufft" in target.extra_libs:
-    return True
-  return False
-
-def read_distribution(module_path):
-  "Reads a TBX distribution, filter and prepare for output conversion"
-
-  tbx = read_module_path_sconscripts(module_path)
-
-  # Remove the boost targets
-  boost_target_names = {"boost_thread", "boost_system", "boost_python", "boost_chrono"}
-  boost_targets = {x for x in tbx.targets if x.name in boost_target_names}
-  for target in boost_targets:
-    logger.info("Removing target {} (in {})".format(target.name, target.module.name))
-    tbx.targets.remove(target)
-
-  # Remove any modules we don't want
-  # - Clipper has some script referencing we don't understand completely
-  # - fftw3tbx uses an external library and we don't use this in dials, so skip for now
-  for module in {"clipper", "clipper_adaptbx", "fftw3tbx"}:
-    if module in tbx.modules:
-      logger.info("Removing module {} ({} targets)".format(module, len(tbx.modules[module].targets)))
-      del tbx.modules[module]
-
-  # Remove CUDA projects, for now
-  for target in [x for x in tbx.targets if _is_cuda_target(x)]:
-    logger.info("Removing CUDA target {}".format(target.name))
-    tbx.targets.remove(target)
-  # for target in [x for x in tbx.targets:
-
-  # Remove any modules without targets (these might not even be real modules)
-  for module in [x.name for x in tbx.modules.values() if not x.targets]:
-    del tbx.modules[module]
-
-  # Fix any duplicated target names
-  _deduplicate_target_names(tbx.targets)
-
-  # Classify any python-module-type targets as modules
+def verify_fast_path(module_path, build_options=None, only=None):
+  """Reads the SConscripts with and without the fast path, and compares.
+
+  :returns: A tuple of the differences, as from compare_targets, and the
+            fast-path TBXDistribution
+  """
+  logger.info("Emulating every SConscript")
+  reference = read_module_path_sconscripts(module_path, build_options, only=only, fast_path=False)
+  logger.info("Emulating with the fast path")
+  fast = read_module_path_sconscripts(module_path, build_options, only=only)
+  return compare_targets(reference.targets, fast.targets), fast
+
+def _target_key(target):
+  "A key to identify the same target across separate emulation runs"
+  return (target.module.name, target.origin_path, target.name)
+
+def _profile_build_options(profile, build_options=None):
+  "The libtbxBuildOptions overrides to emulate a build profile with"
+  profile_options = dict(build_options or {})
+  profile_options.update(BUILD_PROFILES[profile])
+  return profile_options
+
+def _read_profile_flags(tbx, profiles, build_options=None, only=None):
+  """Emulates the distribution once for each build profile after the first,
+  and splits every target's flags into those common to all profiles and
+  those per-profile.
+
+  :param tbx:      The TBXDistribution to update the target flags in, as
+                   emulated with the first profile
+  :param profiles: A list of names from BUILD_PROFILES
+  :param build_options: libtbxBuildOptions overrides common to every profile
+  :param only:     Names of modules to restrict the emulation to
+  """
+  profile_targets = {profiles[0]: {_target_key(x): x for x in tbx.targets}}
+  for profile in profiles[1:]:
+    logger.info("Emulating SConscripts for build profile {}".format(profile))
+    profile_tbx = read_module_path_sconscripts(tbx.module_path,
+      _profile_build_options(profile, build_options), only=only)
+    profile_targets[profile] = {_target_key(x): x for x in profile_tbx.targets}
+
   for target in tbx.targets:
-    if "boost_python" in target.extra_libs and not target.prefix:
-      target.type = Target.Type.MODULE
-
-  # Make sure that all instances of shared source objects are known about
-  # and collapse them down to unshared sources.
-  KNOWN_IGNORABLE_SHARED = [
-    ['numpy_bridge.cpp'],
-    ['lbfgs_fem.cpp'],
-    ['boost_python/outlier_helpers.cc'],
-    ['nanoBragg_ext.cpp', 'nanoBragg.cpp']
-  ]
-  for target in [x for x in tbx.targets if x.shared_sources]:
-    src = target.shared_sources[0].path
-    if isinstance(src, basestring):
-      src = [src]
-    if src in KNOWN_IGNORABLE_SHARED:
-      target.sources.extend(src)
-      target.shared_sources = []
-
-  # Check assumptions about all the targets
-  assert all(x.module for x in tbx.targets), "Not all targets belong to a module"
-  assert all(x.prefix == "lib" for x in tbx.targets if x.type == Target.Type.SHARED)
-  assert all(x.prefix == "lib" for x in tbx.targets if x.type == Target.Type.STATIC)
-  assert all(x.prefix == "" for x in tbx.targets if x.type == Target.Type.MODULE)
-  assert all(not x.shared_sources for x in tbx.targets), "Shared sources exists - all should be filtered"
-  # assert all("GLU" in x.extra_libs for x in tbx.targets if "GL" in x.extra_libs), "Not all GLU has GL"
-  # assert all("GL" in x.extra_libs for x in tbx.targets if "GLU" in x.extra_libs), "Not all GL has GLU"
-  
-  # For all targets named directly after a module, ensure it's in the module root
-  assert all([x.origin_path == tbx.modules[x.name].path for x in tbx.targets if x.name in tbx.modules])
-
-  # Print some information out
-  all_libs = set(itertools.chain(*[x.extra_libs for x in tbx.targets]))
-  external_libs = all_libs - {x.name for x in tbx.targets}
-  logger.info("All linked libraries: {}".format(", ".join(all_libs)))
-  logger.info("All external (w/o universal): {}".format(", ".join(external_libs)))
-  logger.info("{} Targets remaining".format(len(tbx.targets)))
-
-  # Check that we know and expect all the external libraries
-  assert external_libs == {"tiff", "boost_python", "GL", "GLU", "hdf5"}, "Unexpected extra external libs in: {}".format(external_libs)
-  
+    key = _target_key(target)
+    missing = [x for x in profiles if not key in profile_targets[x]]
+    if missing:
+      logger.warning("Target {} not present in profiles {}; keeping the {} flags".format(
+        target.name, ", ".join(missing), profiles[0]))
+      continue
+    flags = {x: profile_targets[x][key].flags for x in profiles}
+    target.flags = BuildFlags()
+    for field in BuildFlags.FIELDS:
+      common = set.intersection(*(set(getattr(x, field)) for x in flags.values()))
+      setattr(target.flags, field, [x for x in getattr(flags[profiles[0]], field) if x in common])
+      for profile in profiles:
+        extra = [x for x in getattr(flags[profile], field) if not x in common]
+        setattr(target.flags.profile(profile), field, extra)
+
+def read_distribution(module_path, profiles=None, build_options=None, only=None, pipeline=None):
+  """Reads a TBX distribution, filter and prepare for output conversion
+
+  :param profiles: Names of build profiles to emulate separately, to find
+                   the compile flags that differ between them
+  :param build_options: A dictionary of libtbxBuildOptions to override
+  :param only: Names of modules to convert, along with their dependencies
+  :param pipeline: The Pipeline of rules to filter, classify and check the
+                   targets with. By default, the default rules
+  """
+
+  if profiles:
+    # The first profile's emulation is also the distribution read
+    logger.info("Emulating SConscripts for build profile {}".format(profiles[0]))
+    tbx = read_module_path_sconscripts(module_path, _profile_build_options(profiles[0], build_options),
+      only=only)
+    _read_profile_flags(tbx, profiles, build_options, only=only)
+  else:
+    tbx = read_module_path_sconscripts(module_path, build_options, only=only)
+
+  # Find the inputs of every refresh script, while all modules are known
+  packages = python_packages(tbx.module_path, [x.path for x in tbx.modules.values()])
+  for module in [x for x in tbx.modules.values() if x.has_refresh]:
+    script = os.path.join(module.path, "libtbx_refresh.py")
+    module.refresh_inputs = find_refresh_inputs(tbx.module_path, packages, script)
+    logger.debug("Refresh inputs for {}: {}".format(module.name, module.refresh_inputs))
+
+  (pipeline or Pipeline()).run(tbx)
   return tbx
 
 
+def _sconscript_paths(module_path, only=None):
+  "The SConscripts in the modules of a distribution that would be read"
+  modules = list(find_libtbx_modules(module_path))
+  if only:
+    selected = module_closure(_build_dependency_graph(modules), only)
+    modules = [x for x in modules if x.name in selected]
+  for module in modules:
+    for dirpath, dirnames, filenames in os.walk(os.path.join(module_path, module.path)):
+      dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+      if "SConscript" in filenames:
+        yield os.path.join(dirpath, "SConscript")
+
+def _read_distribution_worker(args):
+  "Reads one distribution for read_distributions, in a worker process"
+  module_path, kwargs = args
+  tbx = read_distribution(module_path, **kwargs)
+  # The pipeline here is a copy, so send back how it performed
+  pipeline = kwargs.get("pipeline")
+  return tbx, pipeline.rules if pipeline else None
+
+def read_distributions(module_paths, jobs=None, **kwargs):
+  """Reads several distributions at once, e.g. different checkouts or
+  branches, each in its own process.
+
+  :param module_paths: The module roots to read
+  :param jobs:   How many to read at once. By default, all of them
+  :param kwargs: Arguments passed on to read_distribution
+  :returns: A list of TBXDistribution, in the order of module_paths
+  """
+  if not module_paths:
+    return []
+  # Forked workers share the scripts converted here, instead of each
+  # converting the SConscripts that the distributions have in common
+  if not PY2 and multiprocessing.get_start_method() == "fork":
+    convert_scripts(itertools.chain(*(_sconscript_paths(x, kwargs.get("only")) for x in module_paths)))
+  pool = multiprocessing.Pool(jobs or len(module_paths))
+  try:
+    results = pool.map(_read_distribution_worker, [(x, kwargs) for x in module_paths])
+  finally:
+    pool.close()
+    pool.join()
+  for tbx, rules in results:
+    if rules is not None:
+      kwargs["pipeline"].add(rules)
+  return [tbx for tbx, rules in results]
+
 def main(args=None):
   logging.basicConfig(level=logging.INFO)
 
   if args is None:
     args = sys.argv[1:]
+  only = [x for arg in args if arg.startswith("--only=") for x in arg[len("--only="):].split(",") if x]
+  args = [x for x in args if not x.startswith("--only=")]
   if "-h" in args or "--help" in args or len(args) != 1 or not os.path.isdir(args[0]):
-    print("Usage: read_scons.py <module_path>")
+    print("Usage: read_scons.py [--only=<modules>] <module_path>")
     return 0
 
   module_path = args[0]
-  tbx = read_distribution(module_path)
+  if unknown_modules(module_path, only):
+    print("Error: Unknown modules {}".format(", ".join(unknown_modules(module_path, only))))
+    sys.exit(1)
+  tbx = read_distribution(module_path, only=only)
 
 
   import pdb
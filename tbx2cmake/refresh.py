@@ -0,0 +1,91 @@
+# coding: utf-8
+
+"""
+Works out the inputs of the libtbx_refresh.py scripts.
+
+The refresh scripts generate sources by importing python generator modules
+from around the distribution, which in turn may read template files. These
+are found by following the imports of each script through the python
+packages in the distribution, and looking for string literals that name
+files next to the scripts that reference them.
+"""
+
+import os
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+_IMPORT_RE = re.compile(r"^\s*import\s+([\w.]+(?:\s*,\s*[\w.]+)*)", re.M)
+_FROM_IMPORT_RE = re.compile(r"^\s*from\s+([\w.]+)\s+import\s+\(?([\w.,\s]+)\)?", re.M)
+_STRING_RE = re.compile(r"""["']([\w./-]+\.\w+)["']""")
+
+def python_packages(module_root, paths):
+  """Maps top-level python package names to their directory.
+
+  :param module_root: The root path of the distribution
+  :param paths:       The module paths, relative to the module root
+  :returns: A dictionary of package name to path relative to the module root
+  """
+  packages = {}
+  for path in paths:
+    if os.path.isdir(os.path.join(module_root, path)):
+      packages[os.path.basename(path)] = path
+  return packages
+
+def _resolve_module(module_root, packages, name):
+  "Finds the file for a dotted python module name, relative to the module root"
+  parts = name.split(".")
+  if not parts[0] in packages:
+    return None
+  base = os.path.join(packages[parts[0]], *parts[1:])
+  for candidate in (base + ".py", os.path.join(base, "__init__.py")):
+    if os.path.isfile(os.path.join(module_root, candidate)):
+      return os.path.normpath(candidate)
+  return None
+
+def _imported_names(text):
+  "Returns the dotted names a python source could be importing"
+  names = set()
+  for match in _IMPORT_RE.finditer(text):
+    names |= {x.strip() for x in match.group(1).split(",")}
+  for match in _FROM_IMPORT_RE.finditer(text):
+    module = match.group(1)
+    names.add(module)
+    # The imported names may themselves be submodules
+    for name in match.group(2).split(","):
+      name = name.strip()
+      if name and name != "*":
+        names.add(module + "." + name)
+  return names
+
+def find_refresh_inputs(module_root, packages, script):
+  """Finds the files that a refresh script reads, in the distribution.
+
+  :param module_root: The root path of the distribution
+  :param packages:    Python packages, as returned by python_packages
+  :param script:      Path to the refresh script, relative to the module root
+  :returns: A sorted list of paths relative to the module root, excluding
+            the script itself
+  """
+  inputs = set()
+  pending = [os.path.normpath(script)]
+  seen = set(pending)
+  while pending:
+    path = pending.pop()
+    with open(os.path.join(module_root, path)) as f:
+      text = f.read()
+    # Follow the imports that resolve to python files in the distribution
+    for name in _imported_names(text):
+      found = _resolve_module(module_root, packages, name)
+      if found and not found in seen:
+        seen.add(found)
+        inputs.add(found)
+        pending.append(found)
+    # Any other files named relative to this one, such as templates
+    for name in _STRING_RE.findall(text):
+      candidate = os.path.normpath(os.path.join(os.path.dirname(path), name))
+      if not candidate.startswith("..") and os.path.isfile(os.path.join(module_root, candidate)):
+        inputs.add(candidate)
+  inputs.discard(os.path.normpath(script))
+  return sorted(inputs)
@@ -1,19 +1,21 @@
 # coding: utf-8
 
+from __future__ import print_function
+
 import os
 import sys
 import inspect
 import copy
 import glob
-import contextlib
 import fnmatch
 import traceback
-from collections import defaultdict
+import itertools
 
 from enum import Enum
 
 from .utils import InjectableModule, monkeypatched
-from .import_env import do_import_patching
+from .compat import basestring, builtins
+from .import_env import make_stub_modules
 
 class ProgramReturn(object):
   """Thin shim to represent the return from a Program builder.
@@ -50,8 +52,7 @@ class SConsConfigurationContext(object):
     #   return (1, repr(data))
 
     # Get the name of the calling function
-    with no_intercept_os():
-      caller = inspect.stack()[1][3]
+    caller = inspect.stack()[1][3]
     
     # Yes, openMP works as far as libtbx configuration is concerned
     if caller == "enable_openmp_if_possible":
@@ -112,6 +113,61 @@ class SharedObject(object):
   def __iter__(self):
     return iter([self.path])
 
+# Compile flags that CMake handles itself, or are converted to dependencies
+CMAKE_HANDLED_FLAGS = {"-fPIC", "-fopenmp", "-shared"}
+# Link flags that are kept for the target instead of ignored
+LINK_PASSTHROUGH_FLAGS = {"-pg"}
+
+# Compiler options that take their argument as the next flag
+PAIRED_FLAGS = {"-D", "-U", "-I", "-include", "-imacros", "-isystem", "-iquote",
+  "-idirafter", "-Xclang", "-Xpreprocessor", "-Xassembler", "-x", "-arch"}
+
+def _group_flags(flags):
+  """Joins options to a separate argument, e.g. "-isystem <dir>", so that
+  each pair is filtered and deduplicated as one flag"""
+  grouped = []
+  flags = iter(flags)
+  for flag in flags:
+    if flag in PAIRED_FLAGS:
+      argument = next(flags, None)
+      if argument is not None:
+        flag = flag + " " + argument
+    grouped.append(flag)
+  return grouped
+
+def _split_flags(flags):
+  "Returns a flag list from a SCons flags variable, that may be a string"
+  if isinstance(flags, basestring):
+    return flags.split()
+  return list(itertools.chain(*(_split_flags(x) for x in flags)))
+
+def _normalise_defines(defines):
+  """Converts any of the forms SCons accepts for CPPDEFINES to a list of
+  NAME or NAME=VALUE strings"""
+  if isinstance(defines, basestring):
+    return [defines]
+  if isinstance(defines, dict):
+    defines = sorted(defines.items())
+  result = []
+  for define in defines:
+    if isinstance(define, basestring):
+      result.append(define)
+    elif len(define) == 1 or define[1] is None:
+      result.append(define[0])
+    else:
+      result.append("{}={}".format(define[0], define[1]))
+  return result
+
+def _unique(entries):
+  "Removes repeated entries from a list, keeping the first instance"
+  seen = set()
+  result = []
+  for entry in entries:
+    if not entry in seen:
+      seen.add(entry)
+      result.append(entry)
+  return result
+
 class SConsEnvironment(object):
   """Represents an object created by the scons Environment() call.
 
@@ -134,6 +190,7 @@ class SConsEnvironment(object):
     "SHLIBPREFIX": "lib",
     "LIBS": [],
     "CPPPATH": [],
+    "CPPDEFINES": [],
   }
 
   def __init__(self, emulator_environment, *args, **kwargs):
@@ -144,6 +201,13 @@ class SConsEnvironment(object):
     for key in self.kwargs:
       self._update(key)
 
+  def __getstate__(self):
+    # The emulator is only needed while reading, and holds modules that
+    # can't be pickled, e.g. to send a distribution between processes
+    state = dict(self.__dict__)
+    state["runner"] = None
+    return state
+
   def _update(self, key):
     pass
 
@@ -151,6 +215,9 @@ class SConsEnvironment(object):
     for key, val in kwargs.items():
       if isinstance(val, basestring):
         val = [val]
+      elif isinstance(val, dict):
+        # e.g. CPPDEFINES; keep the values as (key, value) pairs
+        val = sorted(val.items())
       if not key in self.kwargs:
         self.kwargs[key] = []
       self.kwargs[key].extend(val)
@@ -160,6 +227,9 @@ class SConsEnvironment(object):
     for key, val in kwargs.items():
       if isinstance(val, basestring):
         val = [val]
+      elif isinstance(val, dict):
+        # e.g. CPPDEFINES; keep the values as (key, value) pairs
+        val = sorted(val.items())
       if not key in self.kwargs:
         self.kwargs[key] = []
       self.kwargs[key][:0] = val
@@ -193,6 +263,9 @@ class SConsEnvironment(object):
   def has_key(self, key):
     return key in self.kwargs or key in self._DEFAULT_KWARGS
 
+  def __contains__(self, key):
+    return self.has_key(key)
+
   def Repository(self, path):
     self.Append(REPOSITORIES=path)
 
@@ -228,19 +301,50 @@ class SConsEnvironment(object):
     libs -= {"boost_thread", "boost_system", "m"}
     target.extra_libs = libs
 
+    # Record OpenMP use so that the target can link it, instead of dropping it
+    openmp_flags = ("CCFLAGS", "SHCCFLAGS", "CXXFLAGS", "SHCXXFLAGS", "SHLINKFLAGS")
+    target.openmp = any("-fopenmp" in target.env[x] for x in openmp_flags)
+
+    # Collect the compile flags and preprocessor definitions
+    flagvars = ["CCFLAGS", "CXXFLAGS"]
+    if targettype in {Target.Type.SHARED, Target.Type.CUDALIB}:
+      flagvars += ["SHCCFLAGS", "SHCXXFLAGS"]
+    defines = _normalise_defines(target.env["CPPDEFINES"])
+    compile_options = []
+    flags = _group_flags(itertools.chain(*(_split_flags(target.env[x]) for x in flagvars)))
+    for flag in flags:
+      if flag.startswith("-D"):
+        defines.append(flag[2:].strip())
+      elif flag.startswith("-I") or flag in CMAKE_HANDLED_FLAGS:
+        continue
+      else:
+        compile_options.append(flag)
+    target.flags.compile_options = _unique(compile_options)
+    target.flags.compile_definitions = _unique(defines)
+
     # Handle link flags
     linkflags = list(target.env["SHLINKFLAGS"])
     known_ignore_flags = {"-fopenmp", "-shared", "-rdynamic"}
     for flag in known_ignore_flags:
       while flag in linkflags:
         linkflags.remove(flag)
+    target.flags.link_options = _unique(x for x in linkflags if x in LINK_PASSTHROUGH_FLAGS)
+    linkflags = [x for x in linkflags if not x in LINK_PASSTHROUGH_FLAGS]
     assert not linkflags, "Unknown link flag: {}".format(linkflags)
     if linkflags:
       print("Unhandled link flags: ", linkflags)
 
-    # Handle include directories.
-    # import pdb
-    # pdb.set_trace()
+    # Handle include directories. Keep them all, in order, for the include scanner
+    cpppath = target.env.kwargs.get("CPPPATH", [])
+    if isinstance(cpppath, basestring):
+      cpppath = [cpppath]
+    search_paths = []
+    for path in cpppath:
+      if isinstance(path, basestring):
+        search_paths.append(path)
+      elif isinstance(path, (list, tuple)):
+        search_paths.extend(x for x in path if isinstance(x, basestring))
+    target.search_paths = _unique(search_paths)
     if "CPPPATH" in target.env.kwargs:
       # Remove things we expect
       COMMON_INCLUDES = {
@@ -299,6 +403,32 @@ class SConsEnvironment(object):
 
 
 
+class BuildFlags(object):
+  """Compile options, definitions and link options for a target or group of
+  targets. Flags that only apply to one build profile are held separately."""
+  FIELDS = ("compile_options", "compile_definitions", "link_options")
+
+  def __init__(self):
+    self.compile_options = []
+    self.compile_definitions = []
+    self.link_options = []
+    # Extra flags only used for a build profile, as {profile: BuildFlags}
+    self.profiles = {}
+
+  def profile(self, name):
+    "Returns the extra flags for a build profile, creating them if needed"
+    if not name in self.profiles:
+      self.profiles[name] = BuildFlags()
+    return self.profiles[name]
+
+  def __bool__(self):
+    return any(getattr(self, x) for x in self.FIELDS) or any(self.profiles.values())
+  __nonzero__ = __bool__
+
+def _target_type(value):
+  "Looks up a Target.Type by value, for unpickling"
+  return Target.Type(value)
+
 class Target(object):
   """Represents an output target, extracted information independent of SCons"""
   class Type(Enum):
@@ -308,6 +438,10 @@ class Target(object):
     MODULE  = "Module"
     CUDALIB = "CUDALib"
 
+    def __reduce_ex__(self, protocol):
+      # Python 2 can't find a nested class by name when unpickling
+      return _target_type, (self.value,)
+
   def __init__(self, targettype, output_name, sources):
     assert targettype in self.Type
     self.type = targettype
@@ -326,6 +460,18 @@ class Target(object):
     self.origin_path = ""
     self.module = None
     self.include_paths = set()
+    # The CPPPATH entries of the SCons environment, in search order
+    self.search_paths = []
+    # Headers to precompile, if any
+    self.precompile_headers = []
+    # Whether the target was built with -fopenmp
+    self.openmp = False
+    # Compile and link flags from the SCons environment
+    self.flags = BuildFlags()
+    # Whether the target can be built with link-time optimisation
+    self.lto = True
+    # Whether the target can be built with hidden symbol visibility
+    self.hidden_visibility = True
 
   @property
   def output_filename(self):
@@ -342,7 +488,7 @@ class Target(object):
     if self.shared_sources:
       out += "   SharedObjects: {}\n".format(self.shared_sources)
     if self.extra_libs:
-      out += "   Libs: {}\n".format(", ".join(self.extra_libs))
+      out += "   Libs: {}\n".format(", ".join(sorted(self.extra_libs)))
     out += "   Origin: {}\n".format(self.origin_path)
     if self.module:
       out += "   Module: {}\n".format(self.module)
@@ -368,8 +514,7 @@ class _fakeFile(object):
     self.data += data
 
   def read(self):
-    with no_intercept_os():
-      caller = inspect.stack()[1][3]
+    caller = inspect.stack()[1][3]
     if "csymlib.c" in self.filename or caller == "replace_printf":
       return ""
 
@@ -378,71 +523,47 @@ def _wrappedOpen(file, mode=None):
   return _fakeFile(file)
 
 
-@contextlib.contextmanager
-def no_intercept_os():
-  "Contextmanager to temporarily suspend the OS interception checks"
-  with _fake_system_env.current.suspend():
-    yield
+class _ModuleProxy(object):
+  """Stands in for a module, replacing some of its attributes"""
+  def __init__(self, module, overrides):
+    self._module = module
+    self._overrides = overrides
 
-class _undo_fake_system_env(object):
-  """Created from a fake env, context manager to suspend behaviour"""
-  def __init__(self, original):
-    self._orig = original
+  def __getattr__(self, name):
+    if name in self._overrides:
+      return self._overrides[name]
+    return getattr(self._module, name)
 
-  def __enter__(self):
-    self._orig.__exit__(None,None,None)
+class _ScopedImporter(object):
+  """Replaces __import__ for the SConscripts of one emulator, so that they
+  find its own stub modules before anything in sys.modules"""
+  def __init__(self, modules):
+    self.modules = modules
 
-  def __exit__(self, *args):
-    self._orig.__enter__()
+  def __call__(self, name, globals=None, locals=None, fromlist=(), level=0):
+    if level <= 0 and name in self.modules:
+      if fromlist:
+        return self.modules[name]
+      return self.modules[name.split(".")[0]]
+    return builtins.__import__(name, globals, locals, fromlist, level)
 
 class _fake_system_env(object):
-  current = None
+  """The os and sys functions as seen by the SConscripts of an emulator"""
   def __init__(self, env):
-    # self._os = {}
-    # self._ospath = {}
-    # self._sys = {}
     self.env = env
-    self._orig = defaultdict(dict)
-
-  _to_rewrite = {
-    os: {"mkdir", "name"},
-    os.path: {"isdir", "isfile", "exists"},
-    sys: {"platform"}
-  }
-
-  def suspend(self):
-    return _undo_fake_system_env(self)
-
-  def __enter__(self):
-    assert _fake_system_env.current is None
-    # print("Entering fake env")
-    # traceback.print_stack()
-    _fake_system_env.current = self
-    for module, names in self._to_rewrite.items():
-      for name in names:
-        self._orig[module][name] = getattr(module, name)
-        setattr(module, name, getattr(self, "_fake_{}".format(name)))
-
-    # for name in {"mkdir", "name"}:
-    #   self._os[name] = getattr(os, name)
-    #   setattr(os, name, getattr(self, "_fake_{}".format(name)))
-    
-    # for name in {"isdir", "isfile", "exists"}:
-    #   self._ospath[name] = getattr(os.path, name)
-    #   setattr(os.path, name, getattr(self, "_fake_{}".format(name)))
-
-    # for name in {"isdir", "isfile", "exists"}:
-    #   self._ospath[name] = getattr(os.path, name)
-    #   setattr(os.path, name, getattr(self, "_fake_{}".format(name)))
-
 
-  def __exit__ (self, type, value, tb):
-    # print("Exiting fake env")
-    # traceback.print_stack()
-    for module, entries in self._orig.items():
-      for name, value in entries.items():
-        setattr(module, name, value)
-    _fake_system_env.current = None
+  def proxies(self):
+    "Returns the stand-in os, os.path and sys modules"
+    path = _ModuleProxy(os.path, {
+      "isdir": self._fake_isdir,
+      "isfile": self._fake_isfile,
+      "exists": self._fake_exists,
+    })
+    return {
+      "os": _ModuleProxy(os, {"mkdir": self._fake_mkdir, "name": self._fake_name, "path": path}),
+      "os.path": path,
+      "sys": _ModuleProxy(sys, {"platform": self._fake_platform}),
+    }
 
   _fake_name = "posix"
   _fake_platform = "linux2"
@@ -472,35 +593,33 @@ class _fake_system_env(object):
     print("IS FILE: {}".format(file))
     traceback.print_stack()
 
-    with self.suspend():
-      # If given a special location, try to find it
-      if file.startswith("DISTPATH["):
-        module = file[9:file.find("]")]
-        # Find this module in our distpath
-        for repo in [".", "cctbx_project"]:
-          path = os.path.join(self.env.dist_path, repo, module)      
-          if os.path.isdir(path):
-            file = path + file[len(module)+10:]
-      elif file.startswith("DISTPATH"):
-        file = os.path.join(self.env.dist_path, file[9:])
-      print("Out: {}".format(file))
-
-      if os.path.isfile(file):
-        print("  YES")
-        return True
-      else:
-        print("  NO")
-        return False
-      return os.path.isfile(file)
+    # If given a special location, try to find it
+    if file.startswith("DISTPATH["):
+      module = file[9:file.find("]")]
+      # Find this module in our distpath
+      for repo in [".", "cctbx_project"]:
+        path = os.path.join(self.env.dist_path, repo, module)      
+        if os.path.isdir(path):
+          file = path + file[len(module)+10:]
+    elif file.startswith("DISTPATH"):
+      file = os.path.join(self.env.dist_path, file[9:])
+    print("Out: {}".format(file))
+
+    if os.path.isfile(file):
+      print("  YES")
+      return True
+    else:
+      print("  NO")
+      return False
 
 
   def _fake_exists(self, path):
     print("EXISTS: {}".format(path))
     traceback.print_stack()
-    return self._orig[os.path]["exists"](path)  
+    return os.path.exists(path)
 
 class SconsEmulator(object):
-  def __init__(self, dist):#, modules):
+  def __init__(self, dist, build_options=None, planner=None):#, modules):
     self._exports = {}
     self._current_sconscript = None
     self._current_module = None
@@ -509,8 +628,19 @@ class SconsEmulator(object):
     # self.module_map = modules
 
     self.targets = []
-
-    do_import_patching(dist)
+    # A function to read simple SConscripts without executing them, if any
+    self.planner = planner
+    # How many SConscripts were read by the planner, and how many executed
+    self.planned_count = 0
+    self.executed_count = 0
+
+    # The modules this emulator's SConscripts import in place of libtbx,
+    # SCons, os and sys; nothing is changed for the rest of the process
+    self._fake_env = _fake_system_env(self)
+    modules = make_stub_modules(dist, build_options, isdir=self._fake_env._fake_isdir)
+    modules.update(self._fake_env.proxies())
+    self._builtins = dict(vars(builtins))
+    self._builtins["__import__"] = _ScopedImporter(modules)
 
 
   def parse_module(self, module):
@@ -520,11 +650,9 @@ class SconsEmulator(object):
     if not os.path.isfile(scons):
       print("No Sconscript for module {}".format(module.name))
       return
-    print "Parsing {}".format(module.name)  
+    print("Parsing {}".format(module.name))
     
-    self._fake_env = _fake_system_env(self)
-    with self._fake_env:
-      self.parse_sconscript(scons)
+    self.parse_sconscript(scons)
 
   def sconscript_command(self, name, exports=None):
     newpath = os.path.join(os.path.dirname(self._current_sconscript), name)
@@ -532,17 +660,42 @@ class SconsEmulator(object):
     self.parse_sconscript(newpath, custom_exports=exports)
     print("Returning to sconscript {}".format(self._current_sconscript))
 
+  def _glob(self, filename, path):
+    globpath = os.path.join(os.path.dirname(filename), path)
+    # SCons returns globs sorted; the filesystem order isn't stable
+    results = sorted(glob.glob(globpath))
+    ldir = len(os.path.dirname(filename))
+    return [x[ldir+1:] for x in results]
+
   def parse_sconscript(self, filename, custom_exports=None):
+    # Handle the stack of Sconscript processing
+    prev_scons = self._current_sconscript
+    self._current_sconscript = filename
+    # Try to read the script without running it, first
+    plan = None
+    if self.planner:
+      plan = self.planner(filename, self._exports, custom_exports,
+                          lambda path: self._glob(filename, path))
+    if plan:
+      print("Read {} without executing".format(filename))
+      self.planned_count += 1
+      plan.apply(self)
+    else:
+      self.executed_count += 1
+      self._execute_sconscript(filename, custom_exports)
+    self._current_sconscript = prev_scons
+
+  def _execute_sconscript(self, filename, custom_exports=None):
     # Build the object used to run the script
     module = InjectableModule(filename)
 
     # Build the Scons injection environment
     def _env_export(*args):
-      print "Exporting", args
+      print("Exporting", args)
       for name in args:
         self._exports[name] = module.getvar(name)
     def _env_import(*args):
-      print "Importing", args
+      print("Importing", args)
       inj = {}
       for imp in args:
         if custom_exports and imp in custom_exports:
@@ -552,10 +705,7 @@ class SconsEmulator(object):
       module.inject(inj)
 
     def _env_glob(path):
-      globpath = os.path.join(os.path.dirname(filename), path)
-      results = glob.glob(globpath)
-      ldir = len(os.path.dirname(filename))
-      return [x[ldir+1:] for x in results]
+      return self._glob(filename, path)
 
     def _new_env(*args, **kwargs):
       return SConsEnvironment(self, *args, **kwargs)
@@ -572,9 +722,7 @@ class SconsEmulator(object):
     }
     # Inject this
     module.inject(inj)
-    # Handle the stack of Sconscript processing
-    prev_scons = self._current_sconscript
-    self._current_sconscript = filename
+    # Imports from the script go through this emulator's modules
+    module.inject({"__builtins__": self._builtins})
     # Now execute the script
     module.execute()
-    self._current_sconscript = prev_scons
@@ -0,0 +1,299 @@
+# coding: utf-8
+
+"""
+Reads simple SConscripts from their syntax tree, without executing them.
+
+Most SConscripts only import an environment, clone and adjust it with
+literal values, and declare libraries from it. These are recognised from
+the syntax tree and the same environment calls made directly, skipping the
+python execution with the faked modules and os functions. A script using
+anything else is run under the full emulator instead.
+"""
+
+import ast
+import itertools
+
+from .sconsemu import SConsEnvironment
+from .compat import basestring
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Environment methods that make a new environment
+CLONE_METHODS = {"Clone", "Copy"}
+# Environment methods that can be called for their effect
+CALL_METHODS = {"Append", "Prepend", "Replace", "SharedLibrary", "StaticLibrary", "Program"}
+
+_CONSTANTS = {"True": True, "False": False, "None": None}
+
+class _Unsupported(Exception):
+  "Raised when a script uses something the fast path doesn't understand"
+
+def _is_plain(value):
+  "Whether a value is plain data, that can be read without side effects"
+  if value is None or isinstance(value, (basestring, bool, int, float)):
+    return True
+  if isinstance(value, (list, tuple)):
+    return all(_is_plain(x) for x in value)
+  if isinstance(value, dict):
+    return all(_is_plain(x) and _is_plain(y) for x, y in value.items())
+  return False
+
+def _is_string(node):
+  "Whether an expression is a string literal"
+  if type(node).__name__ == "Constant":
+    return isinstance(node.value, basestring)
+  return type(node).__name__ == "Str"
+
+def _subscript_index(node):
+  "The index expression of a subscript; older pythons wrap it in an Index"
+  if type(node.slice).__name__ == "Index":
+    return node.slice.value
+  return node.slice
+
+class SConscriptPlan(object):
+  """The environment calls that a simple SConscript makes, in order.
+
+  Actions are tuples of:
+    ("clone",     name, environment name, method, kwargs)
+    ("call",      environment name, method, args, kwargs)
+    ("setitem",   environment name, key, value)
+    ("sconscript", filename)
+  """
+  def __init__(self, filename, imported):
+    self.filename = filename
+    self.imported = imported
+    self.actions = []
+
+  def apply(self, runner):
+    "Makes the planned calls, creating targets in the runner"
+    names = dict(self.imported)
+    for action in self.actions:
+      if action[0] == "clone":
+        _, name, source, method, kwargs = action
+        names[name] = getattr(names[source], method)(**kwargs)
+      elif action[0] == "call":
+        _, source, method, args, kwargs = action
+        getattr(names[source], method)(*args, **kwargs)
+      elif action[0] == "setitem":
+        _, source, key, value = action
+        names[source][key] = value
+      elif action[0] == "sconscript":
+        runner.sconscript_command(action[1])
+
+class _Planner(object):
+  """Walks the statements of a script, resolving every name and value"""
+  def __init__(self, filename, exports, custom_exports, glob):
+    self.plan = SConscriptPlan(filename, {})
+    self.exports = exports
+    self.custom_exports = custom_exports or {}
+    self.glob = glob
+    # Names bound to environments, to other imported objects, and to data
+    self.environments = set()
+    self.objects = {}
+    self.data = {}
+
+  def _bound(self, name):
+    return name in self.environments or name in self.objects or name in self.data
+
+  def _unbind(self, name):
+    self.environments.discard(name)
+    self.objects.pop(name, None)
+    self.data.pop(name, None)
+
+  def value(self, node):
+    "Evaluates an expression that must result in plain data"
+    if isinstance(node, ast.Name):
+      if node.id in self.data:
+        return self.data[node.id]
+      if node.id in _CONSTANTS and not self._bound(node.id):
+        return _CONSTANTS[node.id]
+      raise _Unsupported("name {}".format(node.id))
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+      if not node.value.id in self.objects:
+        raise _Unsupported("attribute of {}".format(node.value.id))
+      # Attributes are read now, so a SConscript called before the read
+      # could change them after planning
+      if any(x[0] == "sconscript" for x in self.plan.actions):
+        raise _Unsupported("attribute {}.{} after SConscript".format(node.value.id, node.attr))
+      if not hasattr(self.objects[node.value.id], node.attr):
+        raise _Unsupported("missing attribute {}.{}".format(node.value.id, node.attr))
+      value = getattr(self.objects[node.value.id], node.attr)
+      if not _is_plain(value):
+        raise _Unsupported("attribute {}.{}".format(node.value.id, node.attr))
+      return value
+    if isinstance(node, (ast.List, ast.Tuple)):
+      values = [self.value(x) for x in node.elts]
+      return values if isinstance(node, ast.List) else tuple(values)
+    if isinstance(node, ast.Dict):
+      return {self.value(x): self.value(y) for x, y in zip(node.keys, node.values)}
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+      return self.value(node.left) + self.value(node.right)
+    if isinstance(node, ast.Call) and self._is_function(node, "Glob"):
+      args, kwargs = self.arguments(node)
+      if kwargs or len(args) != 1 or not isinstance(args[0], basestring):
+        raise _Unsupported("Glob arguments")
+      return self.glob(args[0])
+    try:
+      return ast.literal_eval(node)
+    except ValueError:
+      raise _Unsupported(type(node).__name__)
+
+  def arguments(self, node):
+    "Evaluates the positional and keyword arguments of a call"
+    if getattr(node, "starargs", None) or getattr(node, "kwargs", None):
+      raise _Unsupported("argument unpacking")
+    if any(type(x).__name__ == "Starred" for x in node.args):
+      raise _Unsupported("argument unpacking")
+    if any(x.arg is None for x in node.keywords):
+      raise _Unsupported("argument unpacking")
+    return [self.value(x) for x in node.args], {x.arg: self.value(x.value) for x in node.keywords}
+
+  def _is_function(self, node, name):
+    "Whether a call is to one of the SCons global functions"
+    return (isinstance(node.func, ast.Name) and node.func.id == name
+      and not self._bound(name))
+
+  def _environment_call(self, node, methods):
+    "Splits a call of an environment method into the name and method"
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)):
+      return None
+    if not node.func.value.id in self.environments or not node.func.attr in methods:
+      return None
+    return node.func.value.id, node.func.attr
+
+  def statement(self, node):
+    "Adds the actions for one top-level statement"
+    if isinstance(node, ast.Pass):
+      return
+    if isinstance(node, ast.Expr):
+      call = node.value
+      if _is_string(call):
+        # A docstring
+        return
+      if isinstance(call, ast.Call) and self._is_function(call, "Import"):
+        return self.import_names(call)
+      if isinstance(call, ast.Call) and self._is_function(call, "SConscript"):
+        args, kwargs = self.arguments(call)
+        if kwargs or len(args) != 1 or not isinstance(args[0], basestring):
+          raise _Unsupported("SConscript arguments")
+        self.plan.actions.append(("sconscript", args[0]))
+        return
+      method = self._environment_call(call, CALL_METHODS)
+      if method:
+        args, kwargs = self.arguments(call)
+        self.plan.actions.append(("call",) + method + (args, kwargs))
+        return
+    if isinstance(node, ast.Assign) and len(node.targets) == 1:
+      target = node.targets[0]
+      if isinstance(target, ast.Name):
+        method = self._environment_call(node.value, CLONE_METHODS)
+        if method:
+          args, kwargs = self.arguments(node.value)
+          if args:
+            raise _Unsupported("positional Clone arguments")
+          self._unbind(target.id)
+          self.environments.add(target.id)
+          self.plan.actions.append(("clone", target.id) + method + (kwargs,))
+          return
+        value = self.value(node.value)
+        self._unbind(target.id)
+        self.data[target.id] = value
+        return
+      if (isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name)
+          and target.value.id in self.environments):
+        self.plan.actions.append(("setitem", target.value.id,
+          self.value(_subscript_index(target)), self.value(node.value)))
+        return
+    raise _Unsupported("{} statement on line {}".format(type(node).__name__, node.lineno))
+
+  def import_names(self, call):
+    "Binds the names from an Import call to the exported objects"
+    args, kwargs = self.arguments(call)
+    if kwargs:
+      raise _Unsupported("Import keywords")
+    for name in args:
+      if name in self.custom_exports:
+        value = self.custom_exports[name]
+      elif name in self.exports:
+        value = self.exports[name]
+      else:
+        raise _Unsupported("unknown export {}".format(name))
+      self._unbind(name)
+      self.plan.imported[name] = value
+      if isinstance(value, SConsEnvironment):
+        self.environments.add(name)
+      else:
+        self.objects[name] = value
+
+def plan_sconscript(filename, exports, custom_exports=None, glob=None):
+  """Works out the environment calls made by a simple SConscript.
+
+  :param filename:       The SConscript to read
+  :param exports:        The objects exported by previously read SConscripts
+  :param custom_exports: Exports passed explicitly to this SConscript
+  :param glob:           A function to evaluate Glob patterns with
+  :returns: A SConscriptPlan, or None if the script has to be executed
+  """
+  with open(filename) as f:
+    text = f.read()
+  try:
+    tree = ast.parse(text, filename)
+  except SyntaxError:
+    return None
+  planner = _Planner(filename, exports, custom_exports, glob)
+  try:
+    for node in tree.body:
+      planner.statement(node)
+  except _Unsupported as e:
+    logger.debug("Executing {}: unsupported {}".format(filename, e))
+    return None
+  return planner.plan
+
+def describe_target(target):
+  "The emulated properties of a target, for comparing between emulations"
+  return {
+    "type": target.type.value,
+    "output": (target.output_path, target.filename, target.prefix),
+    "sources": list(target.sources),
+    "shared_sources": [x.path for x in target.shared_sources],
+    "extra_libs": sorted(target.extra_libs),
+    "openmp": target.openmp,
+    "flags": [getattr(target.flags, x) for x in target.flags.FIELDS],
+  }
+
+def compare_targets(reference, fast):
+  """Compares the targets found by two emulations of a distribution.
+
+  :param reference: Targets found by executing every SConscript
+  :param fast:      Targets found using the fast path
+  :returns: A sorted list of (target key, property, reference, fast) differences
+  """
+  def _key(target):
+    return (target.module.name, target.origin_path, target.name)
+  reference = {_key(x): describe_target(x) for x in reference}
+  fast = {_key(x): describe_target(x) for x in fast}
+  differences = []
+  for key in sorted(set(reference) | set(fast)):
+    if not key in fast or not key in reference:
+      differences.append((key, "present", key in reference, key in fast))
+      continue
+    for name in sorted(reference[key]):
+      if reference[key][name] != fast[key][name]:
+        differences.append((key, name, reference[key][name], fast[key][name]))
+  return differences
+
+def format_verification(differences, static_count, executed_count):
+  "Formats the result of verifying the fast path as a human-readable report"
+  lines = ["{} of {} SConscripts were read without executing them".format(
+    static_count, static_count + executed_count)]
+  if not differences:
+    lines.append("Targets are identical to full emulation")
+  else:
+    lines.append("{} target properties differ from full emulation:".format(len(differences)))
+    for key, name, reference, fast in differences:
+      lines.append("  {} {}".format(":".join(key[1:]), name))
+      lines.append("    emulated:  {}".format(reference))
+      lines.append("    fast path: {}".format(fast))
+  return "\n".join(lines)
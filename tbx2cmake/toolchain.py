@@ -0,0 +1,113 @@
+# coding: utf-8
+
+"""
+Works out compiler command lines for targets directly from a TBXDistribution,
+for the backends that don't go through CMake.
+"""
+
+import os
+
+from .sconsemu import Target
+
+# Source extensions compiled with the C compiler, rather than C++
+C_EXTENSIONS = {".c"}
+
+class Toolchain(object):
+  """The compilers and extra settings used to build a distribution"""
+  # The C and C++ compilers to run
+  cc = "cc"
+  cxx = "c++"
+  # Extra include directories, e.g. for boost and python
+  include_dirs = []
+  # A build profile to add the per-profile flags of, if any
+  profile = None
+
+def source_paths(tbx, target, build_dir):
+  """Generates the absolute path of every source of a target.
+
+  Generated sources are resolved to their location in the build directory.
+  """
+  for source in target.sources:
+    yield os.path.normpath(os.path.join(os.path.abspath(tbx.module_path), target.origin_path, source))
+  for source in sorted(target.generated_sources):
+    yield os.path.normpath(os.path.join(os.path.abspath(build_dir), source))
+
+def object_path(tbx, target, source, build_dir):
+  "The object file a source of a target is compiled to, in the build directory"
+  build_dir = os.path.abspath(build_dir)
+  if source.startswith(build_dir + os.sep):
+    name = os.path.join("generated", os.path.relpath(source, build_dir))
+  else:
+    origin = os.path.join(os.path.abspath(tbx.module_path), target.origin_path)
+    name = os.path.relpath(source, origin).replace("..", "__")
+  return os.path.join(build_dir, target.origin_path, target.name + ".dir", name + ".o")
+
+def _expand_include_path(tbx, target, path, build_dir):
+  "Resolves a target include path to an absolute directory"
+  path = path.lstrip("!")
+  if path.startswith("#base"):
+    return os.path.normpath(os.path.abspath(tbx.module_path) + path[len("#base"):])
+  elif path.startswith("#build"):
+    return os.path.normpath(os.path.abspath(build_dir) + path[len("#build"):])
+  return os.path.normpath(os.path.join(os.path.abspath(tbx.module_path), target.origin_path, path))
+
+def include_directories(tbx, target, build_dir, toolchain):
+  """Works out the include directories used to compile a target.
+
+  These are the target's own include paths, followed by those of its module,
+  the directories containing every module (as libtbx uses), the build
+  directory for generated headers, and any extra toolchain directories.
+  """
+  dirs = [_expand_include_path(tbx, target, x, build_dir) for x in sorted(target.include_paths)]
+  if target.module:
+    dirs += [_expand_include_path(tbx, target, x, build_dir) for x in sorted(target.module.include_paths)]
+  module_root = os.path.abspath(tbx.module_path)
+  dirs += sorted({os.path.dirname(os.path.join(module_root, x.path)) for x in tbx.modules.values()})
+  dirs += [os.path.abspath(build_dir), os.path.join(os.path.abspath(build_dir), "include")]
+  dirs += list(toolchain.include_dirs)
+  unique = []
+  for path in dirs:
+    if not path in unique:
+      unique.append(path)
+  return unique
+
+def target_arguments(tbx, target, build_dir, toolchain):
+  """Returns the compiler arguments shared by every source of a target.
+
+  :param tbx:       The TBXDistribution the target belongs to
+  :param target:    The target being built
+  :param build_dir: The build directory that objects are written to
+  :param toolchain: A Toolchain object
+  """
+  options = list(target.flags.compile_options)
+  definitions = list(target.flags.compile_definitions)
+  if toolchain.profile and toolchain.profile in target.flags.profiles:
+    options += target.flags.profiles[toolchain.profile].compile_options
+    definitions += target.flags.profiles[toolchain.profile].compile_definitions
+
+  arguments = []
+  # Static libraries are linked into the shared ones, so need PIC as well
+  if target.type in {Target.Type.SHARED, Target.Type.MODULE, Target.Type.STATIC}:
+    arguments.append("-fPIC")
+  if target.openmp:
+    arguments.append("-fopenmp")
+  # Options paired with an argument are kept together as one flag
+  arguments += [x for option in options for x in option.split()]
+  arguments += ["-D" + x for x in definitions]
+  arguments += ["-I" + x for x in include_directories(tbx, target, build_dir, toolchain)]
+  return arguments
+
+def compiler_for(source, toolchain):
+  "The compiler to build a source with"
+  if os.path.splitext(source)[1] in C_EXTENSIONS:
+    return toolchain.cc
+  return toolchain.cxx
+
+def compile_arguments(tbx, target, source, build_dir, toolchain, arguments):
+  """Returns the full command line to compile one source of a target.
+
+  :param source:    The absolute path of the source, from source_paths
+  :param arguments: The shared target arguments, from target_arguments
+  """
+  return ([compiler_for(source, toolchain)] + arguments
+    + ["-c", source, "-o", object_path(tbx, target, source, build_dir)])
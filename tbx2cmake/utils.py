@@ -1,8 +1,16 @@
 # coding: utf-8
 
 import os
-import imp
+import sys
+import heapq
+import threading
 import contextlib
+from types import ModuleType
+
+from .compat import PY2, PYTHON2_BUILTINS, python3_source
+
+import logging
+logger = logging.getLogger(__name__)
 
 class AttrDict(dict):
   """Object that can access dictionary elements as keys or attributes"""
@@ -16,6 +24,24 @@ def return_as_list(f):
     return list(f(*args, **kwargs))
   return _wrap
 
+def topological_order(G, reverse=False):
+  """Sorts the nodes of a directed acyclic graph so that every node comes
+  before its successors, breaking ties by the node name so the order is
+  stable. With reverse, every node comes after its successors instead."""
+  if reverse:
+    G = G.reverse()
+  remaining = {x: G.in_degree(x) for x in G.nodes()}
+  ready = sorted(x for x, count in remaining.items() if not count)
+  order = []
+  while ready:
+    node = heapq.heappop(ready)
+    order.append(node)
+    for successor in G.successors(node):
+      remaining[successor] -= 1
+      if not remaining[successor]:
+        heapq.heappush(ready, successor)
+  return order
+
 def fully_split_path(path):
   "Splits a path until there is nothing left to split"
   parts = []
@@ -28,6 +54,48 @@ def fully_split_path(path):
     parts.insert(0, head)
   return parts
 
+# Scripts converted for the current interpreter by source, and compiled by
+# path and source. Shared by every emulator in the process, and by worker
+# processes forked after they are filled.
+_converted_sources = {}
+_compiled_scripts = {}
+_compiled_lock = threading.Lock()
+
+def _converted_source(text, filename):
+  "Converts a script for the current interpreter, reusing earlier results"
+  with _compiled_lock:
+    if text in _converted_sources:
+      return _converted_sources[text]
+  source = python3_source(text, filename)
+  with _compiled_lock:
+    _converted_sources[text] = source
+  return source
+
+def _compile_script(module_path):
+  "Compiles a script for the current interpreter, reusing earlier results"
+  with open(module_path) as f:
+    text = f.read()
+  key = (str(module_path), text)
+  with _compiled_lock:
+    if key in _compiled_scripts:
+      return _compiled_scripts[key]
+  bytecode = compile(_converted_source(text, str(module_path)), str(module_path), "exec")
+  with _compiled_lock:
+    _compiled_scripts[key] = bytecode
+  return bytecode
+
+def convert_scripts(paths):
+  """Converts scripts for the current interpreter ahead of running them, so
+  that processes forked afterwards don't each convert the same sources.
+  Scripts that fail to convert are left to fail when they are run."""
+  for path in paths:
+    with open(path) as f:
+      text = f.read()
+    try:
+      _converted_source(text, str(path))
+    except Exception as e:
+      logger.debug("Not converting {} ahead of running it: {}".format(path, e))
+
 class InjectableModule(object):
   """Load and run a python script with an injected globals dictionary.
   This is to emulate what it appears libtbx/scons does to run refresh scripts.
@@ -36,10 +104,11 @@ class InjectableModule(object):
   def __init__(self, module_path):
     path, module_filename = os.path.split(module_path)
     module_name, ext = os.path.splitext(module_filename)
-    module = imp.new_module(module_name)
+    module = ModuleType(module_name)
     module.__file__ = module_path
-    with open(module_path) as f:
-      self.bytecode = compile(f.read(), str(module_path), "exec")
+    if not PY2:
+      vars(module).update(PYTHON2_BUILTINS)
+    self.bytecode = _compile_script(module_path)
     self.module = module
 
   def inject(self, globals):
@@ -59,3 +128,18 @@ def monkeypatched(object, name, patch):
   setattr(object, name, patch)
   yield object
   setattr(object, name, pre_patched_value)
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+  """Sends anything printed to stderr, e.g. to keep the emulator output out
+  of a result written to stdout.
+
+  This replaces sys.stdout for the whole process, so it is not thread-safe:
+  output from other threads is redirected too, and nested or overlapping
+  uses from different threads can restore the wrong stream."""
+  stdout = sys.stdout
+  sys.stdout = sys.stderr
+  try:
+    yield
+  finally:
+    sys.stdout = stdout
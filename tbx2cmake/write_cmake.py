@@ -7,19 +7,130 @@ No root CMakeLists.txt will be created. Instead, an autogen-CMakeLists.txt
 file will be created in the root directory that can be included by the root
 CMakeLists.txt. Writing of this root may be added later.
 
-Usage: tbx2cmake <module_dir> <autogen.yaml> <output_dir>
+Usage: tbx2cmake [options] <module_dir> <autogen.yaml> <output_dir>
+       tbx2cmake --analyze [options] <module_dir> <autogen.yaml>
+       tbx2cmake --size-report <build_dir> <baseline_dir>
+       tbx2cmake --check-cache [options] <module_dir> <autogen.yaml>
+       tbx2cmake --unused-deps <build_dir>
+       tbx2cmake --check-deterministic [options] <module_dir> <autogen.yaml>
+       tbx2cmake --verify-fast-path [options] <module_dir>
+       tbx2cmake --benchmark [options] <module_dir> <autogen.yaml>
+
+Options:
+  --analyze           Estimate the cost of building each target and report
+                      the critical path and parallelism, instead of writing
+                      CMake files
+  --split-dwarf       Compile with -gsplit-dwarf, to keep debug information
+                      out of the objects and speed up linking
+  --linker=<linker>   Link with an alternative linker, if it is available at
+                      configure time. One of lld, mold, gold
+  --gdb-index         Have the linker build a .gdb_index section
+  --pgo               Add PGOInstrument and PGOOptimize build types, for
+                      profile-guided optimisation. These are based on the
+                      release profile, which is emulated if not listed
+  --lto               Use link-time optimisation for optimised builds, where
+                      the toolchain supports it. Targets can be excluded by
+                      listing them under lto_exclude in the autogen.yaml
+  --lto-jobs=<jobs>   The number of parallel LTO jobs to link with
+                      [default: auto]
+  --static-libraries  Build internal shared libraries as static libraries,
+                      linked into each python extension module, so that
+                      importing loads fewer libraries
+  --hidden-visibility
+                      Build libraries with hidden symbol visibility, and
+                      put functions and data in separate sections so that
+                      the linker can drop unused ones. Shared libraries that
+                      other targets link against keep their symbols visible
+                      unless listed under export_annotated in autogen.yaml
+  --compiler-launcher=<launcher>
+                      Compile through a caching launcher (e.g. ccache or
+                      sccache), if it is found at configure time, and run
+                      each libtbx_refresh.py from the build directory with
+                      relative paths, through TBX_REFRESH_RUNNER if it is set
+  --check-cache       List the targets whose compile commands have absolute
+                      or per-build paths that would stop a compiler cache
+                      from sharing results between builds
+  --origin-rpath      Put the libraries built into #/lib into one directory,
+                      finding each other through an $ORIGIN-relative RPATH,
+                      and only record the libraries that are actually used
+                      (--as-needed)
+  --unused-deps       List the unused direct dependencies of every library
+                      in a build directory, instead of writing CMake files
+  --refresh-cache     Keep the sources generated by each libtbx_refresh.py
+                      in a cache shared between build directories, keyed
+                      by the module path and the hash of the refresh
+                      inputs, and restore them instead of running the
+                      refresh. Needs TBX_REFRESH_RUNNER to be set
+  --flat              Write the whole distribution into the one
+                      autogen_CMakeLists.txt, with explicit source paths,
+                      instead of a CMakeLists.txt for every directory
+  --compare-configure
+                      After writing, configure both the flat and directory
+                      layouts with stand-in dependencies, and compare the
+                      targets and the time taken to configure them
+  --check-deterministic
+                      Generate the output twice, with different python hash
+                      seeds, and fail if the files written differ
+  --size-report       Compare the sizes of the libraries in two build
+                      directories, instead of writing CMake files
+  --verify-fast-path  Read the SConscripts both with and without executing
+                      the simple ones, and fail if the targets differ
+  --benchmark         Time reading the distribution and generating the
+                      CMake files, instead of writing them
+  --repeat=<n>        How many times to repeat each benchmark [default: 3]
+  --interpreters=<list>
+                      Also benchmark with each of a comma-separated list of
+                      python interpreters, for comparison
+  --profiles=<names>  Emulate the SConscripts once for each of a comma-
+                      separated list of build profiles (release, debug,
+                      profile), and write the flags that differ as flags
+                      for the matching CMake build types
+  --only=<modules>    Only convert a comma-separated list of modules, and
+                      the modules that they require in their libtbx_config
+  --scan-includes     Scan the #include directives of every target's
+                      sources, and add the include directories found to be
+                      needed to the target as private include directories,
+                      instead of relying only on target_includes in the
+                      autogen.yaml
+  --include-cache=<file>
+                      Keep the scanned #include directives in a file, to
+                      only rescan changed files on the next run
+  --precompile-headers
+                      Scan includes, and precompile the expensive external
+                      headers that most sources of a target include. The
+                      include paths are only changed with --scan-includes
+  --pipeline-report   Report how many targets each rule of the pipeline,
+                      configured under pipeline in the autogen.yaml,
+                      matched and the time it took
 """
 
 import sys
 import os
+import re
 import logging
+import filecmp
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
 
 from docopt import docopt
 import yaml
 
 from .utils import fully_split_path 
-from .read_scons import read_distribution
-from .sconsemu import Target
+from .compat import basestring
+from .read_scons import read_distribution, unknown_modules, verify_fast_path
+from .sconsemu import Target, BuildFlags
+from .import_env import BUILD_PROFILES
+from .analyze import analyze_build, format_report, format_import_report
+from .analyze import binary_sizes, format_size_report, format_cache_report
+from .analyze import format_unused_report
+from .compare import compare_layouts, format_comparison
+from .static_scons import format_verification
+from .include_scan import IncludeCache, scan_includes, add_include_paths
+from .include_scan import select_precompiled_headers
+from .pipeline import Pipeline, format_pipeline_report
 
 logger = logging.getLogger()
 
@@ -40,17 +151,77 @@ OPTIONAL_DEPENDS = {
   "boost_thread", "GL", "GLU"
 }
 
+# Alternative linkers that can be requested, and the flag to select them
+LINKERS = {
+  "lld": "-fuse-ld=lld",
+  "mold": "-fuse-ld=mold",
+  "gold": "-fuse-ld=gold",
+}
+
+# CMake build types for each of the emulated build profiles
+PROFILE_BUILD_TYPES = {
+  "release": "Release",
+  "debug": "Debug",
+  "profile": "Profile",
+}
+
+# Optimisation and debug flags, which the CMake build type sets instead
+BUILD_TYPE_FLAG_RE = re.compile(r"-(O|g)")
+BUILD_TYPE_DEFINITIONS = {"NDEBUG"}
+
+# Build types added for profile-guided optimisation
+PGO_BUILD_TYPES = ["PGOInstrument", "PGOOptimize"]
+
+class GenerationOptions(object):
+  """Options controlling the extra build settings written to the CMake output"""
+  # Write debug information to separate .dwo files instead of the objects
+  split_dwarf = False
+  # Name of an alternative linker from LINKERS, if any
+  linker = None
+  # Have the linker build a .gdb_index section for faster debugger startup
+  gdb_index = False
+  # Build profiles emulated separately, with differing flags written per type
+  profiles = []
+  # Add build types for profile-guided optimisation
+  pgo = False
+  # Build optimised builds with link-time optimisation, and the number of
+  # parallel LTO jobs to use ("auto" to let the toolchain decide)
+  lto = False
+  lto_jobs = "auto"
+  # Build internal shared libraries as static, position-independent code,
+  # so that each extension module links as one self-contained library
+  static_libraries = False
+  # Hide symbols that aren't explicitly exported, and drop unused sections
+  hidden_visibility = False
+  # A compiler cache to launch compilers with, if found at configure time
+  compiler_launcher = None
+  # Collect the #/lib outputs, find each other relative to $ORIGIN, and
+  # only link libraries that are actually used
+  origin_rpath = False
+  # Share refresh-generated sources between build directories
+  refresh_cache = False
+  # Write the whole distribution into one file, instead of one per directory
+  flat = False
+  # Precompile the headers chosen for each target
+  precompile_headers = False
+
+# Target types that are written out as CMake libraries
+LIBRARY_TYPES = {Target.Type.SHARED, Target.Type.STATIC, Target.Type.MODULE}
+
 class CMakeLists(object):
   "Represents a single CMakeLists file. Keeps track of subdirectories."
   
-  def __init__(self, path="", parent=None):
+  def __init__(self, path="", parent=None, options=None):
     self.path = path
     self.subdirectories = {}
     self.parent = parent
+    self._options = options or GenerationOptions()
 
     self.is_module_root = False
     self.targets = []
     self._module = None
+    # Compile and link flags applied to this directory and below
+    self.flags = BuildFlags()
 
   def get_path(self, path):
     "Returns a CMakeLists object for a specific subpath"
@@ -90,7 +261,7 @@ class CMakeLists(object):
 
   def all(self):
     yield self
-    for child in self.subdirectories.values():
+    for child in sorted(self.subdirectories.values(), key=lambda x: x.path):
       for result in child.all():
         yield result
 
@@ -101,6 +272,20 @@ class CMakeLists(object):
     else:
       return self.path
 
+  @property
+  def source_dir(self):
+    "How the written CMake refers to the source directory of this node"
+    if self.options.flat:
+      return "/".join(["${CMAKE_SOURCE_DIR}"] + fully_split_path(self.full_path))
+    return "${CMAKE_CURRENT_SOURCE_DIR}"
+
+  @property
+  def options(self):
+    "The GenerationOptions for the tree this CMakeLists belongs to"
+    if self.parent:
+      return self.parent.options
+    return self._options
+
   @property
   def module(self):
     if self._module:
@@ -114,8 +299,44 @@ class CMakeLists(object):
     return "<CMakeLists {}>".format(self.full_path)
 
   def generate_cmakelist(self):
+    if self.options.flat:
+      assert not self.parent, "Flat output is only written from the root"
+      sections = []
+      for cml in self.all():
+        text = "\n\n".join(x for x in (str(x) for x in cml.blocks()) if x)
+        if text and cml.parent:
+          text = "# {}\n{}".format(cml.full_path, text)
+        if text:
+          sections.append(text)
+      return "\n\n".join(sections) + "\n"
+    return "\n\n".join(x for x in (str(x) for x in self.blocks()) if x) + "\n"
+
+  def write(self, output_dir):
+    """Writes the CMake files for this tree into a directory.
+
+    :returns: The number of files written
+    """
+    cmls = list(self.all())
+    if self.options.flat:
+      cmls = [self]
+    for cml in cmls:
+      path = os.path.join(output_dir, cml.full_path)
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      filename = "CMakeLists.txt"
+      if cml is self:
+        filename = "autogen_CMakeLists.txt"
+      with open(os.path.join(path, filename), "w") as f:
+        f.write(cml.generate_cmakelist())
+    return len(cmls)
+
+  def blocks(self):
+    "The blocks that this node of the tree writes"
     blocks = []
 
+    if not self.parent:
+      blocks.append(CMLBuildOptionsBlock(self))
+
     if self.is_module_root:
       blocks.append(CMLModuleRootBlock(self))
 
@@ -124,20 +345,138 @@ class CMakeLists(object):
         if target.name == self.module.name:
           # Handled separately
           continue
-        if target.type in {Target.Type.SHARED, Target.Type.STATIC, Target.Type.MODULE}:
-          blocks.append(CMLLibraryOutput(target))
+        if target.type in LIBRARY_TYPES:
+          blocks.append(CMLLibraryOutput(target, self.options, self))
         else:
           print("Not handling {} yet".format(target.type))
 
-    if self.subdirectories:
+    if self.subdirectories and not self.options.flat:
       blocks.append(CMLSubDirBlock(self))
 
-    return "\n\n".join(str(x) for x in blocks) + "\n"
+    return blocks
 
 class CMakeListBlock(object):
   def __init__(self, cmakelist):
     self.cml = cmakelist
 
+class CMLBuildOptionsBlock(CMakeListBlock):
+  """Distribution-wide build settings, written before any subdirectories so
+  that every target picks them up"""
+  def __str__(self):
+    options = self.cml.options
+    lines = _directory_flag_lines(self.cml.flags, options, profiles=False)
+    if options.profiles:
+      if lines:
+        lines.append("")
+      lines.extend(_build_type_lines(self.cml.flags, options))
+
+    if any(target.openmp for cml in self.cml.all() for target in cml.targets):
+      if lines:
+        lines.append("")
+      lines.append("find_package(OpenMP)")
+
+    if options.static_libraries:
+      if lines:
+        lines.append("")
+      lines.append("# Internal libraries are static, and linked into the extension modules")
+      lines.append("set(CMAKE_POSITION_INDEPENDENT_CODE ON)")
+
+    if options.pgo:
+      if lines:
+        lines.append("")
+      lines.extend(_pgo_lines())
+
+    if options.lto:
+      if lines:
+        lines.append("")
+      lines.extend(_lto_lines(options))
+
+    if options.compiler_launcher:
+      if lines:
+        lines.append("")
+      lines.extend(_compiler_launcher_lines(options))
+
+    if options.compiler_launcher or options.refresh_cache:
+      if lines:
+        lines.append("")
+      lines.extend(_refresh_command_lines(options))
+
+    if options.split_dwarf:
+      if lines:
+        lines.append("")
+      lines.append("# Keep debug information out of the objects to speed up linking, in the")
+      lines.append("# build types that have debug information")
+      lines.append("include(CheckCXXCompilerFlag)")
+      lines.append("check_cxx_compiler_flag(-gsplit-dwarf TBX_HAVE_SPLIT_DWARF)")
+      lines.append("if(TBX_HAVE_SPLIT_DWARF)")
+      condition = _build_types_condition(_debug_build_types(options))
+      lines.append("  add_compile_options($<{}:-gsplit-dwarf>)".format(condition))
+      lines.append("endif()")
+
+    if options.linker or options.gdb_index:
+      if lines:
+        lines.append("")
+      lines.append("include(CheckCXXSourceCompiles)")
+
+    if options.linker:
+      flag = LINKERS[options.linker]
+      variable = "TBX_HAVE_LINKER_{}".format(options.linker.upper())
+      lines.append("# Use the {} linker, if the compiler can use it".format(options.linker))
+      lines.append("set(CMAKE_REQUIRED_LINK_OPTIONS {})".format(flag))
+      lines.append('check_cxx_source_compiles("int main() { return 0; }" ' + variable + ")")
+      lines.append("unset(CMAKE_REQUIRED_LINK_OPTIONS)")
+      lines.append("if({})".format(variable))
+      lines.append("  add_link_options({})".format(flag))
+      lines.append("  set(TBX_LINKER_FLAG {})".format(flag))
+      lines.append("else()")
+      lines.append('  message(WARNING "Linker {} not available; using the default linker")'.format(options.linker))
+      lines.append("endif()")
+
+    if options.gdb_index:
+      lines.append("# Pre-build the debugger symbol index at link time")
+      lines.append("set(CMAKE_REQUIRED_LINK_OPTIONS ${TBX_LINKER_FLAG} -Wl,--gdb-index)")
+      lines.append('check_cxx_source_compiles("int main() { return 0; }" TBX_HAVE_GDB_INDEX)')
+      lines.append("unset(CMAKE_REQUIRED_LINK_OPTIONS)")
+      lines.append("if(TBX_HAVE_GDB_INDEX)")
+      lines.append("  add_link_options(-Wl,--gdb-index)")
+      lines.append("else()")
+      lines.append('  message(WARNING "Linker does not support --gdb-index; not building index")')
+      lines.append("endif()")
+
+    if options.origin_rpath:
+      if lines:
+        lines.append("")
+      lines.append("# Libraries built into #/lib share a directory, and find each other relative to it")
+      lines.append('set(TBX_LIBRARY_DIR "${CMAKE_BINARY_DIR}/lib" CACHE PATH "Output directory for the libraries built into #/lib")')
+      lines.append("if(APPLE)")
+      lines.append("  set(TBX_ORIGIN @loader_path)")
+      lines.append("else()")
+      lines.append("  set(TBX_ORIGIN $ORIGIN)")
+      lines.append("endif()")
+      lines.append("# Only record the libraries that are actually used")
+      lines.append("include(CheckCXXSourceCompiles)")
+      lines.append("set(CMAKE_REQUIRED_LINK_OPTIONS ${TBX_LINKER_FLAG} -Wl,--as-needed)")
+      lines.append('check_cxx_source_compiles("int main() { return 0; }" TBX_HAVE_AS_NEEDED)')
+      lines.append("unset(CMAKE_REQUIRED_LINK_OPTIONS)")
+      lines.append("if(TBX_HAVE_AS_NEEDED)")
+      lines.append("  add_link_options(-Wl,--as-needed)")
+      lines.append("endif()")
+
+    if options.hidden_visibility:
+      if lines:
+        lines.append("")
+      lines.append("# Put functions and data in their own sections, so the linker can drop unused ones")
+      lines.append("include(CheckCXXSourceCompiles)")
+      lines.append("set(CMAKE_REQUIRED_LINK_OPTIONS ${TBX_LINKER_FLAG} -Wl,--gc-sections)")
+      lines.append('check_cxx_source_compiles("int main() { return 0; }" TBX_HAVE_GC_SECTIONS)')
+      lines.append("unset(CMAKE_REQUIRED_LINK_OPTIONS)")
+      lines.append("if(TBX_HAVE_GC_SECTIONS)")
+      lines.append("  add_compile_options(-ffunction-sections -fdata-sections)")
+      lines.append("  add_link_options(-Wl,--gc-sections)")
+      lines.append("endif()")
+
+    return "\n".join(lines)
+
 class CMLSubDirBlock(CMakeListBlock):
   def __str__(self):
     lines = []
@@ -145,47 +484,60 @@ class CMLSubDirBlock(CMakeListBlock):
       lines.append("add_subdirectory({})".format(subdir))
     return "\n".join(lines)
 
-def _expand_include_path(path):
+def _expand_include_path(path, source_dir="${CMAKE_CURRENT_SOURCE_DIR}"):
   assert not path.startswith("!")
   if path.startswith("#base"):
     path = path.replace("#base", "${CMAKE_SOURCE_DIR}")
   elif path.startswith("#build"):
     path = path.replace("#build", "${CMAKE_BINARY_DIR}")
   else:
-    path = "${CMAKE_CURRENT_SOURCE_DIR}/" + path
+    path = source_dir + "/" + path
   return path
 
 class CMLModuleRootBlock(CMakeListBlock):
   def __str__(self):
     module = self.cml.module
     lines = []
-    lines.append("project({})".format(self.cml.module.name))
-    lines.append("")
+    # Flat output has no directory scopes; module flags go on each target
+    if not self.cml.options.flat:
+      lines.append("project({})".format(self.cml.module.name))
+      lines.append("")
+
+      # Flags shared by every target in the module
+      flag_lines = _directory_flag_lines(module.flags, self.cml.options)
+      if flag_lines:
+        lines.extend(flag_lines)
+        lines.append("")
 
     # Decide what kind of library we are
     module_target = [x for x in self.cml.targets if x.name == self.cml.module.name]
     assert len(module_target) <= 1
     if module_target:
       # We are a real, compiled library
-      lines.append(str(CMLLibraryOutput(module_target[0])))
+      lines.append(str(CMLLibraryOutput(module_target[0], self.cml.options, self.cml)))
     else:
       # We're just an interface library
       lines.append("add_library( {} INTERFACE )".format(module.name))
-      include_paths = {"${CMAKE_CURRENT_SOURCE_DIR}/.."}
+      include_paths = {self.cml.source_dir + "/.."}
       
       # Handle any replacements in this path
       for path in module.include_paths:
         assert not path.startswith("!"), "No private includes for interface libraries"
-        path = _expand_include_path(path)
+        path = _expand_include_path(path, self.cml.source_dir)
         include_paths.add(path)
       linepre = "target_include_directories( {} INTERFACE ".format(module.name)
 
-      lines.append(_append_list_to(linepre, include_paths, append=(" )", "\n)")))
+      lines.append(_append_list_to(linepre, sorted(include_paths), append=(" )", "\n)")))
 
     # Write out the libtbx refresh generator, along with the sources it creates
     if self.cml.module.generated_sources:
       lines.append("")
-      lines.append("add_libtbx_refresh_command( ${CMAKE_CURRENT_SOURCE_DIR}/libtbx_refresh.py")
+      if self.cml.options.compiler_launcher or self.cml.options.refresh_cache:
+        # Run from the build directory, so the outputs are the same for every
+        # build, and through the shared cache if there is one
+        lines.append("tbx_libtbx_refresh( {}/libtbx_refresh.py".format(self.cml.source_dir))
+      else:
+        lines.append("add_libtbx_refresh_command( {}/libtbx_refresh.py".format(self.cml.source_dir))
 
       slines = []
       for source in sorted(self.cml.module.generated_sources):
@@ -193,11 +545,111 @@ class CMLModuleRootBlock(CMakeListBlock):
         if not slines:
           indent = "     OUTPUT "
         slines.append(indent + "${CMAKE_BINARY_DIR}/" + source)
+      for i, source in enumerate(self.cml.module.refresh_inputs):
+        indent = "            "
+        if i == 0:
+          indent = "    DEPENDS "
+        slines.append(indent + "${CMAKE_SOURCE_DIR}/" + source)
       slines.append(")")
       lines.extend(slines)
 
     return "\n".join(lines)
 
+def _cmake_string(text):
+  "Returns text as a quoted CMake string"
+  return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _cmake_quote(argument):
+  "Quotes a command argument for CMake, if it needs it"
+  if any(x in argument for x in (" ", ";", '"', "\\", "${", "#")):
+    return _cmake_string(argument)
+  return argument
+
+def _profile_build_types(profile, options):
+  "The CMake build types that a build profile's flags apply to"
+  build_types = [PROFILE_BUILD_TYPES[profile]]
+  # The PGO build types are variants of release
+  if options.pgo and profile == "release":
+    build_types.extend(PGO_BUILD_TYPES)
+  return build_types
+
+def _config_condition(profiles, options):
+  "A generator expression condition that is true when building any of the profiles"
+  return _build_types_condition(
+    [build_type for profile in profiles for build_type in _profile_build_types(profile, options)])
+
+def _debug_build_types(options):
+  "The CMake build types that are built with debug information"
+  build_types = ["Debug", "RelWithDebInfo"]
+  for profile in options.profiles:
+    if BUILD_PROFILES[profile].get("debug_symbols") and not PROFILE_BUILD_TYPES[profile] in build_types:
+      build_types.append(PROFILE_BUILD_TYPES[profile])
+  return build_types
+
+def _build_types_condition(build_types):
+  "A generator expression condition that is true when building any of the build types"
+  conditions = ["$<CONFIG:{}>".format(build_type) for build_type in build_types]
+  if len(conditions) == 1:
+    return conditions[0]
+  return "$<OR:{}>".format(",".join(conditions))
+
+def _flag_arguments(flags, field, options, profiles=True):
+  """The command arguments for one field of a BuildFlags object.
+
+  Flags for a specific build profile are wrapped in generator expressions.
+  Options paired with an argument are kept together with SHELL:, so that
+  CMake doesn't deduplicate repeated options away from their arguments.
+  """
+  def _shell(value):
+    return "SHELL:" + value if field != "compile_definitions" and " " in value else value
+  arguments = [_cmake_quote(_shell(x)) for x in getattr(flags, field)]
+  if profiles:
+    for profile in sorted(flags.profiles):
+      condition = _config_condition([profile], options)
+      for value in getattr(flags.profiles[profile], field):
+        arguments.append(_cmake_quote("$<{}:{}>".format(condition, _shell(value))))
+  return arguments
+
+def _directory_flag_lines(flags, options, profiles=True):
+  "Lines adding compile and link flags to every target in a directory and below"
+  lines = []
+  for field in BuildFlags.FIELDS:
+    arguments = _flag_arguments(flags, field, options, profiles=profiles)
+    if arguments:
+      lines.append(_append_list_to("add_{}( ".format(field), arguments, append=(" )", " )")))
+  return lines
+
+def _build_type_lines(flags, options):
+  """Lines setting the CMake build-type flags from the flags that only apply
+  to each build profile, and the optional host tuning"""
+  profiles = options.profiles
+  lines = ["# Flags for each build type, from emulating the SConscripts with each profile"]
+  for profile in profiles:
+    build_type = PROFILE_BUILD_TYPES[profile].upper()
+    extra = flags.profiles.get(profile, BuildFlags())
+    compile_flags = extra.compile_options + ["-D" + x for x in extra.compile_definitions]
+    lines.append("set(CMAKE_CXX_FLAGS_{} {})".format(build_type, _cmake_string(" ".join(compile_flags))))
+    lines.append("set(CMAKE_C_FLAGS_{0} \"${{CMAKE_CXX_FLAGS_{0}}}\")".format(build_type))
+    if extra.link_options:
+      for kind in ("SHARED", "MODULE", "EXE"):
+        lines.append("set(CMAKE_{}_LINKER_FLAGS_{} {})".format(
+          kind, build_type, _cmake_string(" ".join(extra.link_options))))
+  lines.append("if(NOT CMAKE_BUILD_TYPE AND NOT CMAKE_CONFIGURATION_TYPES)")
+  lines.append("  set(CMAKE_BUILD_TYPE {} CACHE STRING \"Build type\" FORCE)".format(
+    PROFILE_BUILD_TYPES[profiles[0]]))
+  lines.append("endif()")
+
+  optimised = [x for x in profiles if BUILD_PROFILES[x].get("optimization")]
+  if optimised:
+    condition = _config_condition(optimised, options)
+    lines.append("")
+    lines.append('option(TBX_HOST_TUNING "Tune optimised builds for the CPU of the build host" OFF)')
+    lines.append("if(TBX_HOST_TUNING)")
+    tuning = ["$<{}:{}>".format(condition, x) for x in ("-march=native", "-mtune=native")]
+    lines.append(_append_list_to("  add_compile_options( ", tuning, indent=6, append=(" )", " )")))
+    lines.append("endif()")
+  return lines
+
 def _append_list_to(line, list, join=" ", indent=4, append=("",""), firstindent=None):
   """
   Appends a list to a line, either inline or as separate lines depending on length.
@@ -215,15 +667,333 @@ def _append_list_to(line, list, join=" ", indent=4, append=("",""), firstindent=
     joiner = join.strip() + "\n" + " "*indent
     return line + "\n" + firstindent + joiner.join(list) + append[1]
 
+# Merges the profiles written by training runs of a PGOInstrument build.
+# GCC merges repeated runs into the same .gcda files itself, so only clang
+# output needs an explicit merge.
+_PGO_MERGE_SCRIPT = """\
+file(GLOB_RECURSE _raw "${PGO_DIR}/*.profraw")
+if(_raw)
+  if(NOT PROFDATA)
+    message(FATAL_ERROR "llvm-profdata is needed to merge the profiles in ${PGO_DIR}")
+  endif()
+  execute_process(COMMAND "${PROFDATA}" merge "-output=${PGO_DIR}/default.profdata" ${_raw}
+                  RESULT_VARIABLE _result)
+  if(_result)
+    message(FATAL_ERROR "Failed to merge the profiles in ${PGO_DIR}")
+  endif()
+  list(LENGTH _raw _count)
+  message(STATUS "Merged ${_count} profiles into ${PGO_DIR}/default.profdata")
+else()
+  file(GLOB_RECURSE _gcda "${PGO_DIR}/*.gcda")
+  if(NOT _gcda)
+    message(FATAL_ERROR "No profile data in ${PGO_DIR}; run the training workload with a PGOInstrument build first")
+  endif()
+  list(LENGTH _gcda _count)
+  message(STATUS "${_count} GCC profiles in ${PGO_DIR} are ready to use")
+endif()
+"""
+
+def _lto_build_types(options):
+  "The build types that link-time optimisation is used for"
+  return [x for x in _profile_build_types("release", options) if x != "PGOInstrument"]
+
+def _lto_lines(options):
+  """Lines turning on link-time optimisation by default for the optimised
+  build types, if the toolchain supports it"""
+  build_types = _lto_build_types(options)
+  condition = _build_types_condition(build_types)
+  lines = [
+    "# Link-time optimisation for optimised builds, if the toolchain supports it",
+    "include(CheckIPOSupported)",
+    "check_ipo_supported(RESULT TBX_IPO_SUPPORTED OUTPUT _tbx_ipo_error LANGUAGES C CXX)",
+    "if(TBX_IPO_SUPPORTED)",
+  ]
+  for build_type in build_types:
+    lines.append("  set(CMAKE_INTERPROCEDURAL_OPTIMIZATION_{} ON)".format(build_type.upper()))
+  # GCC and clang spell the parallel LTO job count differently
+  lines.append('  if(CMAKE_CXX_COMPILER_ID STREQUAL "GNU")')
+  lines.append("    add_link_options( $<{}:-flto={}> )".format(condition, options.lto_jobs))
+  if options.lto_jobs != "auto":
+    lines.append('  elseif(CMAKE_CXX_COMPILER_ID MATCHES "Clang")')
+    lines.append("    add_link_options( $<{}:-flto-jobs={}> )".format(condition, options.lto_jobs))
+  lines.append("  endif()")
+  lines.append("else()")
+  lines.append('  message(WARNING "Link-time optimisation is not available: ${_tbx_ipo_error}")')
+  lines.append("endif()")
+  return lines
+
+def _pgo_lines():
+  """Lines adding the instrumented and optimised PGO build types, based on
+  the release flags, and a tbx_pgo_merge target to prepare the profiles"""
+  lines = [
+    "# Profile-guided optimisation. Build with CMAKE_BUILD_TYPE=PGOInstrument,",
+    "# run the training workload, build tbx_pgo_merge, then reconfigure the same",
+    "# build directory with CMAKE_BUILD_TYPE=PGOOptimize and rebuild.",
+    'set(TBX_PGO_DIR "${CMAKE_BINARY_DIR}/pgo-data" CACHE PATH "Directory for the PGO profile data")',
+    'if(CMAKE_CXX_COMPILER_ID MATCHES "Clang")',
+    '  set(_tbx_pgo_generate "-fprofile-generate=${TBX_PGO_DIR}")',
+    '  set(_tbx_pgo_use "-fprofile-use=${TBX_PGO_DIR}/default.profdata")',
+    "else()",
+    '  set(_tbx_pgo_generate "-fprofile-generate=${TBX_PGO_DIR} -fprofile-update=atomic")',
+    '  set(_tbx_pgo_use "-fprofile-use=${TBX_PGO_DIR} -fprofile-correction -Wno-missing-profile")',
+    "endif()",
+    "foreach(_lang C CXX)",
+    '  set(CMAKE_${_lang}_FLAGS_PGOINSTRUMENT "${CMAKE_${_lang}_FLAGS_RELEASE} ${_tbx_pgo_generate}")',
+    '  set(CMAKE_${_lang}_FLAGS_PGOOPTIMIZE "${CMAKE_${_lang}_FLAGS_RELEASE} ${_tbx_pgo_use}")',
+    "endforeach()",
+    "foreach(_kind SHARED MODULE EXE)",
+    '  set(CMAKE_${_kind}_LINKER_FLAGS_PGOINSTRUMENT "${CMAKE_${_kind}_LINKER_FLAGS_RELEASE} ${_tbx_pgo_generate}")',
+    '  set(CMAKE_${_kind}_LINKER_FLAGS_PGOOPTIMIZE "${CMAKE_${_kind}_LINKER_FLAGS_RELEASE} ${_tbx_pgo_use}")',
+    "endforeach()",
+    "if(CMAKE_CONFIGURATION_TYPES)",
+    "  list(APPEND CMAKE_CONFIGURATION_TYPES {})".format(" ".join(PGO_BUILD_TYPES)),
+    "  list(REMOVE_DUPLICATES CMAKE_CONFIGURATION_TYPES)",
+    "endif()",
+    "",
+    "find_program(TBX_LLVM_PROFDATA NAMES llvm-profdata)",
+    'file(WRITE "${CMAKE_BINARY_DIR}/tbx_pgo_merge.cmake" [=[',
+  ]
+  lines.extend(_PGO_MERGE_SCRIPT.splitlines())
+  lines.extend([
+    "]=])",
+    "add_custom_target( tbx_pgo_merge",
+    '    COMMAND ${CMAKE_COMMAND} "-DPGO_DIR=${TBX_PGO_DIR}" "-DPROFDATA=${TBX_LLVM_PROFDATA}"',
+    "            -P ${CMAKE_BINARY_DIR}/tbx_pgo_merge.cmake",
+    '    COMMENT "Merging profile data in ${TBX_PGO_DIR}" )',
+  ])
+  return lines
+
+_REFRESH_SCRIPT = """\
+# Runs a libtbx_refresh.py from the build directory, with paths relative to it.
+# With a CACHE_DIR, the outputs are restored from a cache shared between build
+# directories instead, keyed by the module path and the hashes of the inputs,
+# and saved to it after running.
+# Usage: cmake -DMANIFEST=<file> -P <this script>, from the build directory
+include("${MANIFEST}")
+
+function(_tbx_refresh_cache_key out)
+  set(_parts "${MODULE}")
+  foreach(_file IN LISTS INPUTS)
+    file(SHA256 "${_file}" _hash)
+    list(APPEND _parts "${_hash}")
+  endforeach()
+  list(APPEND _parts ${OUTPUTS})
+  string(SHA256 _key "${_parts}")
+  set(${out} "${CACHE_DIR}/${_key}" PARENT_SCOPE)
+endfunction()
+
+function(_tbx_refresh_cache_restore entry)
+  foreach(_file IN LISTS OUTPUTS)
+    get_filename_component(_dir "${CMAKE_CURRENT_BINARY_DIR}/${_file}" DIRECTORY)
+    file(COPY "${entry}/${_file}" DESTINATION "${_dir}")
+    # Newer than the inputs, so the refresh command is up to date
+    file(TOUCH "${_file}")
+  endforeach()
+  file(TOUCH "${entry}/.complete")
+endfunction()
+
+function(_tbx_refresh_cache_save entry)
+  string(RANDOM _tag)
+  set(_partial "${entry}.${_tag}")
+  foreach(_file IN LISTS OUTPUTS)
+    if(NOT EXISTS "${_file}")
+      file(REMOVE_RECURSE "${_partial}")
+      return()
+    endif()
+    get_filename_component(_dir "${_partial}/${_file}" DIRECTORY)
+    file(COPY "${_file}" DESTINATION "${_dir}")
+  endforeach()
+  file(TOUCH "${_partial}/.complete")
+  if(EXISTS "${entry}")
+    file(REMOVE_RECURSE "${_partial}")
+  else()
+    file(RENAME "${_partial}" "${entry}")
+  endif()
+endfunction()
+
+function(_tbx_refresh_cache_evict)
+  file(GLOB _entries LIST_DIRECTORIES true "${CACHE_DIR}/*")
+  set(_total 0)
+  set(_sorted)
+  foreach(_entry IN LISTS _entries)
+    if(NOT EXISTS "${_entry}/.complete")
+      continue()
+    endif()
+    file(GLOB_RECURSE _files "${_entry}/*")
+    set(_size 0)
+    foreach(_file IN LISTS _files)
+      file(SIZE "${_file}" _file_size)
+      math(EXPR _size "${_size} + ${_file_size}")
+    endforeach()
+    math(EXPR _total "${_total} + ${_size}")
+    file(TIMESTAMP "${_entry}/.complete" _used "%s")
+    list(APPEND _sorted "${_used}|${_size}|${_entry}")
+  endforeach()
+  # Remove the least recently used entries until within the size limit
+  math(EXPR _limit "${CACHE_SIZE_MB} * 1048576")
+  list(SORT _sorted)
+  foreach(_item IN LISTS _sorted)
+    if(_total LESS_EQUAL _limit)
+      break()
+    endif()
+    string(REPLACE "|" ";" _fields "${_item}")
+    list(GET _fields 1 _size)
+    list(GET _fields 2 _entry)
+    file(REMOVE_RECURSE "${_entry}")
+    math(EXPR _total "${_total} - ${_size}")
+  endforeach()
+endfunction()
+
+if(CACHE_DIR)
+  _tbx_refresh_cache_key(_entry)
+endif()
+if(CACHE_DIR AND EXISTS "${_entry}/.complete")
+  _tbx_refresh_cache_restore("${_entry}")
+  message(STATUS "Restored the outputs of ${MODULE} from ${_entry}")
+else()
+  execute_process(COMMAND ${RUNNER} "${SCRIPT}" RESULT_VARIABLE _result)
+  if(NOT _result EQUAL 0)
+    message(FATAL_ERROR "Running ${SCRIPT} failed: ${_result}")
+  endif()
+  if(CACHE_DIR)
+    _tbx_refresh_cache_save("${_entry}")
+    _tbx_refresh_cache_evict()
+  endif()
+endif()
+"""
+
+def _refresh_command_lines(options):
+  """Lines defining tbx_libtbx_refresh, which runs a module refresh itself
+  when the including project says how to, instead of add_libtbx_refresh_command"""
+  lines = [
+    "# Run libtbx_refresh.py scripts from the build directory, with relative paths",
+    'set(TBX_REFRESH_RUNNER "" CACHE STRING "Command to run a libtbx_refresh.py with, given its path relative to the build directory")',
+  ]
+  if options.refresh_cache:
+    lines.extend([
+      "# Share the sources generated by libtbx_refresh.py between build directories",
+      'if(DEFINED ENV{XDG_CACHE_HOME})',
+      '  set(_tbx_cache_home "$ENV{XDG_CACHE_HOME}")',
+      "else()",
+      '  set(_tbx_cache_home "$ENV{HOME}/.cache")',
+      "endif()",
+      'set(TBX_REFRESH_CACHE_DIR "${_tbx_cache_home}/tbx2cmake-refresh" CACHE PATH "Directory to cache refresh-generated sources in")',
+      'set(TBX_REFRESH_CACHE_SIZE 1024 CACHE STRING "Maximum size of the refresh cache, in MiB")',
+    ])
+  lines.extend([
+    'set(TBX_REFRESH_SCRIPT "${CMAKE_BINARY_DIR}/tbx_refresh.cmake")',
+    'file(WRITE "${TBX_REFRESH_SCRIPT}" [=[',
+  ])
+  lines.extend(_REFRESH_SCRIPT.splitlines())
+  lines.extend([
+    "]=])",
+    "# Usage: tbx_libtbx_refresh( <script> OUTPUT <outputs>... [DEPENDS <inputs>...] )",
+    "function(tbx_libtbx_refresh script)",
+    "  if(NOT TBX_REFRESH_RUNNER)",
+    "    add_libtbx_refresh_command(${script} ${ARGN})",
+    "    return()",
+    "  endif()",
+    '  cmake_parse_arguments(_refresh "" "" "OUTPUT;DEPENDS" ${ARGN})',
+    "  # Everything the command needs, in a file named after the module path",
+    '  get_filename_component(_module "${script}" DIRECTORY)',
+    '  file(RELATIVE_PATH MODULE "${CMAKE_SOURCE_DIR}" "${_module}")',
+    '  file(RELATIVE_PATH SCRIPT "${CMAKE_BINARY_DIR}" "${script}")',
+    '  set(RUNNER "${TBX_REFRESH_RUNNER}")',
+    '  set(INPUTS "${script}" ${_refresh_DEPENDS})',
+    "  set(OUTPUTS)",
+    "  foreach(_output IN LISTS _refresh_OUTPUT)",
+    '    file(RELATIVE_PATH _output "${CMAKE_BINARY_DIR}" "${_output}")',
+    '    list(APPEND OUTPUTS "${_output}")',
+    "  endforeach()",
+    '  set(CACHE_DIR "${TBX_REFRESH_CACHE_DIR}")',
+    '  set(CACHE_SIZE_MB "${TBX_REFRESH_CACHE_SIZE}")',
+    "  set(_content)",
+    "  foreach(_var RUNNER SCRIPT MODULE INPUTS OUTPUTS CACHE_DIR CACHE_SIZE_MB)",
+    '    string(APPEND _content "set(${_var} [==[${${_var}}]==])\\n")',
+    "  endforeach()",
+    '  string(MAKE_C_IDENTIFIER "${MODULE}" _name)',
+    '  set(_manifest "${CMAKE_BINARY_DIR}/tbx_refresh/${_name}.cmake")',
+    '  file(WRITE "${_manifest}" "${_content}")',
+    "  add_custom_command( OUTPUT ${_refresh_OUTPUT}",
+    '    COMMAND ${CMAKE_COMMAND} "-DMANIFEST=${_manifest}" -P "${TBX_REFRESH_SCRIPT}"',
+    "    DEPENDS ${script} ${_refresh_DEPENDS}",
+    "    WORKING_DIRECTORY ${CMAKE_BINARY_DIR}",
+    '    COMMENT "Running ${SCRIPT}"',
+    "    VERBATIM )",
+    "endfunction()",
+  ])
+  return lines
+
+def _compiler_launcher_lines(options):
+  """Lines to compile through a compiler cache, keeping the compile commands
+  independent of where the source and build trees are"""
+  launcher = options.compiler_launcher
+  lines = [
+    "# Compile through {}, if it is available".format(launcher),
+    "find_program(TBX_COMPILER_LAUNCHER NAMES {})".format(launcher),
+    "if(TBX_COMPILER_LAUNCHER AND NOT CMAKE_CXX_COMPILER_LAUNCHER)",
+  ]
+  if os.path.basename(launcher) == "ccache":
+    # Rewrite paths in the base directory as relative, and ignore the working
+    # directory, so that separate checkouts and build directories share hits
+    lines.extend([
+      "  # The nearest directory holding both the source and build trees",
+      '  set(_tbx_basedir "${CMAKE_SOURCE_DIR}")',
+      '  while(NOT _tbx_basedir STREQUAL "/")',
+      '    file(RELATIVE_PATH _tbx_rel "${_tbx_basedir}" "${CMAKE_BINARY_DIR}")',
+      '    if(NOT _tbx_rel MATCHES "^[.][.]")',
+      "      break()",
+      "    endif()",
+      '    get_filename_component(_tbx_basedir "${_tbx_basedir}" DIRECTORY)',
+      "  endwhile()",
+      '  set(TBX_CCACHE_BASEDIR "${_tbx_basedir}" CACHE PATH "Base directory for ccache to make paths relative to")',
+      "  set(_tbx_launcher ${CMAKE_COMMAND} -E env CCACHE_BASEDIR=${TBX_CCACHE_BASEDIR}",
+      "      CCACHE_NOHASHDIR=true ${TBX_COMPILER_LAUNCHER})",
+    ])
+  else:
+    lines.append("  set(_tbx_launcher ${TBX_COMPILER_LAUNCHER})")
+  lines.extend([
+    "  set(CMAKE_C_COMPILER_LAUNCHER ${_tbx_launcher})",
+    "  set(CMAKE_CXX_COMPILER_LAUNCHER ${_tbx_launcher})",
+    "elseif(NOT TBX_COMPILER_LAUNCHER)",
+    '  message(WARNING "Compiler launcher {} not found; compiling without it")'.format(launcher),
+    "endif()",
+    "# Keep the source and build paths out of __FILE__ and the debug information",
+    "include(CheckCXXCompilerFlag)",
+    "check_cxx_compiler_flag(-ffile-prefix-map=/a=b TBX_HAVE_FILE_PREFIX_MAP)",
+    "if(TBX_HAVE_FILE_PREFIX_MAP)",
+    "  add_compile_options(-ffile-prefix-map=${CMAKE_SOURCE_DIR}/= -ffile-prefix-map=${CMAKE_BINARY_DIR}/=)",
+    "endif()",
+  ])
+  return lines
+
 class CMLLibraryOutput(CMakeListBlock):
-  def __init__(self, target):
+  def __init__(self, target, options=None, cml=None):
     self.target = target
+    self.options = options or GenerationOptions()
+    self.cml = cml
+
+  @property
+  def sources(self):
+    "The target sources, with explicit paths in flat output"
+    if self.options.flat and self.cml:
+      return [self.cml.source_dir + "/" + x for x in self.target.sources]
+    return self.target.sources
+
+  @property
+  def inherited_flags(self):
+    "Module flags that flat output has to put on the target itself"
+    if self.options.flat and self.cml and self.cml.module:
+      return self.cml.module.flags
+    return None
 
   @property
   def typename(self):
     if self.target.type == self.target.Type.MODULE:
       return "MODULE"
     elif self.target.type == self.target.Type.SHARED:
+      if self.options.static_libraries:
+        return "STATIC"
       return "SHARED"
     elif self.target.type == self.target.Type.STATIC:
       return "STATIC"
@@ -247,7 +1017,7 @@ class CMLLibraryOutput(CMakeListBlock):
     # Work out if we can put all the sources on one line
     lines = []
 
-    lines.append(_append_list_to(add_lib, self.target.sources, append=(" )", " )")))
+    lines.append(_append_list_to(add_lib, self.sources, append=(" )", " )")))
 
     # lines.extend()
     # if len(add_lib + " ".join(self.target.sources)) + 2 <= 78:
@@ -262,19 +1032,19 @@ class CMLLibraryOutput(CMakeListBlock):
     # Add generated sources
     if self.target.generated_sources:
       addgen = "add_generated_sources( {} ".format(self.target.name)
-      lines.append(_append_list_to(addgen, self.target.generated_sources, append=(" )", " )")))
+      lines.append(_append_list_to(addgen, sorted(self.target.generated_sources), append=(" )", " )")))
 
     # If we have custom include directories, add them now
     if self.target.include_paths:
       include_public = []
       include_private = []
-      for path in self.target.include_paths:
+      for path in sorted(self.target.include_paths):
         pathtype = include_public
         if path.startswith("!"):
           path = path[1:]
           pathtype = include_private
         
-        path = _expand_include_path(path)
+        path = _expand_include_path(path, self.cml.source_dir if self.cml else "${CMAKE_CURRENT_SOURCE_DIR}")
         pathtype.append(path)
 
       inclines = ["target_include_directories( {} ".format(self.target.name)]
@@ -285,13 +1055,59 @@ class CMLLibraryOutput(CMakeListBlock):
         # inclines.append(_append_list_to("    PRIVATE ", include_private))
       lines.append("\n".join(inclines) + " )")
 
+    # Precompiled headers need CMake 3.16, so are skipped on older versions
+    if self.options.precompile_headers and self.target.precompile_headers:
+      lines.append("if(COMMAND target_precompile_headers)")
+      lines.append("  " + _append_list_to("target_precompile_headers( {} PRIVATE ".format(self.target.name),
+        ["<{}>".format(x) for x in self.target.precompile_headers], indent=6, append=(" )", " )")))
+      lines.append("endif()")
+
+    # Flags from the SCons environment that aren't shared module-wide
+    for field in BuildFlags.FIELDS:
+      arguments = _flag_arguments(self.target.flags, field, self.options)
+      if self.inherited_flags:
+        arguments = _flag_arguments(self.inherited_flags, field, self.options) + arguments
+      if arguments:
+        flagline = "target_{}( {} PRIVATE ".format(field, self.target.name)
+        lines.append(_append_list_to(flagline, arguments, append=(" )", " )")))
+
     extra_libs = self.target.extra_libs
     if self.is_python_module:
       extra_libs = extra_libs - {"boost_python"}
     else:
       extra_libs |= {"boost"}
     if extra_libs:
-      lines.append("target_link_libraries( {} {} )".format(self.target.name, " ".join(_target_rename(x) for x in extra_libs)))
+      lines.append("target_link_libraries( {} {} )".format(self.target.name, " ".join(sorted(_target_rename(x) for x in extra_libs))))
+
+    # OpenMP is optional; without it the target just runs single-threaded
+    if self.target.openmp:
+      lines.append("if(TARGET OpenMP::OpenMP_CXX)")
+      lines.append("  target_link_libraries( {} OpenMP::OpenMP_CXX )".format(self.target.name))
+      lines.append("endif()")
+
+    # Targets excluded from link-time optimisation in the autogen information
+    if self.options.lto and not self.target.lto:
+      properties = ["INTERPROCEDURAL_OPTIMIZATION_{} OFF".format(x.upper())
+        for x in _lto_build_types(self.options)]
+      lines.append(_append_list_to("set_target_properties( {} PROPERTIES ".format(self.target.name),
+        properties, append=(" )", " )")))
+
+    # Put shared #/lib outputs together, and find each other through $ORIGIN
+    if self.options.origin_rpath and self.target.output_path == "#/lib" and self.typename != "STATIC":
+      properties = ["LIBRARY_OUTPUT_DIRECTORY ${TBX_LIBRARY_DIR}",
+                    "BUILD_WITH_INSTALL_RPATH ON",
+                    "INSTALL_RPATH ${TBX_ORIGIN}",
+                    "INSTALL_RPATH_USE_LINK_PATH ON"]
+      lines.append(_append_list_to("set_target_properties( {} PROPERTIES ".format(self.target.name),
+        properties, append=(" )", " )")))
+
+    # Only export symbols that are explicitly marked, where it's safe to
+    hideable = self.target.hidden_visibility or self.options.static_libraries
+    if self.options.hidden_visibility and hideable:
+      properties = ["C_VISIBILITY_PRESET hidden", "CXX_VISIBILITY_PRESET hidden",
+                    "VISIBILITY_INLINES_HIDDEN ON"]
+      lines.append(_append_list_to("set_target_properties( {} PROPERTIES ".format(self.target.name),
+        properties, append=(" )", " )")))
 
     # Handle any optional dependencies
     optionals = OPTIONAL_DEPENDS & set(extra_libs)
@@ -299,7 +1115,7 @@ class CMLLibraryOutput(CMakeListBlock):
       # Ensure we have properly split lines before indenting
       lines = "\n".join(lines).splitlines()
       # cond_lines = []
-      conditions = " AND ".join(("TARGET {}".format(_target_rename(x)) for x in optionals))
+      conditions = " AND ".join(sorted("TARGET {}".format(_target_rename(x)) for x in optionals))
       cond_lines = ["if({})".format(conditions)]
       cond_lines.extend("  " + x for x in lines)
       cond_lines.append("endif()")
@@ -310,15 +1126,38 @@ class CMLLibraryOutput(CMakeListBlock):
 
 def read_autogen_information(filename, tbx):
   with open(filename) as f:
-    data = yaml.load(f)
+    data = yaml.safe_load(f)
+
+  def _missing(message):
+    # Entries for modules outside a partial conversion are expected
+    if tbx.selected_modules is None:
+      logger.warning(message)
+    else:
+      logger.debug(message)
 
   # Load the list of module-refresh-generated files
-  for modname, value in data.get("libtbx_refresh", {}).items():
+  for modname, value in sorted(data.get("libtbx_refresh", {}).items()):
+    if not modname in tbx.modules and tbx.selected_modules is not None:
+      _missing("No module named {} found; ignoring refresh outputs".format(modname))
+      continue
     module = tbx.modules[modname]
     module.generated_sources.extend(value)
 
-  # Add the generated sources information
-  tbx.other_generated = data.get("other_generated", [])
+  # Other generated files can name the module whose refresh step creates
+  # them, e.g. "- include/scitbx/other.h: scitbx", so that each module's
+  # refresh can run independently. Files without one are left to the whole
+  # distribution
+  tbx.other_generated = []
+  for entry in data.get("other_generated", []):
+    if not isinstance(entry, dict):
+      tbx.other_generated.append(entry)
+      continue
+    for path, modname in sorted(entry.items()):
+      if modname in tbx.modules and tbx.modules[modname].has_refresh:
+        tbx.modules[modname].generated_sources.append(path)
+      else:
+        _missing("No refreshed module named {} found for {}".format(modname, path))
+        tbx.other_generated.append(path)
 
   # Find all targets that use repository-lookup sources
   for target in tbx.targets:
@@ -372,16 +1211,19 @@ def read_autogen_information(filename, tbx):
       logger.warning("Target {}:{} has no non-generated sources".format(target.origin_path, target.name))
 
   # Handle any forced dependencies (e.g. things we can't tell/can't tell easily from SCons)
-  for name, deps in data.get("dependencies", {}).items():
+  for name, deps in sorted(data.get("dependencies", {}).items()):
     if isinstance(deps, basestring):
       deps = [deps]
     # find this target
+    if not name in tbx.targets and tbx.selected_modules is not None:
+      _missing("No target named {} found; ignoring dependencies".format(name))
+      continue
     target = tbx.targets[name]
     print("Adding {} to {}".format(", ".join(deps), target.name))
     target.extra_libs |= set(deps)
   
   # Handle adding of include paths to specific targets/modules
-  for name, incs in data.get("target_includes", {}).items():
+  for name, incs in sorted(data.get("target_includes", {}).items()):
     if isinstance(incs, basestring):
       incs = [incs]
 
@@ -391,10 +1233,185 @@ def read_autogen_information(filename, tbx):
     elif name in tbx.modules:
       inc_target = tbx.modules[name]
     else:
-      logger.warning("No target/module named {} found; ignoring extra include paths".format(name))
+      _missing("No target/module named {} found; ignoring extra include paths".format(name))
     if inc_target:
       inc_target.include_paths |= set(incs)
 
+  # Targets that must not be built with link-time optimisation
+  for name in data.get("lto_exclude", []):
+    if name in tbx.targets:
+      tbx.targets[name].lto = False
+    else:
+      _missing("No target named {} found; ignoring LTO exclusion".format(name))
+
+  # Shared libraries that other targets link against need their symbols
+  # visible, unless their exports have been explicitly annotated
+  annotated = set(data.get("export_annotated", []))
+  for name in annotated - {x.name for x in tbx.targets}:
+    _missing("No target named {} found; ignoring export annotation".format(name))
+  linked = set().union(*[x.extra_libs for x in tbx.targets])
+  for target in tbx.targets:
+    if target.type == Target.Type.SHARED and target.name in linked and not target.name in annotated:
+      target.hidden_visibility = False
+
+def _factor_flags(flagsets):
+  """Removes the flags that every one of a list of BuildFlags shares.
+
+  :returns: A BuildFlags with the common flags, in the order of the first
+  """
+  factored = BuildFlags()
+  if len(flagsets) < 2:
+    return factored
+  for field in BuildFlags.FIELDS:
+    common = set.intersection(*(set(getattr(x, field)) for x in flagsets))
+    setattr(factored, field, [x for x in getattr(flagsets[0], field) if x in common])
+    for flags in flagsets:
+      setattr(flags, field, [x for x in getattr(flags, field) if not x in common])
+  for profile in sorted(set.intersection(*(set(x.profiles) for x in flagsets))):
+    factored.profiles[profile] = _factor_flags([x.profiles[profile] for x in flagsets])
+  return factored
+
+def _remove_build_type_flags(flags):
+  """Takes the optimisation and debug flags, which the CMake build type sets,
+  out of the flags common to every profile.
+
+  :returns: A BuildFlags with the flags removed
+  """
+  removed = BuildFlags()
+  removed.compile_options = [x for x in flags.compile_options if BUILD_TYPE_FLAG_RE.match(x)]
+  removed.compile_definitions = [x for x in flags.compile_definitions if x in BUILD_TYPE_DEFINITIONS]
+  flags.compile_options = [x for x in flags.compile_options if not x in removed.compile_options]
+  flags.compile_definitions = [x for x in flags.compile_definitions if not x in removed.compile_definitions]
+  return removed
+
+def factor_compile_flags(tbx, profiles=()):
+  """Moves flags shared by all targets out to the distribution, and those
+  shared by all targets in a module to the module.
+
+  Optimisation and debug flags are left to the build type: they are only
+  kept in the flags of each emulated profile.
+
+  :param profiles: The build profiles that were emulated
+  :returns: A BuildFlags with the flags common to all targets
+  """
+  targets = [x for x in tbx.targets if x.type in LIBRARY_TYPES]
+  common = _factor_flags([x.flags for x in targets])
+  for module in tbx.modules.values():
+    module.flags = _factor_flags([x.flags for x in module.targets if x.type in LIBRARY_TYPES])
+    _remove_build_type_flags(module.flags)
+  for target in targets:
+    removed = _remove_build_type_flags(target.flags)
+    if removed:
+      logger.debug("Leaving {} on {} to the build type".format(
+        " ".join(removed.compile_options + removed.compile_definitions), target.name))
+  removed = _remove_build_type_flags(common)
+  for profile in profiles:
+    extra = common.profile(profile)
+    extra.compile_options = removed.compile_options + extra.compile_options
+    extra.compile_definitions = removed.compile_definitions + extra.compile_definitions
+  return common
+
+def _check_deterministic(args):
+  """Runs the generation twice with different hash seeds, and compares.
+
+  :param args: The command line arguments, without the output directory
+  :returns: The process exit code; 0 if the outputs are identical
+  """
+  workdir = tempfile.mkdtemp(prefix="tbx2cmake_deterministic_")
+  try:
+    outputs = []
+    for seed in ("1", "2"):
+      output = os.path.join(workdir, seed)
+      env = dict(os.environ, PYTHONHASHSEED=seed)
+      with open(os.devnull, "w") as devnull:
+        result = subprocess.call([sys.executable, "-m", "tbx2cmake.write_cmake"] + args + [output],
+          env=env, stdout=devnull, stderr=devnull)
+      if result:
+        print("Error: Generation with PYTHONHASHSEED={} failed".format(seed))
+        return 1
+      outputs.append(output)
+
+    files = [set() for _ in outputs]
+    for found, output in zip(files, outputs):
+      for dirpath, _, filenames in os.walk(output):
+        found |= {os.path.relpath(os.path.join(dirpath, x), output) for x in filenames}
+    differ = sorted(files[0] ^ files[1])
+    differ += [x for x in sorted(files[0] & files[1])
+      if not filecmp.cmp(*(os.path.join(y, x) for y in outputs), shallow=False)]
+  finally:
+    shutil.rmtree(workdir)
+
+  if differ:
+    print("Output differs between hash seeds in {} files:".format(len(differ)))
+    for name in differ:
+      print("  " + name)
+    return 1
+  print("Output is identical between hash seeds ({} files)".format(len(files[0])))
+  return 0
+
+def build_cmakelists(tbx, generation):
+  """Builds the tree of CMakeLists for a distribution.
+
+  :param tbx:        The TBXDistribution, with autogen information applied
+  :param generation: The GenerationOptions to write with
+  :returns: The root CMakeLists
+  """
+  root = CMakeLists(options=generation)
+  root.flags = factor_compile_flags(tbx, generation.profiles)
+
+  for module in tbx.modules.values():
+    modroot = root.get_path(module.path)
+    modroot.is_module_root = True
+    modroot._module = module
+
+  for target in tbx.targets:
+    cmakelist = root.get_path(target.origin_path)
+    cmakelist.targets.append(target)
+
+  return root
+
+def _benchmark(module_dir, autogen_file, generation, repeat, read_options):
+  """Times reading a distribution and generating CMake for it.
+
+  :param read_options: Keyword arguments for read_distribution
+  :returns: A one-line summary, with the best time of each stage
+  """
+  read_times = []
+  generate_times = []
+  workdir = tempfile.mkdtemp(prefix="tbx2cmake_benchmark_")
+  try:
+    for run in range(repeat):
+      start = time.time()
+      tbx = read_distribution(module_dir, **read_options)
+      read_autogen_information(autogen_file, tbx)
+      read_times.append(time.time() - start)
+      start = time.time()
+      build_cmakelists(tbx, generation).write(os.path.join(workdir, str(run)))
+      generate_times.append(time.time() - start)
+  finally:
+    shutil.rmtree(workdir)
+  return "{} {}: read {:.3f}s, generate {:.3f}s (best of {})".format(
+    platform.python_implementation(), platform.python_version(),
+    min(read_times), min(generate_times), repeat)
+
+def _benchmark_interpreters(interpreters, args):
+  """Runs the benchmark under other python interpreters.
+
+  :param args: The command line arguments, without --interpreters
+  :returns: A summary line for each interpreter
+  """
+  results = []
+  for interpreter in interpreters:
+    process = subprocess.Popen([interpreter, "-m", "tbx2cmake.write_cmake"] + args,
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    output, _ = process.communicate()
+    lines = output.strip().splitlines()
+    if process.returncode or not lines:
+      results.append("{}: benchmark failed".format(interpreter))
+    else:
+      results.append("{}: {}".format(interpreter, lines[-1]))
+  return results
+
 def _target_rename(name):
   "Renames a target to the CMake target name, if required"
   return DEPENDENCY_RENAMES.get(name, name)
@@ -403,35 +1420,136 @@ def main():
   logging.basicConfig(level=logging.INFO)
 
   options = docopt(__doc__)
+
+  if options["--check-deterministic"]:
+    args = [x for x in sys.argv[1:] if x != "--check-deterministic"]
+    sys.exit(_check_deterministic(args))
+
+  if options["--unused-deps"]:
+    if not os.path.isdir(options["<build_dir>"]):
+      print("Error: Build path {} must be a directory".format(options["<build_dir>"]))
+      sys.exit(1)
+    print(format_unused_report(options["<build_dir>"]))
+    return
+
+  if options["--size-report"]:
+    for path in (options["<build_dir>"], options["<baseline_dir>"]):
+      if not os.path.isdir(path):
+        print("Error: Build path {} must be a directory".format(path))
+        sys.exit(1)
+    print(format_size_report(binary_sizes(options["<build_dir>"]),
+                             binary_sizes(options["<baseline_dir>"])))
+    return
   module_dir = options["<module_dir>"]
   output_dir = options["<output_dir>"]
   autogen_file = options["<autogen.yaml>"]
     
   # Validate the input values
+  if options["--linker"] and options["--linker"] not in LINKERS:
+    print("Error: Unknown linker {}; must be one of {}".format(options["--linker"], ", ".join(sorted(LINKERS))))
+    sys.exit(1)
+  if not (options["--lto-jobs"] == "auto" or options["--lto-jobs"].isdigit()):
+    print("Error: --lto-jobs must be a number, or auto")
+    sys.exit(1)
+  profiles = [x for x in (options["--profiles"] or "").split(",") if x]
+  for profile in profiles:
+    if not profile in BUILD_PROFILES:
+      print("Error: Unknown build profile {}; must be one of {}".format(profile, ", ".join(sorted(BUILD_PROFILES))))
+      sys.exit(1)
+  # The PGO build types take their optimisation flags from the release profile
+  if options["--pgo"] and not "release" in profiles:
+    logger.info("Emulating the release profile for the PGO build types")
+    profiles.append("release")
   if not os.path.isdir(module_dir):
     print("Error: Module path {} must be a directory".format(module_dir))
     sys.exit(1)
-  if os.path.isfile(output_dir):
+  only = [x for x in (options["--only"] or "").split(",") if x]
+  if unknown_modules(module_dir, only):
+    print("Error: Unknown modules {}".format(", ".join(unknown_modules(module_dir, only))))
+    sys.exit(1)
+  if output_dir and os.path.isfile(output_dir):
     print("Error: Output path {} is a file. Please specify a directory or name of one to create.".format(options["<module_dir>"]))
     sys.exit(1)
 
+  build_options = {}
+  if options["--static-libraries"]:
+    build_options["static_libraries"] = True
+
+  if options["--verify-fast-path"]:
+    differences, tbx = verify_fast_path(module_dir, build_options, only=only)
+    print(format_verification(differences, tbx.planned_sconscripts, tbx.executed_sconscripts))
+    sys.exit(1 if differences else 0)
+
+  generation = GenerationOptions()
+  generation.split_dwarf = options["--split-dwarf"]
+  generation.linker = options["--linker"]
+  generation.gdb_index = options["--gdb-index"]
+  generation.profiles = profiles
+  generation.pgo = options["--pgo"]
+  generation.lto = options["--lto"]
+  generation.lto_jobs = options["--lto-jobs"]
+  generation.static_libraries = options["--static-libraries"]
+  generation.hidden_visibility = options["--hidden-visibility"]
+  generation.compiler_launcher = options["--compiler-launcher"]
+  generation.origin_rpath = options["--origin-rpath"]
+  generation.refresh_cache = options["--refresh-cache"]
+  generation.flat = options["--flat"]
+  generation.precompile_headers = options["--precompile-headers"]
+
+  if options["--benchmark"]:
+    if not options["--repeat"].isdigit() or int(options["--repeat"]) < 1:
+      print("Error: --repeat must be a positive number")
+      sys.exit(1)
+    read_options = {"profiles": profiles, "build_options": build_options, "only": only,
+                    "pipeline": Pipeline.from_autogen(autogen_file)}
+    print(_benchmark(module_dir, autogen_file, generation, int(options["--repeat"]), read_options))
+    if options["--interpreters"]:
+      args = sys.argv[1:]
+      if "--interpreters" in args:
+        index = args.index("--interpreters")
+        args = args[:index] + args[index+2:]
+      args = [x for x in args if not x.startswith("--interpreters=")]
+      for line in _benchmark_interpreters(options["--interpreters"].split(","), args):
+        print(line)
+    return
+
   logger.info("Reading TBX distribution")
-  tbx = read_distribution(module_dir)
+  pipeline = Pipeline.from_autogen(autogen_file)
+  tbx = read_distribution(module_dir, profiles=profiles, build_options=build_options, only=only,
+    pipeline=pipeline)
   read_autogen_information(autogen_file, tbx)
 
   logger.info("Read {} targets in {} modules".format(len(tbx.targets), len(tbx.modules)))
+  if options["--pipeline-report"]:
+    print(format_pipeline_report(pipeline))
+
+  if options["--scan-includes"] or options["--precompile-headers"]:
+    includes = scan_includes(tbx, IncludeCache(options["--include-cache"]))
+    if options["--scan-includes"]:
+      logger.info("Added {} include paths found by scanning".format(add_include_paths(includes)))
+    if generation.precompile_headers:
+      for target in tbx.targets:
+        target.precompile_headers = select_precompiled_headers(includes[target.name])
+
+  if options["--check-cache"]:
+    print(format_cache_report(tbx))
+    return
+
+  # The emulated SConscripts already built static libraries, so compare the
+  # import report against the distribution as it would be built by default
+  baseline = None
+  if options["--static-libraries"]:
+    logger.info("Reading TBX distribution without static libraries, for comparison")
+    baseline = read_distribution(module_dir, only=only, pipeline=Pipeline.from_autogen(autogen_file))
+
+  if options["--analyze"]:
+    print(format_report(analyze_build(tbx)))
+    print("")
+    print(format_import_report(tbx, static_libraries=options["--static-libraries"], baseline=baseline))
+    return
 
   # Start building the CMakeLists structure
-  root = CMakeLists()
-
-  for module in tbx.modules.values():
-    modroot = root.get_path(module.path)
-    modroot.is_module_root = True
-    modroot._module = module
-
-  for target in tbx.targets:
-    cmakelist = root.get_path(target.origin_path)
-    cmakelist.targets.append(target)
+  root = build_cmakelists(tbx, generation)
 
   # root.draw_tree()
 
@@ -439,15 +1557,15 @@ def main():
   if not os.path.isdir(output_dir):
     os.makedirs(output_dir)
 
-  for cml in root.all():
-    path = os.path.join(output_dir, cml.full_path)
-    if not os.path.isdir(path):
-      os.makedirs(path)
-    filename = "CMakeLists.txt"
-    if cml is root:
-      filename = "autogen_CMakeLists.txt"
-    with open(os.path.join(path, filename), "w") as f:
-      f.write(cml.generate_cmakelist())
+  root.write(output_dir)
+
+  if options["--compare-configure"]:
+    imported = sorted(set(DEPENDENCY_RENAMES.values()) | {"OpenMP::OpenMP_CXX"})
+    print(format_comparison(compare_layouts(root, tbx, imported)))
+
+  for line in format_import_report(tbx, static_libraries=generation.static_libraries,
+                                   baseline=baseline).splitlines():
+    logger.info(line)
 
 
 if __name__ == "__main__":
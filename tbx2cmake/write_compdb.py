@@ -0,0 +1,109 @@
+# coding: utf-8
+
+"""
+Writes a compile_commands.json compilation database for a TBX-distribution,
+directly from the SConscripts and without configuring CMake.
+
+Usage: tbx2compdb [options] <module_dir> <autogen.yaml> <build_dir>
+
+Options:
+  --output=<file>     Where to write the database. Defaults to
+                      compile_commands.json in the build directory
+  --cc=<compiler>     The C compiler to use [default: cc]
+  --cxx=<compiler>    The C++ compiler to use [default: c++]
+  --include=<dirs>    Extra include directories, e.g. for boost and python,
+                      separated by the path separator
+  --profile=<name>    Add the flags specific to a build profile (one of
+                      release, debug, profile)
+  --only=<modules>    Only include a comma-separated list of modules, and
+                      the modules that they require
+"""
+
+import sys
+import os
+import json
+import logging
+
+from docopt import docopt
+
+from .read_scons import read_distribution, unknown_modules
+from .pipeline import Pipeline
+from .write_cmake import read_autogen_information, LIBRARY_TYPES
+from .import_env import BUILD_PROFILES
+from .toolchain import Toolchain, source_paths, target_arguments, compile_arguments
+
+logger = logging.getLogger(__name__)
+
+def compile_commands(tbx, build_dir, toolchain):
+  """Generates a compilation database entry for every compiled source.
+
+  Entries are generated one at a time, so that the whole database never
+  has to be held in memory.
+  """
+  directory = os.path.abspath(build_dir)
+  for target in sorted(tbx.targets, key=lambda x: x.name):
+    if not target.type in LIBRARY_TYPES:
+      continue
+    arguments = target_arguments(tbx, target, build_dir, toolchain)
+    for source in source_paths(tbx, target, build_dir):
+      command = compile_arguments(tbx, target, source, build_dir, toolchain, arguments)
+      yield {
+        "directory": directory,
+        "file": source,
+        "arguments": command,
+        "output": command[-1],
+      }
+
+def write_compile_commands(entries, stream):
+  """Writes compilation database entries to a stream as a JSON array.
+
+  :returns: The number of entries written
+  """
+  count = 0
+  stream.write("[")
+  for entry in entries:
+    stream.write(",\n" if count else "\n")
+    json.dump(entry, stream, sort_keys=True)
+    count += 1
+  stream.write("\n]\n")
+  return count
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  options = docopt(__doc__)
+  module_dir = options["<module_dir>"]
+  build_dir = options["<build_dir>"]
+  output = options["--output"] or os.path.join(build_dir, "compile_commands.json")
+
+  if not os.path.isdir(module_dir):
+    print("Error: Module path {} must be a directory".format(module_dir))
+    sys.exit(1)
+  profile = options["--profile"]
+  if profile and not profile in BUILD_PROFILES:
+    print("Error: Unknown build profile {}; must be one of {}".format(profile, ", ".join(sorted(BUILD_PROFILES))))
+    sys.exit(1)
+  only = [x for x in (options["--only"] or "").split(",") if x]
+  if unknown_modules(module_dir, only):
+    print("Error: Unknown modules {}".format(", ".join(unknown_modules(module_dir, only))))
+    sys.exit(1)
+
+  toolchain = Toolchain()
+  toolchain.cc = options["--cc"]
+  toolchain.cxx = options["--cxx"]
+  toolchain.include_dirs = [x for x in (options["--include"] or "").split(os.pathsep) if x]
+  toolchain.profile = profile
+
+  logger.info("Reading TBX distribution")
+  tbx = read_distribution(module_dir, profiles=[profile] if profile else None, only=only,
+    pipeline=Pipeline.from_autogen(options["<autogen.yaml>"]))
+  read_autogen_information(options["<autogen.yaml>"], tbx)
+
+  if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+    os.makedirs(os.path.dirname(output))
+  with open(output, "w") as f:
+    count = write_compile_commands(compile_commands(tbx, build_dir, toolchain), f)
+  logger.info("Wrote {} compile commands to {}".format(count, output))
+
+if __name__ == "__main__":
+  sys.exit(main())
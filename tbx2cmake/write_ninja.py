@@ -0,0 +1,265 @@
+# coding: utf-8
+
+"""
+Writes a build.ninja for a TBX-distribution directly, without CMake.
+
+The targets, refresh-generated sources and link graph read from the
+SConscripts are turned into compile, link and python-module build edges.
+Header dependencies are tracked through compiler depfiles, and links share
+a limited job pool. Rerun tbx2ninja after changing the SConscripts.
+
+Usage: tbx2ninja [options] <module_dir> <autogen.yaml> <build_dir>
+
+Options:
+  --cc=<compiler>     The C compiler to use [default: cc]
+  --cxx=<compiler>    The C++ compiler to use [default: c++]
+  --include=<dirs>    Extra include directories, e.g. for boost and python,
+                      separated by the path separator
+  --ldflags=<flags>   Extra flags for every link, e.g. library directories
+  --profile=<name>    Add the flags specific to a build profile (one of
+                      release, debug, profile)
+  --only=<modules>    Only include a comma-separated list of modules, and
+                      the modules that they require
+  --link-jobs=<n>     The number of links to run at once [default: 2]
+  --refresh-command=<command>
+                      The command that runs a libtbx_refresh.py script,
+                      which is passed as the only argument [default: python]
+"""
+
+import sys
+import os
+import logging
+
+from docopt import docopt
+try:
+  from shlex import quote
+except ImportError:
+  from pipes import quote
+
+from .read_scons import read_distribution, unknown_modules
+from .pipeline import Pipeline
+from .write_cmake import read_autogen_information, LIBRARY_TYPES
+from .import_env import BUILD_PROFILES
+from .sconsemu import Target
+from .toolchain import Toolchain, source_paths, target_arguments, compiler_for, object_path
+
+logger = logging.getLogger(__name__)
+
+def escape(text):
+  "Escapes text for use in a ninja variable value"
+  return text.replace("$", "$$")
+
+def escape_path(path):
+  "Escapes a path for use in a ninja build statement"
+  return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+class NinjaWriter(object):
+  """Writes ninja syntax to a stream"""
+  def __init__(self, stream):
+    self.stream = stream
+
+  def _line(self, text, indent=0):
+    self.stream.write("  " * indent + text + "\n")
+
+  def newline(self):
+    self._line("")
+
+  def comment(self, text):
+    self._line("# " + text)
+
+  def variable(self, key, value, indent=0):
+    if isinstance(value, (list, tuple)):
+      value = " ".join(x for x in value if x)
+    self._line("{} = {}".format(key, value), indent)
+
+  def pool(self, name, depth):
+    self._line("pool {}".format(name))
+    self.variable("depth", depth, indent=1)
+
+  def rule(self, name, command, description=None, depfile=None, deps=None, pool=None, restat=False):
+    self._line("rule {}".format(name))
+    self.variable("command", command, indent=1)
+    if description:
+      self.variable("description", description, indent=1)
+    if depfile:
+      self.variable("depfile", depfile, indent=1)
+    if deps:
+      self.variable("deps", deps, indent=1)
+    if pool:
+      self.variable("pool", pool, indent=1)
+    if restat:
+      self.variable("restat", "1", indent=1)
+
+  def build(self, outputs, rule, inputs=(), implicit=(), order_only=(), variables=None):
+    text = "build {}: {}".format(" ".join(escape_path(x) for x in outputs), rule)
+    if inputs:
+      text += " " + " ".join(escape_path(x) for x in inputs)
+    if implicit:
+      text += " | " + " ".join(escape_path(x) for x in implicit)
+    if order_only:
+      text += " || " + " ".join(escape_path(x) for x in order_only)
+    self._line(text)
+    for key, value in sorted((variables or {}).items()):
+      self.variable(key, value, indent=1)
+
+  def default(self, paths):
+    self._line("default " + " ".join(escape_path(x) for x in paths))
+
+def output_path(target, build_dir):
+  "The file a target is linked to, in the build directory"
+  directory = target.output_path
+  if directory.startswith("#"):
+    directory = directory[1:].lstrip("/")
+  else:
+    directory = os.path.join(target.origin_path, directory)
+  if target.type == Target.Type.STATIC:
+    filename = "lib{}.a".format(target.filename)
+  elif target.type == Target.Type.SHARED:
+    filename = "lib{}.so".format(target.filename)
+  else:
+    filename = target.filename + ".so"
+  return os.path.normpath(os.path.join(os.path.abspath(build_dir), directory, filename))
+
+def _link_options(target, toolchain):
+  "The captured link flags for a target"
+  options = list(target.flags.link_options)
+  if toolchain.profile and toolchain.profile in target.flags.profiles:
+    options += target.flags.profiles[toolchain.profile].link_options
+  if target.openmp:
+    options.append("-fopenmp")
+  return options
+
+def write_ninja(tbx, build_dir, toolchain, stream, link_jobs=2, refresh_command="python", ldflags=""):
+  """Writes the build.ninja for a distribution.
+
+  :param tbx:       The TBXDistribution, with autogen information applied
+  :param build_dir: The directory that the build will be run in
+  :param toolchain: A Toolchain object
+  :param stream:    The stream to write the ninja file to
+  :returns: The number of targets written
+  """
+  build_dir = os.path.abspath(build_dir)
+  module_root = os.path.abspath(tbx.module_path)
+  ninja = NinjaWriter(stream)
+  ninja.comment("Generated by tbx2ninja from {}; do not edit".format(module_root))
+  ninja.variable("ninja_required_version", "1.7")
+  ninja.variable("builddir", escape(build_dir))
+  ninja.variable("cc", escape(toolchain.cc))
+  ninja.variable("cxx", escape(toolchain.cxx))
+  ninja.variable("ldflags", escape(ldflags))
+  ninja.variable("refresh", escape(refresh_command))
+  ninja.newline()
+  ninja.pool("link_pool", link_jobs)
+  ninja.newline()
+
+  ninja.rule("cc", "$cc -MD -MF $out.d $flags -c $in -o $out",
+    description="CC $out", depfile="$out.d", deps="gcc")
+  ninja.rule("cxx", "$cxx -MD -MF $out.d $flags -c $in -o $out",
+    description="CXX $out", depfile="$out.d", deps="gcc")
+  ninja.rule("link_shared", "$cxx -shared -Wl,-soname,$soname -o $out $in $linkflags $ldflags",
+    description="LINK $out", pool="link_pool")
+  ninja.rule("link_module", "$cxx -shared -o $out $in $linkflags $ldflags",
+    description="LINK MODULE $out", pool="link_pool")
+  ninja.rule("archive", "rm -f $out && ar crs $out $in",
+    description="AR $out")
+  ninja.rule("refresh", "cd $workdir && $refresh $in",
+    description="REFRESH $in", restat=True)
+  ninja.newline()
+
+  # Refresh steps run independently for every module
+  generated = []
+  for module in sorted(tbx.modules.values(), key=lambda x: x.name):
+    if not module.generated_sources:
+      continue
+    outputs = [os.path.join(build_dir, x) for x in sorted(module.generated_sources)]
+    script = os.path.join(module_root, module.path, "libtbx_refresh.py")
+    inputs = [os.path.join(module_root, x) for x in module.refresh_inputs]
+    ninja.build(outputs, "refresh", [script], implicit=inputs,
+      variables={"workdir": quote(build_dir)})
+    generated.extend(outputs)
+  ninja.build(["refresh_all"], "phony", generated)
+  ninja.newline()
+
+  targets = sorted((x for x in tbx.targets if x.type in LIBRARY_TYPES), key=lambda x: x.name)
+  outputs = {x.name: output_path(x, build_dir) for x in targets}
+  for target in targets:
+    ninja.comment("{} ({})".format(target.name, target.origin_path))
+    flags = target_arguments(tbx, target, build_dir, toolchain)
+    flag_variable = "flags_{}".format(target.name)
+    ninja.variable(flag_variable, escape(" ".join(quote(x) for x in flags)))
+
+    # Compile every source; generated headers have to exist beforehand
+    objects = []
+    for source in source_paths(tbx, target, build_dir):
+      obj = object_path(tbx, target, source, build_dir)
+      rule = "cc" if compiler_for(source, toolchain) == toolchain.cc else "cxx"
+      ninja.build([obj], rule, [source], order_only=["refresh_all"],
+        variables={"flags": "$" + flag_variable})
+      objects.append(obj)
+
+    # Link against internal libraries by path, and external ones by name
+    internal = sorted(x for x in target.extra_libs if x in outputs and x != target.name)
+    external = sorted(x for x in target.extra_libs if not x in outputs)
+    linkflags = [quote(x) for x in _link_options(target, toolchain)]
+    linkflags += [outputs[x] for x in internal] + ["-l" + x for x in external]
+    if target.output_path == "#/lib":
+      linkflags.append("-Wl,-rpath,'$ORIGIN'")
+    variables = {"linkflags": escape(" ".join(linkflags))}
+    if target.type == Target.Type.STATIC:
+      ninja.build([outputs[target.name]], "archive", objects)
+    elif target.type == Target.Type.SHARED:
+      variables["soname"] = os.path.basename(outputs[target.name])
+      ninja.build([outputs[target.name]], "link_shared", objects,
+        implicit=[outputs[x] for x in internal], variables=variables)
+    else:
+      ninja.build([outputs[target.name]], "link_module", objects,
+        implicit=[outputs[x] for x in internal], variables=variables)
+    ninja.newline()
+
+  ninja.default([outputs[x.name] for x in targets])
+  return len(targets)
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  options = docopt(__doc__)
+  module_dir = options["<module_dir>"]
+  build_dir = options["<build_dir>"]
+
+  if not os.path.isdir(module_dir):
+    print("Error: Module path {} must be a directory".format(module_dir))
+    sys.exit(1)
+  profile = options["--profile"]
+  if profile and not profile in BUILD_PROFILES:
+    print("Error: Unknown build profile {}; must be one of {}".format(profile, ", ".join(sorted(BUILD_PROFILES))))
+    sys.exit(1)
+  only = [x for x in (options["--only"] or "").split(",") if x]
+  if unknown_modules(module_dir, only):
+    print("Error: Unknown modules {}".format(", ".join(unknown_modules(module_dir, only))))
+    sys.exit(1)
+  if not options["--link-jobs"].isdigit() or int(options["--link-jobs"]) < 1:
+    print("Error: --link-jobs must be a positive number")
+    sys.exit(1)
+
+  toolchain = Toolchain()
+  toolchain.cc = options["--cc"]
+  toolchain.cxx = options["--cxx"]
+  toolchain.include_dirs = [x for x in (options["--include"] or "").split(os.pathsep) if x]
+  toolchain.profile = profile
+
+  logger.info("Reading TBX distribution")
+  tbx = read_distribution(module_dir, profiles=[profile] if profile else None, only=only,
+    pipeline=Pipeline.from_autogen(options["<autogen.yaml>"]))
+  read_autogen_information(options["<autogen.yaml>"], tbx)
+
+  if not os.path.isdir(build_dir):
+    os.makedirs(build_dir)
+  with open(os.path.join(build_dir, "build.ninja"), "w") as f:
+    count = write_ninja(tbx, build_dir, toolchain, f,
+      link_jobs=int(options["--link-jobs"]),
+      refresh_command=options["--refresh-command"],
+      ldflags=options["--ldflags"] or "")
+  logger.info("Wrote {} targets to {}".format(count, os.path.join(build_dir, "build.ninja")))
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,40 @@
+# coding: utf-8
+
+import os
+
+import pytest
+
+LIBTBX_SCONSCRIPT = """\
+import libtbx.load_env
+env_etc = libtbx.group_args()
+env_base = Environment(CCFLAGS=["-fPIC"], SHLINKFLAGS=["-shared"], LIBS=["m"],
+  CPPPATH=["DISTPATH"])
+Export("env_base", "env_etc")
+"""
+
+def _write(path, text):
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, "w") as f:
+    f.write(text)
+
+@pytest.fixture
+def distribution(tmpdir):
+  """Makes a small distribution to read, with libtbx and the modules given.
+
+  Each module is a dictionary of file name to contents, with the modules
+  it requires under "requires".
+  """
+  def _make(modules, name="dist"):
+    root = str(tmpdir.join(name))
+    _write(os.path.join(root, "libtbx", "SConscript"), LIBTBX_SCONSCRIPT)
+    _write(os.path.join(root, "libtbx", "libtbx_config"), '{"modules_required_for_build": []}')
+    for module, files in modules.items():
+      files = dict(files)
+      requires = files.pop("requires", [])
+      path = os.path.join(root, "cctbx_project", module)
+      _write(os.path.join(path, "libtbx_config"), repr({"modules_required_for_build": requires}))
+      for filename, text in files.items():
+        _write(os.path.join(path, filename), text)
+    return root
+  return _make
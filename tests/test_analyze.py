@@ -0,0 +1,77 @@
+# coding: utf-8
+
+import os
+
+import pytest
+
+from tbx2cmake import analyze
+from tbx2cmake.analyze import (analyze_build, binary_sizes, format_import_report, format_size_report,
+  format_unused_report)
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution
+
+FOO_SCONSCRIPT = """\
+import libtbx.load_env
+Import("env_base")
+env = env_base.Clone()
+if libtbx.env.build_options.static_libraries:
+  env.StaticLibrary(target="#lib/foo", source=["foo.cpp"])
+else:
+  env.SharedLibrary(target="#lib/foo", source=["foo.cpp"])
+env.Replace(SHLIBPREFIX="")
+env.SharedLibrary(target="#lib/foo_ext", source=["ext.cpp"], LIBS=["foo", "boost_python"])
+"""
+
+def test_import_report_compares_against_shared_build(distribution):
+  root = distribution({"foo": {"SConscript": FOO_SCONSCRIPT}})
+  pipeline = {"external_libraries": ["boost_python"]}
+  static = read_distribution(root, build_options={"static_libraries": True}, pipeline=Pipeline(pipeline))
+  baseline = read_distribution(root, pipeline=Pipeline(pipeline))
+  report = format_import_report(static, static_libraries=True, baseline=baseline)
+  assert "loads 1 internal libraries (2 as shared libraries)" in report
+
+CHAIN_SCONSCRIPT = """\
+Import("env_base")
+env_base.SharedLibrary(target="#lib/base", source=["base.cpp"])
+env_base.SharedLibrary(target="#lib/mid", source=["mid.cpp"], LIBS=["base"])
+env_base.SharedLibrary(target="#lib/side", source=["side.cpp"], LIBS=["base"])
+env_base.SharedLibrary(target="#lib/top", source=["top.cpp"], LIBS=["mid"])
+"""
+
+def test_critical_path_and_slack(distribution):
+  root = distribution({"foo": {"SConscript": CHAIN_SCONSCRIPT, "mid.cpp": "", "side.cpp": "", "top.cpp": ""}})
+  # Sources aren't necessarily UTF-8
+  with open(os.path.join(root, "cctbx_project", "foo", "base.cpp"), "wb") as f:
+    f.write(b"#include <boost/python.hpp>\n// \xff\n")
+  tbx = read_distribution(root, pipeline=Pipeline({"external_libraries": []}))
+  analysis = analyze_build(tbx)
+  assert analysis.costs["base"].heavy_includes == {"boost/python": 1}
+  assert analysis.critical_path == ["base", "mid", "top"]
+  assert analysis.slack["mid"] == 0
+  assert analysis.slack["side"] == pytest.approx(1.0)
+  assert analysis.makespan == pytest.approx(analysis.costs["base"].cost + 2.0)
+  assert [x[0] for x in analysis.bottlenecks()] == ["base", "mid", "top"]
+
+def test_size_report(tmpdir):
+  for build, sizes in (("base", {"lib/libfoo.so": 2048, "lib/libold.so": 10}),
+                       ("new", {"lib/libfoo.so": 1024, "lib/libnew.a": 10})):
+    for name, size in sizes.items():
+      tmpdir.join(build, name).write("x" * size, ensure=True)
+  tmpdir.join("new", "CMakeFiles", "ignored.so").write("x", ensure=True)
+  report = format_size_report(binary_sizes(str(tmpdir.join("new"))), binary_sizes(str(tmpdir.join("base"))))
+  lines = report.splitlines()
+  assert "lib/libfoo.so" in lines[1] and "-50.0%" in lines[1]
+  assert "lib/libnew.a" in lines[2] and "added" in lines[2]
+  assert "lib/libold.so" in lines[3] and "removed" in lines[3]
+  assert not "ignored" in report
+
+def test_unused_report(tmpdir, monkeypatch):
+  for name in ("lib/libfoo.so", "lib/libbar.so"):
+    tmpdir.join(name).write("", ensure=True)
+  unused = {"libfoo.so": ["/usr/lib/libm.so.6"], "libbar.so": []}
+  monkeypatch.setattr(analyze, "unused_dependencies", lambda path: unused[os.path.basename(path)])
+  assert format_unused_report(str(tmpdir)).splitlines() == [
+    "1 of 2 libraries have unused direct dependencies",
+    "  " + os.path.join("lib", "libfoo.so"),
+    "    /usr/lib/libm.so.6",
+  ]
@@ -0,0 +1,37 @@
+# coding: utf-8
+
+import pytest
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+from tbx2cmake.compare import compare_layouts
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution
+from tbx2cmake.write_cmake import DEPENDENCY_RENAMES, GenerationOptions, build_cmakelists
+
+MODULE_SCONSCRIPT = """\
+Import("env_base")
+env = env_base.Clone()
+env.Append(CPPDEFINES=["FOO_SHARED"], CCFLAGS=["-fno-strict-aliasing"])
+env.SharedLibrary(target="#lib/foo", source=["foo.cpp"])
+env.SharedLibrary(target="#lib/foo_extra", source=["foo_extra.cpp"])
+"""
+
+@pytest.mark.skipif(not which("cmake"), reason="needs cmake")
+def test_module_flags_compare_equal_in_both_layouts(distribution):
+  root = distribution({
+    "foo": {"SConscript": MODULE_SCONSCRIPT, "foo.cpp": "", "foo_extra.cpp": ""},
+    "bar": {"SConscript": 'Import("env_base")\nenv_base.SharedLibrary(target="#lib/bar", source=["bar.cpp"])\n',
+            "bar.cpp": ""},
+  })
+  tbx = read_distribution(root, pipeline=Pipeline({"external_libraries": []}))
+  cmakelists = build_cmakelists(tbx, GenerationOptions())
+  assert "add_compile_definitions( FOO_SHARED )" in cmakelists.get_path("cctbx_project/foo").generate_cmakelist()
+
+  imported = sorted(set(DEPENDENCY_RENAMES.values()))
+  comparison = compare_layouts(cmakelists, tbx, imported, repeat=1)
+  assert comparison.tree.properties[("foo", "COMPILE_DEFINITIONS")] == "FOO_SHARED"
+  assert comparison.differences == []
@@ -0,0 +1,27 @@
+# coding: utf-8
+
+import logging
+
+from tbx2cmake.compat import PY2, python3_source
+
+def test_python2_source_converted():
+  text = 'print "hi"\nif d.has_key("a"):\n  pass\n'
+  converted = python3_source(text, "SConscript")
+  if PY2:
+    assert converted == text
+  else:
+    assert converted == 'print("hi")\nif "a" in d:\n  pass\n'
+
+def test_python3_semantics_fixed_in_compiling_source(caplog):
+  text = 'names = map(str, libs)\nfirst = d.keys()[0]\nhalf = n / 2\n'
+  with caplog.at_level(logging.WARNING):
+    converted = python3_source(text, "SConscript")
+  if PY2:
+    assert converted == text
+  else:
+    assert converted == 'names = list(map(str, libs))\nfirst = list(d.keys())[0]\nhalf = n / 2\n'
+    assert "SConscript divides with / on lines 3" in caplog.text
+
+def test_source_without_python2_calls_unchanged():
+  text = 'env.Append(CPPPATH=["#/include/foo"])\n'
+  assert python3_source(text, "SConscript") is text
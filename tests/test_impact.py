@@ -0,0 +1,49 @@
+# coding: utf-8
+
+import json
+import sys
+
+from tbx2cmake import impact
+from tbx2cmake.impact import ImpactIndex
+from tbx2cmake.include_scan import scan_includes
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution
+
+SCONSCRIPT = 'Import("env_base")\nenv_base.SharedLibrary(target="#lib/{0}", source=["{0}.cpp"], LIBS=[{1}])\n'
+
+def _distribution(distribution):
+  root = distribution({
+    "foo": {"SConscript": SCONSCRIPT.format("foo", ""), "foo.cpp": "", "foo.h": ""},
+    "bar": {"SConscript": SCONSCRIPT.format("bar", '"foo"'), "bar.cpp": "", "requires": ["foo"]},
+    "baz": {"SConscript": SCONSCRIPT.format("baz", ""), "baz.cpp": '#include "foo/foo.h"\n',
+            "requires": ["foo"]},
+  })
+  return read_distribution(root, pipeline=Pipeline({"external_libraries": []}))
+
+def test_changed_source_affects_linking_targets(distribution):
+  index = ImpactIndex(_distribution(distribution))
+  impact = index.affected(["cctbx_project/foo/foo.cpp", "README"])
+  assert impact.targets == {"foo": "source cctbx_project/foo/foo.cpp changed",
+                            "bar": "links against foo"}
+  assert impact.modules == {"foo", "bar", "baz"}
+  assert impact.unmatched == ["README"]
+
+def test_changed_header_affects_including_targets(distribution):
+  tbx = _distribution(distribution)
+  # Without scanning, every target in the module and those requiring it
+  impact = ImpactIndex(tbx).affected(["cctbx_project/foo/foo.h"])
+  assert sorted(impact.targets) == ["bar", "baz", "foo"]
+  # With scanning, only the targets including the header, and their dependents
+  impact = ImpactIndex(tbx, scan_includes(tbx, jobs=1)).affected(["cctbx_project/foo/foo.h"])
+  assert impact.targets == {"baz": "includes cctbx_project/foo/foo.h"}
+
+def test_json_output_is_not_mixed_with_emulator_output(distribution, tmpdir, monkeypatch, capsys):
+  root = _distribution(distribution).module_path
+  autogen = tmpdir.join("autogen.yaml")
+  autogen.write("pipeline:\n  external_libraries: []\n")
+  capsys.readouterr()
+  monkeypatch.setattr(sys, "argv", ["tbx2impact", "--json", root, str(autogen), "cctbx_project/bar/bar.cpp"])
+  impact.main()
+  output = json.loads(capsys.readouterr().out)
+  assert output == {"targets": {"bar": "source cctbx_project/bar/bar.cpp changed"},
+                    "modules": ["bar"], "unmatched": []}
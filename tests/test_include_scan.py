@@ -0,0 +1,23 @@
+# coding: utf-8
+
+from tbx2cmake.include_scan import add_include_paths, scan_includes
+from tbx2cmake.read_scons import read_module_path_sconscripts
+
+def test_only_private_paths_for_headers_in_required_modules(distribution, tmpdir):
+  root = distribution({
+    "foo": {
+      "SConscript": 'Import("env_base")\n'
+                    'env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"])\n',
+      "foo.cpp": '#include <zlib.h>\n#include <bar/api.h>\n#include <baz/api.h>\n',
+      "third_party/zlib.h": "",
+      "requires": ["bar"],
+    },
+    "bar": {"include/bar/api.h": ""},
+    "baz": {"include/baz/api.h": ""},
+  })
+  tbx = read_module_path_sconscripts(root)
+  includes = scan_includes(tbx, jobs=1)
+  foo = includes["foo"]
+  assert foo.external == {"zlib.h", "baz/api.h"}
+  assert add_include_paths(includes) == 1
+  assert tbx.targets["foo"].include_paths == {"!#base/cctbx_project/bar/include"}
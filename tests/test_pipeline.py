@@ -0,0 +1,47 @@
+# coding: utf-8
+
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from tbx2cmake.pipeline import Pipeline, RuleError
+from tbx2cmake.read_scons import read_module_path_sconscripts, read_distributions
+
+SCONSCRIPT = 'Import("env_base")\nenv_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"], LIBS=["tiff"])\n'
+
+def _hits(pipeline, name):
+  return [x.hits for x in pipeline.rules if x.name == name][0]
+
+def test_one_pipeline_prepares_several_distributions(distribution):
+  roots = [distribution({"foo": {"SConscript": SCONSCRIPT}, "bar": {"SConscript": SCONSCRIPT}}, name=x)
+           for x in "abcd"]
+  pipeline = Pipeline({"external_libraries": ["tiff"]})
+  distributions = [read_module_path_sconscripts(x) for x in roots]
+  pool = ThreadPool(len(distributions))
+  try:
+    pool.map(pipeline.run, distributions)
+  finally:
+    pool.close()
+    pool.join()
+  for tbx in distributions:
+    assert sorted(x.name for x in tbx.targets) == ["foo_bar", "foo_foo"]
+  assert _hits(pipeline, "deduplicate_names") == 2 * len(roots)
+
+  # Worker processes send back how their copy of the pipeline performed
+  read_distributions(roots[:2], pipeline=pipeline)
+  assert _hits(pipeline, "deduplicate_names") == 2 * len(roots) + 4
+
+def test_remove_libraries_and_unexpected_external_libraries(distribution):
+  root = distribution({
+    "foo": {"SConscript": SCONSCRIPT},
+    "bar": {"SConscript": 'Import("env_base")\n'
+                          'env_base.SharedLibrary(target="#lib/bar", source=["bar.cpp"], LIBS=["cufft"])\n'},
+  })
+  tbx = read_module_path_sconscripts(root)
+  rules = Pipeline({"external_libraries": ["tiff"]}).run(tbx)
+  assert [x.name for x in tbx.targets] == ["foo"]
+  assert [x.hits for x in rules if x.name == "remove_libraries"] == [1]
+
+  tbx = read_module_path_sconscripts(root)
+  with pytest.raises(RuleError):
+    Pipeline({"external_libraries": [], "remove_libraries": []}).run(tbx)
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+import pytest
+
+from tbx2cmake.include_scan import scan_includes
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.query import Snapshot, snapshot_distribution
+from tbx2cmake.read_scons import read_distribution
+
+SCONSCRIPT = 'Import("env_base")\nenv_base.SharedLibrary(target="#lib/{0}", source=["{0}.cpp"], LIBS=[{1}])\n'
+
+@pytest.fixture
+def snapshot(distribution, tmpdir):
+  root = distribution({
+    "foo": {"SConscript": SCONSCRIPT.format("foo", '"tiff"'), "foo.cpp": "", "foo.h": ""},
+    "bar": {"SConscript": SCONSCRIPT.format("bar", '"foo"'), "bar.cpp": '#include "foo/foo.h"\n',
+            "requires": ["foo"]},
+    "baz": {"SConscript": SCONSCRIPT.format("baz", '"bar"'), "baz.cpp": "", "requires": ["bar"]},
+  })
+  tbx = read_distribution(root, pipeline=Pipeline({"external_libraries": ["tiff"]}))
+  # Queries are answered from the saved file
+  filename = str(tmpdir.join("dist.json"))
+  snapshot_distribution(tbx, scan_includes(tbx, jobs=1)).save(filename)
+  return Snapshot.load(filename)
+
+def test_link_queries(snapshot):
+  assert snapshot.links("baz") == ["bar", "foo", "tiff"]
+  assert snapshot.links("baz", direct=True) == ["bar"]
+  assert snapshot.linked_by_targets("foo") == ["bar", "baz"]
+  assert snapshot.linked_by_targets("foo", direct=True) == ["bar"]
+  assert snapshot.path("baz", "foo") == ["baz", "bar", "foo"]
+  assert snapshot.path("foo", "baz") is None
+
+def test_module_queries(snapshot):
+  assert snapshot.requires("baz") == ["bar", "foo", "libtbx"]
+  assert snapshot.required_by_modules("foo") == ["bar", "baz"]
+  assert snapshot.required_by_modules("foo", direct=True) == ["bar"]
+  with pytest.raises(KeyError):
+    snapshot.path("baz", "libtbx_module_that_does_not_exist")
+
+def test_owner_queries(snapshot):
+  assert snapshot.owners("cctbx_project/foo/foo.cpp") == {"foo": "compiles"}
+  assert snapshot.owners("cctbx_project/foo/foo.h") == {"bar": "includes"}
+  assert snapshot.owners("cctbx_project/foo/missing.h") == {}
+
+def test_snapshot_version_checked(snapshot, tmpdir):
+  snapshot.data["version"] = Snapshot.VERSION + 1
+  filename = str(tmpdir.join("old.json"))
+  snapshot.save(filename)
+  with pytest.raises(ValueError):
+    Snapshot.load(filename)
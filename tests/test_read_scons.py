@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import multiprocessing
+
+from tbx2cmake import read_scons, utils
+from tbx2cmake.compat import PY2
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution, read_distributions
+from tbx2cmake.static_scons import describe_target
+
+def _describe(tbx):
+  return {(x.module.name, x.name): describe_target(x) for x in tbx.targets}
+
+def test_read_together_matches_read_alone(distribution):
+  roots = [
+    distribution({"foo": {"SConscript": 'Import("env_base")\n'
+      'env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"], LIBS=["tiff"])\n'}}, name="a"),
+    distribution({"bar": {"SConscript": 'Import("env_base")\n'
+      'env = env_base.Clone(CPPDEFINES=["BAR"])\n'
+      'env.SharedLibrary(target="#lib/bar", source=["bar.cpp"], LIBS=["tiff"])\n'}}, name="b"),
+  ]
+  pipeline = Pipeline({"external_libraries": ["tiff"]})
+  together = read_distributions(roots, pipeline=pipeline)
+  alone = [read_distribution(x, pipeline=pipeline) for x in roots]
+  assert [_describe(x) for x in together] == [_describe(x) for x in alone]
+  assert [sorted(x.name for x in tbx.targets) for tbx in together] == [["foo"], ["bar"]]
+
+def test_scripts_converted_before_forking_workers(distribution, monkeypatch):
+  script = ('Import("env_base")\n'
+            'if env_base.has_key("CCFLAGS"): pass\n'
+            'env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"], LIBS=["tiff"])\n')
+  roots = [distribution({"foo": {"SConscript": script, "foo.cpp": ""}}, name=x) for x in "ab"]
+  monkeypatch.setattr(utils, "_converted_sources", {})
+  tbxs = read_distributions(roots, pipeline=Pipeline({"external_libraries": ["tiff"]}))
+  assert [[x.name for x in tbx.targets] for tbx in tbxs] == [["foo"], ["foo"]]
+  if not PY2 and multiprocessing.get_start_method() == "fork":
+    assert script in utils._converted_sources
+
+PROFILE_SCONSCRIPT = """\
+import libtbx.load_env
+Import("env_base")
+env = env_base.Clone()
+env.Append(CCFLAGS=["-O3"] if libtbx.env.build_options.optimization else ["-O0"])
+env.SharedLibrary(target="#lib/foo", source=["foo.cpp"], LIBS=["tiff"])
+"""
+
+def test_profiles_emulated_once_each(distribution, monkeypatch):
+  root = distribution({"foo": {"SConscript": PROFILE_SCONSCRIPT, "foo.cpp": ""}})
+  calls = []
+  original = read_scons.read_module_path_sconscripts
+  def _counted(*args, **kwargs):
+    calls.append(args)
+    return original(*args, **kwargs)
+  monkeypatch.setattr(read_scons, "read_module_path_sconscripts", _counted)
+  tbx = read_distribution(root, profiles=["release", "debug"], pipeline=Pipeline({"external_libraries": ["tiff"]}))
+  assert len(calls) == 2
+  flags = tbx.targets["foo"].flags
+  assert flags.profile("release").compile_options == ["-O3"]
+  assert flags.profile("debug").compile_options == ["-O0"]
+  assert not "-O3" in flags.compile_options and not "-O0" in flags.compile_options
+
+def test_only_reads_the_requested_module_closure(distribution):
+  sconscript = 'Import("env_base")\nenv_base.SharedLibrary(target="#lib/{0}", source=["{0}.cpp"], LIBS=[{1}])\n'
+  root = distribution({
+    "foo": {"SConscript": sconscript.format("foo", '"tiff"'), "foo.cpp": ""},
+    "bar": {"SConscript": sconscript.format("bar", '"foo"'), "bar.cpp": "", "requires": ["foo"]},
+    "baz": {"SConscript": sconscript.format("baz", '"hdf5"'), "baz.cpp": ""},
+  })
+  assert read_scons.unknown_modules(root, ["bar", "qux", "foo"]) == ["qux"]
+  # Only the libraries used by the selected modules need to be expected
+  tbx = read_distribution(root, only=["bar"], pipeline=Pipeline({"external_libraries": ["tiff", "hdf5"]}))
+  assert tbx.selected_modules == {"bar", "foo", "libtbx"}
+  assert sorted(tbx.modules) == ["bar", "foo"]
+  assert sorted(x.name for x in tbx.targets) == ["bar", "foo"]
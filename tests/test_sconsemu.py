@@ -0,0 +1,15 @@
+# coding: utf-8
+
+from tbx2cmake.read_scons import read_module_path_sconscripts
+
+def test_paired_compile_options_kept_together(distribution):
+  root = distribution({"foo": {
+    "SConscript": 'Import("env_base")\n'
+                  'env = env_base.Clone(CXXFLAGS=["-Xclang", "-a", "-Xclang", "-b", "-I", "inc",\n'
+                  '  "-isystem", "d1", "-isystem", "d2", "-D", "X=1"])\n'
+                  'env.SharedLibrary(target="#lib/foo", source=["foo.cpp"])\n',
+  }})
+  tbx = read_module_path_sconscripts(root)
+  foo = tbx.targets["foo"]
+  assert foo.flags.compile_options == ["-Xclang -a", "-Xclang -b", "-isystem d1", "-isystem d2"]
+  assert foo.flags.compile_definitions == ["X=1"]
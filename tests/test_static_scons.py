@@ -0,0 +1,19 @@
+# coding: utf-8
+
+from tbx2cmake.read_scons import verify_fast_path
+
+def test_attributes_read_after_sconscript(distribution):
+  root = distribution({
+    "foo": {"SConscript": 'Import("env_etc")\nenv_etc.bar_defines = ["STALE"]\n'},
+    "bar": {
+      "requires": ["foo"],
+      "SConscript": 'Import("env_base", "env_etc")\n'
+                    'SConscript("sub/SConscript")\n'
+                    'env = env_base.Clone(CPPDEFINES=env_etc.bar_defines)\n'
+                    'env.SharedLibrary(target="#lib/bar", source=["bar.cpp"])\n',
+      "sub/SConscript": 'Import("env_etc")\nenv_etc.bar_defines = ["FROM_SUB"]\n',
+    },
+  })
+  differences, tbx = verify_fast_path(root)
+  assert differences == []
+  assert tbx.targets["bar"].flags.compile_definitions == ["FROM_SUB"]
@@ -0,0 +1,13 @@
+# coding: utf-8
+
+from tbx2cmake.read_scons import read_module_path_sconscripts
+from tbx2cmake.toolchain import Toolchain, target_arguments
+
+def test_static_libraries_are_position_independent(distribution, tmpdir):
+  root = distribution({"foo": {
+    "SConscript": 'Import("env_base")\n'
+                  'env_base.StaticLibrary(target="#lib/foo", source=["foo.cpp"])\n',
+  }})
+  tbx = read_module_path_sconscripts(root)
+  arguments = target_arguments(tbx, tbx.targets["foo"], str(tmpdir.join("build")), Toolchain())
+  assert "-fPIC" in arguments
@@ -0,0 +1,253 @@
+# coding: utf-8
+
+import os
+import re
+import sys
+import subprocess
+
+import pytest
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+from tbx2cmake import write_cmake
+from tbx2cmake.analyze import format_cache_report
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution, read_module_path_sconscripts
+from tbx2cmake.write_cmake import GenerationOptions, build_cmakelists, read_autogen_information
+
+SCONSCRIPT = 'Import("env_base")\nenv_base.SharedLibrary(target="#lib/{0}", source=["{0}.cpp"])\n'
+
+def test_other_generated_only_owned_when_named(distribution, tmpdir):
+  root = distribution({
+    "foo": {"SConscript": SCONSCRIPT.format("foo"), "foo.cpp": "", "libtbx_refresh.py": ""},
+    "bar": {"SConscript": SCONSCRIPT.format("bar"), "bar.cpp": "", "libtbx_refresh.py": ""},
+  })
+  autogen = tmpdir.join("autogen.yaml")
+  autogen.write("other_generated:\n"
+                "  - foo/unowned.h\n"
+                "  - include/foo/named.h: bar\n")
+  tbx = read_module_path_sconscripts(root)
+  read_autogen_information(str(autogen), tbx)
+  assert tbx.other_generated == ["foo/unowned.h"]
+  assert tbx.modules["foo"].generated_sources == []
+  assert tbx.modules["bar"].generated_sources == ["include/foo/named.h"]
+
+OPTIMISED_SCONSCRIPT = """\
+import libtbx.load_env
+Import("env_base")
+env = env_base.Clone()
+if libtbx.env.build_options.optimization:
+  env.Append(CCFLAGS=["-O3"], CPPDEFINES=["NDEBUG"])
+else:
+  env.Append(CCFLAGS=["-O0"])
+if libtbx.env.build_options.debug_symbols:
+  env.Append(CCFLAGS=["-g"])
+env.Append(CCFLAGS=["-fno-strict-aliasing"])
+env.SharedLibrary(target="#lib/{0}", source=["{0}.cpp"])
+env.SharedLibrary(target="#lib/{0}_extra", source=["{0}_extra.cpp"])
+"""
+
+def _generated_cmake(root, profiles=(), external_libraries=(), autogen=None, **options):
+  "The text of every CMakeLists generated, by path, with GenerationOptions set"
+  tbx = read_distribution(root, profiles=list(profiles),
+                          pipeline=Pipeline({"external_libraries": list(external_libraries)}))
+  if autogen:
+    filename = os.path.join(root, "autogen.yaml")
+    with open(filename, "w") as f:
+      f.write(autogen)
+    read_autogen_information(filename, tbx)
+  generation = GenerationOptions()
+  generation.profiles = list(profiles)
+  for name, value in options.items():
+    setattr(generation, name, value)
+  cmakelists = build_cmakelists(tbx, generation)
+  return {x.full_path: x.generate_cmakelist() for x in cmakelists.all()}
+
+@pytest.mark.parametrize("profiles", [(), ("release", "debug")])
+def test_build_type_flags_left_to_the_build_type(distribution, profiles):
+  root = distribution({"foo": {"SConscript": OPTIMISED_SCONSCRIPT.format("foo"),
+                               "foo.cpp": "", "foo_extra.cpp": ""}})
+  output = _generated_cmake(root, profiles)
+  for text in output.values():
+    for line in text.splitlines():
+      if not line.startswith("set(CMAKE_"):
+        assert not "-O0" in line and not "-O3" in line and not "NDEBUG" in line, line
+  assert "add_compile_options( -fno-strict-aliasing )" in output[""]
+  if profiles:
+    assert 'set(CMAKE_CXX_FLAGS_DEBUG "-O0 -g")' in output[""]
+
+def test_pgo_build_types_are_optimised(distribution, tmpdir, monkeypatch):
+  root = distribution({"foo": {"SConscript": OPTIMISED_SCONSCRIPT.format("foo"),
+                               "foo.cpp": "", "foo_extra.cpp": ""}})
+  autogen = tmpdir.join("autogen.yaml")
+  autogen.write("pipeline:\n  external_libraries: []\n")
+  output = tmpdir.join("output")
+  monkeypatch.setattr(sys, "argv", ["tbx2cmake", str(root), str(autogen), str(output), "--pgo"])
+  write_cmake.main()
+  text = output.join("autogen_CMakeLists.txt").read()
+  assert 'set(CMAKE_CXX_FLAGS_RELEASE "-O3 -DNDEBUG")' in text
+  assert "CMAKE_${_lang}_FLAGS_PGOINSTRUMENT \"${CMAKE_${_lang}_FLAGS_RELEASE}" in text
+  assert not "-O0" in text
+
+def test_split_dwarf_only_for_debug_build_types(distribution):
+  root = distribution({"foo": {"SConscript": OPTIMISED_SCONSCRIPT.format("foo"),
+                               "foo.cpp": "", "foo_extra.cpp": ""}})
+  tbx = read_distribution(root, profiles=["release", "profile"],
+                          pipeline=Pipeline({"external_libraries": []}))
+  generation = GenerationOptions()
+  generation.profiles = ["release", "profile"]
+  generation.split_dwarf = True
+  generation.linker = "gold"
+  generation.gdb_index = True
+  text = build_cmakelists(tbx, generation).generate_cmakelist()
+  assert ("add_compile_options($<$<OR:$<CONFIG:Debug>,$<CONFIG:RelWithDebInfo>,"
+          "$<CONFIG:Profile>>:-gsplit-dwarf>)") in text
+  assert "  add_link_options(-fuse-ld=gold)" in text
+  assert "  add_link_options(-Wl,--gdb-index)" in text
+  # Debug information only comes from the build types
+  for line in text.splitlines():
+    if line.lstrip().startswith("add_compile_options"):
+      assert not " -g" in line, line
+  assert 'set(CMAKE_CXX_FLAGS_PROFILE "-O3 -g -DNDEBUG")' in text
+
+OPENMP_SCONSCRIPT = """\
+Import("env_base")
+env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"])
+env = env_base.Clone()
+env.Append(CCFLAGS=["-fopenmp"], SHLINKFLAGS=["-fopenmp"])
+env.SharedLibrary(target="#lib/foo_omp", source=["foo_omp.cpp"])
+"""
+
+def test_openmp_linked_for_targets_built_with_it(distribution):
+  root = distribution({"foo": {"SConscript": OPENMP_SCONSCRIPT, "foo.cpp": "", "foo_omp.cpp": ""}})
+  output = _generated_cmake(root)
+  assert "find_package(OpenMP)" in output[""]
+  module = output["cctbx_project/foo"]
+  assert "  target_link_libraries( foo_omp OpenMP::OpenMP_CXX )" in module
+  assert not "target_link_libraries( foo OpenMP" in module
+  assert not any("-fopenmp" in x for x in output.values())
+
+def test_lto_for_optimised_build_types(distribution):
+  root = distribution({"foo": {"SConscript": OPTIMISED_SCONSCRIPT.format("foo"),
+                               "foo.cpp": "", "foo_extra.cpp": ""}})
+  output = _generated_cmake(root, profiles=["release"], autogen="lto_exclude: [foo_extra]\n",
+                            lto=True, lto_jobs="4", pgo=True)
+  text = output[""]
+  assert "  set(CMAKE_INTERPROCEDURAL_OPTIMIZATION_RELEASE ON)" in text
+  assert "  set(CMAKE_INTERPROCEDURAL_OPTIMIZATION_PGOOPTIMIZE ON)" in text
+  assert not "CMAKE_INTERPROCEDURAL_OPTIMIZATION_PGOINSTRUMENT" in text
+  assert "    add_link_options( $<$<OR:$<CONFIG:Release>,$<CONFIG:PGOOptimize>>:-flto=4> )" in text
+  assert "-flto-jobs=4" in text
+  module = output["cctbx_project/foo"]
+  assert ("set_target_properties( foo_extra PROPERTIES \n"
+          "    INTERPROCEDURAL_OPTIMIZATION_RELEASE OFF\n"
+          "    INTERPROCEDURAL_OPTIMIZATION_PGOOPTIMIZE OFF )") in module
+  assert not "set_target_properties( foo PROPERTIES" in module
+
+VISIBILITY_SCONSCRIPT = """\
+Import("env_base")
+env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"])
+env_base.SharedLibrary(target="#lib/foo_leaf", source=["foo_leaf.cpp"])
+env_base.SharedLibrary(target="#lib/foo_user", source=["foo_user.cpp"], LIBS=["foo"])
+"""
+
+@pytest.mark.parametrize("annotated", [False, True])
+def test_hidden_visibility_keeps_linked_libraries_visible(distribution, annotated):
+  root = distribution({"foo": {"SConscript": VISIBILITY_SCONSCRIPT,
+                               "foo.cpp": "", "foo_leaf.cpp": "", "foo_user.cpp": ""}})
+  autogen = "export_annotated: [foo]\n" if annotated else "{}\n"
+  output = _generated_cmake(root, autogen=autogen, hidden_visibility=True)
+  assert "  add_link_options(-Wl,--gc-sections)" in output[""]
+  hidden = re.findall(r"set_target_properties\( (\w+) PROPERTIES\s+C_VISIBILITY_PRESET hidden",
+                      output["cctbx_project/foo"])
+  assert hidden == (["foo", "foo_leaf", "foo_user"] if annotated else ["foo_leaf", "foo_user"])
+
+HAZARD_SCONSCRIPT = """\
+Import("env_base")
+env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"])
+env = env_base.Clone()
+env.Append(CCFLAGS=["-fdebug-prefix-map=/home/build=."])
+env.SharedLibrary(target="#lib/foo_paths", source=["foo_paths.cpp"])
+"""
+
+def test_cache_report_finds_build_specific_flags(distribution):
+  root = distribution({"foo": {"SConscript": HAZARD_SCONSCRIPT, "foo.cpp": "", "foo_paths.cpp": ""}})
+  tbx = read_distribution(root, pipeline=Pipeline({"external_libraries": []}))
+  report = format_cache_report(tbx).splitlines()
+  assert report[0] == "1 of 2 targets have build-specific compile commands"
+  assert report[1].split() == ["foo_paths", "(cctbx_project/foo)"]
+  assert report[2].strip() == "absolute path in flag -fdebug-prefix-map=/home/build=."
+
+@pytest.mark.skipif(not which("cmake"), reason="needs cmake")
+def test_ccache_launcher_configures(tmpdir):
+  launcher = tmpdir.join("bin", "ccache")
+  launcher.write("#!/bin/sh\nexec \"$@\"\n", ensure=True)
+  launcher.chmod(0o755)
+  options = GenerationOptions()
+  options.compiler_launcher = str(launcher)
+  source = tmpdir.join("checkout", "src")
+  source.join("CMakeLists.txt").write("\n".join(
+    ["cmake_minimum_required(VERSION 3.14)", "project(launcher CXX)"] +
+    write_cmake._compiler_launcher_lines(options)) + "\n", ensure=True)
+  build = tmpdir.join("checkout", "build")
+  subprocess.check_output(["cmake", "-S", str(source), "-B", str(build)], stderr=subprocess.STDOUT)
+  cache = build.join("CMakeCache.txt").read()
+  assert "TBX_CCACHE_BASEDIR:PATH={}\n".format(os.path.realpath(str(tmpdir.join("checkout")))) in cache
+  assert "TBX_COMPILER_LAUNCHER:FILEPATH={}\n".format(launcher) in cache
+
+def test_origin_rpath_for_libraries_in_lib(distribution):
+  root = distribution({"foo": {"SConscript": VISIBILITY_SCONSCRIPT +
+    'env_base.StaticLibrary(target="#lib/foo_static", source=["foo_static.cpp"])\n'
+    'env_base.SharedLibrary(target="foo_local", source=["foo_local.cpp"])\n',
+    "foo.cpp": "", "foo_leaf.cpp": "", "foo_user.cpp": "", "foo_static.cpp": "", "foo_local.cpp": ""}})
+  output = _generated_cmake(root, origin_rpath=True)
+  assert "  set(TBX_ORIGIN $ORIGIN)" in output[""]
+  assert "  add_link_options(-Wl,--as-needed)" in output[""]
+  with_rpath = re.findall(r"set_target_properties\( (\w+) PROPERTIES\s+LIBRARY_OUTPUT_DIRECTORY "
+                          r"\$\{TBX_LIBRARY_DIR\}\s+BUILD_WITH_INSTALL_RPATH ON\s+INSTALL_RPATH \$\{TBX_ORIGIN\}",
+                          output["cctbx_project/foo"])
+  assert with_rpath == ["foo", "foo_leaf", "foo_user"]
+
+@pytest.mark.skipif(not which("cmake") or not which("ninja"), reason="needs cmake and ninja")
+def test_refresh_outputs_restored_from_cache(tmpdir):
+  log = tmpdir.join("runs.log")
+  runner = tmpdir.join("runner.sh")
+  runner.write("#!/bin/sh\necho \"$1\" >> {}\nmkdir -p foo\necho \"// $1\" > foo/gen.h\n".format(log))
+  runner.chmod(0o755)
+  options = GenerationOptions()
+  options.refresh_cache = True
+  source = tmpdir.join("src")
+  source.join("foo", "libtbx_refresh.py").write("", ensure=True)
+  source.join("CMakeLists.txt").write("\n".join(
+    ["cmake_minimum_required(VERSION 3.14)", "project(refresh NONE)"] +
+    write_cmake._refresh_command_lines(options) +
+    ["tbx_libtbx_refresh( ${CMAKE_SOURCE_DIR}/foo/libtbx_refresh.py OUTPUT ${CMAKE_BINARY_DIR}/foo/gen.h )",
+     "add_custom_target( generated ALL DEPENDS ${CMAKE_BINARY_DIR}/foo/gen.h )"]) + "\n")
+  for name in ("build", "build2"):
+    build = tmpdir.join(name)
+    subprocess.check_output(["cmake", "-S", str(source), "-B", str(build), "-G", "Ninja",
+      "-DTBX_REFRESH_RUNNER=" + str(runner), "-DTBX_REFRESH_CACHE_DIR=" + str(tmpdir.join("cache"))],
+      stderr=subprocess.STDOUT)
+    subprocess.check_output(["ninja", "-C", str(build)], stderr=subprocess.STDOUT)
+    # Relative to the build directory, so the cached outputs match
+    assert build.join("foo", "gen.h").read() == "// ../src/foo/libtbx_refresh.py\n"
+  # The second build directory restored the outputs instead of running the refresh
+  assert log.read() == "../src/foo/libtbx_refresh.py\n"
+
+def test_output_identical_between_hash_seeds(distribution, tmpdir, monkeypatch, capsys):
+  root = distribution({
+    "foo": {"SConscript": OPTIMISED_SCONSCRIPT.format("foo"), "foo.cpp": "", "foo_extra.cpp": ""},
+    "bar": {"SConscript": VISIBILITY_SCONSCRIPT.replace("foo", "bar"), "requires": ["foo"],
+            "bar.cpp": "", "bar_leaf.cpp": "", "bar_user.cpp": ""},
+  })
+  autogen = tmpdir.join("autogen.yaml")
+  autogen.write("pipeline:\n  external_libraries: []\n")
+  monkeypatch.setenv("PYTHONPATH", os.path.dirname(os.path.dirname(os.path.abspath(write_cmake.__file__))))
+  assert write_cmake._check_deterministic([root, str(autogen), "--hidden-visibility"]) == 0
+  assert "Output is identical between hash seeds (4 files)" in capsys.readouterr().out
+
+  assert write_cmake._check_deterministic([str(tmpdir.join("missing")), str(autogen)]) == 1
+  assert "Generation with PYTHONHASHSEED=1 failed" in capsys.readouterr().out
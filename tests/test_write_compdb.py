@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import json
+import os
+
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution
+from tbx2cmake.toolchain import Toolchain
+from tbx2cmake.write_compdb import compile_commands, write_compile_commands
+
+SCONSCRIPT = """\
+Import("env_base")
+env = env_base.Clone()
+env.Append(CPPDEFINES=["FOO"])
+env.SharedLibrary(target="#lib/foo", source=["foo.cpp", "helper.c"])
+"""
+
+def test_compile_commands_for_every_source(distribution, tmpdir):
+  root = distribution({"foo": {"SConscript": SCONSCRIPT, "foo.cpp": "", "helper.c": ""}})
+  tbx = read_distribution(root, pipeline=Pipeline({"external_libraries": []}))
+  build_dir = str(tmpdir.join("build"))
+  toolchain = Toolchain()
+  toolchain.cc = "gcc"
+  toolchain.include_dirs = ["/opt/boost/include"]
+
+  database = tmpdir.join("compile_commands.json")
+  with open(str(database), "w") as f:
+    assert write_compile_commands(compile_commands(tbx, build_dir, toolchain), f) == 2
+  entries = json.loads(database.read())
+  module = os.path.join(os.path.abspath(root), "cctbx_project", "foo")
+  assert [x["file"] for x in entries] == [os.path.join(module, "foo.cpp"), os.path.join(module, "helper.c")]
+  assert all(x["directory"] == os.path.abspath(build_dir) for x in entries)
+  assert [x["arguments"][0] for x in entries] == ["c++", "gcc"]
+  arguments = entries[0]["arguments"]
+  assert arguments[1] == "-fPIC"
+  assert "-DFOO" in arguments and "-I/opt/boost/include" in arguments
+  assert arguments[-4:] == ["-c", entries[0]["file"], "-o", entries[0]["output"]]
+  assert entries[0]["output"] == os.path.join(os.path.abspath(build_dir), "cctbx_project", "foo",
+                                              "foo.dir", "foo.cpp.o")
+
+def test_empty_database_is_valid_json(tmpdir):
+  database = tmpdir.join("compile_commands.json")
+  with open(str(database), "w") as f:
+    assert write_compile_commands(iter([]), f) == 0
+  assert json.loads(database.read()) == []
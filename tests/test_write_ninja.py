@@ -0,0 +1,48 @@
+# coding: utf-8
+
+import os
+import subprocess
+
+import pytest
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+from tbx2cmake.pipeline import Pipeline
+from tbx2cmake.read_scons import read_distribution
+from tbx2cmake.toolchain import Toolchain
+from tbx2cmake.write_ninja import escape_path, write_ninja
+
+SCONSCRIPT = """\
+Import("env_base")
+env_base.SharedLibrary(target="#lib/foo", source=["foo.cpp"])
+env_base.SharedLibrary(target="#lib/foo_user", source=["user.cpp"], LIBS=["foo"])
+"""
+
+def test_escape_path():
+  assert escape_path("a b:$c") == "a$ b$:$$c"
+
+@pytest.mark.skipif(not which("ninja") or not which("c++"), reason="needs ninja and a compiler")
+def test_ninja_builds_the_distribution(distribution, tmpdir):
+  root = distribution({"foo": {
+    "SConscript": SCONSCRIPT,
+    "foo.cpp": "int foo() { return 1; }\n",
+    "user.cpp": "int foo();\nint foo_user() { return foo() + 1; }\n",
+  }})
+  tbx = read_distribution(root, pipeline=Pipeline({"external_libraries": []}))
+  build_dir = str(tmpdir.join("build"))
+  os.makedirs(build_dir)
+  with open(os.path.join(build_dir, "build.ninja"), "w") as f:
+    assert write_ninja(tbx, build_dir, Toolchain(), f) == 2
+  subprocess.check_output(["ninja", "-C", build_dir], stderr=subprocess.STDOUT)
+  for name in ("libfoo.so", "libfoo_user.so"):
+    assert os.path.isfile(os.path.join(build_dir, "lib", name))
+  # Nothing is rebuilt without changes
+  output = subprocess.check_output(["ninja", "-C", build_dir, "-n"], universal_newlines=True)
+  assert "no work to do" in output
+  if which("readelf"):
+    dynamic = subprocess.check_output(["readelf", "-d", os.path.join(build_dir, "lib", "libfoo_user.so")],
+                                      universal_newlines=True)
+    assert "libfoo.so" in dynamic and "$ORIGIN" in dynamic